@@ -0,0 +1,403 @@
+#!/usr/bin/env python
+# coding=utf-8
+import time
+import asyncio
+import inspect
+import logging
+import typing
+import threading
+from functools import wraps, partial
+from py_enum import ChoiceEnum
+
+from pykit_tools import fork
+from pykit_tools.utils import get_caller_location
+
+
+class CircuitState(ChoiceEnum):
+    """
+    `枚举` 熔断器状态，定义值详见源码。
+
+    应用于 [CircuitBreaker](./#decorators.breaker.CircuitBreaker)
+    """
+
+    CLOSED = ("closed", "关闭，正常调用")
+    OPEN = ("open", "打开，直接失败不调用")  # 经过 cool_down 后进入半开状态
+    HALF_OPEN = ("half_open", "半开，允许少量调用试探是否恢复")  # 试探成功后关闭，失败后重新打开
+
+
+class CircuitOpenError(Exception):
+    """
+    熔断器打开时调用抛出的异常
+    """
+
+    def __init__(self, name: str) -> None:
+        super(CircuitOpenError, self).__init__(f"circuit breaker {name} is open")
+        self.name = name
+
+
+class CircuitBreaker(object):
+    """
+    熔断器：统计最近 window_size 次调用的失败率，超过阈值后打开熔断器，cool_down 秒内直接失败，
+    之后进入半开状态允许少量调用试探，试探成功后关闭
+
+    同一个名称的熔断器可以在多个函数间共享，通过 [get_circuit_breaker](./#decorators.breaker.get_circuit_breaker) 获取；
+    设置 shared_client（例如redis客户端）后，熔断器打开的状态会同步到其他进程/机器
+    """
+
+    def __init__(
+        self,
+        name: str,
+        failure_rate: float = 0.5,
+        window_size: int = 20,
+        min_calls: int = 10,
+        cool_down: float = 30,
+        half_open_calls: int = 1,
+        shared_client: typing.Any = None,
+        shared_check_interval: float = 1,
+        logger_name: str = "pykit_tools.error",
+        logger_level: int = logging.ERROR,
+    ) -> None:
+        """
+        初始化构造对象
+
+        Args:
+            name: 名称
+            failure_rate: 失败率阈值，达到该值后打开熔断器
+            window_size: 统计失败率的最近调用次数（环形缓冲区大小）
+            min_calls: 窗口内最少调用次数，达到后才计算失败率
+            cool_down: 熔断器打开的持续时间，单位秒(s)，之后进入半开状态
+            half_open_calls: 半开状态允许试探调用的次数，均成功后关闭熔断器
+            shared_client: 共享熔断状态的缓存client，需有 get(key) 和 set(key, value, timeout) 方法，一般使用redis客户端
+            shared_check_interval: 从 shared_client 检查熔断状态的间隔，单位秒(s)
+            logger_name: 日志名称，记录状态变化
+            logger_level: 熔断器打开时日志的级别
+        """
+        self.name = name
+        self.failure_rate = failure_rate
+        self.window_size = window_size
+        self.min_calls = min_calls
+        self.cool_down = cool_down
+        self.half_open_calls = half_open_calls
+        self.shared_client = shared_client
+        self.shared_check_interval = shared_check_interval
+        self.logger_name = logger_name
+        self.logger_level = logger_level
+
+        self._lock = threading.Lock()
+        self._state = CircuitState.CLOSED.value
+        self._opened_at = 0.0
+        self._shared_checked_at = 0.0
+        # 环形缓冲区，记录最近调用是否失败
+        self._window: typing.List[bool] = []
+        self._index = 0
+        self._failures = 0
+        # 半开状态下已放行和已成功的调用数
+        self._trial_calls = 0
+        self._trial_successes = 0
+        fork.register_after_fork(self._after_fork)
+
+    def _after_fork(self) -> None:
+        self._lock = threading.Lock()
+
+    @property
+    def shared_key(self) -> str:
+        return f"circuit:{self.name}"
+
+    @property
+    def state(self) -> str:
+        """
+        当前状态 [CircuitState](./#decorators.breaker.CircuitState)
+        """
+        with self._lock:
+            self._check_cool_down(time.monotonic())
+            return self._state
+
+    def _set_state(self, state: str) -> None:
+        # 调用方需持有锁
+        if state == self._state:
+            return
+        level = self.logger_level if state == CircuitState.OPEN.value else logging.INFO
+        logging.getLogger(self.logger_name).log(
+            level, "circuit breaker %s state %s -> %s", self.name, self._state, state
+        )
+        self._state = state
+        if state == CircuitState.OPEN.value:
+            self._opened_at = time.monotonic()
+        elif state == CircuitState.HALF_OPEN.value:
+            self._trial_calls = 0
+            self._trial_successes = 0
+        else:
+            self._window = []
+            self._index = 0
+            self._failures = 0
+
+    def _check_cool_down(self, now: float) -> None:
+        if self._state == CircuitState.OPEN.value and now - self._opened_at >= self.cool_down:
+            self._set_state(CircuitState.HALF_OPEN.value)
+
+    def _check_shared(self, now: float) -> None:
+        if self.shared_client is None or now - self._shared_checked_at < self.shared_check_interval:
+            return
+        self._shared_checked_at = now
+        try:
+            opened = self.shared_client.get(self.shared_key)
+        except Exception:
+            logging.getLogger(self.logger_name).warning(
+                "circuit breaker %s get shared state error", self.name, exc_info=True
+            )
+            return
+        if opened and self._state == CircuitState.CLOSED.value:
+            with self._lock:
+                self._set_state(CircuitState.OPEN.value)
+
+    def _open(self) -> None:
+        # 调用方需持有锁
+        self._set_state(CircuitState.OPEN.value)
+        if self.shared_client is None:
+            return
+        try:
+            self.shared_client.set(self.shared_key, "1", int(max(self.cool_down, 1)))
+        except Exception:
+            logging.getLogger(self.logger_name).warning(
+                "circuit breaker %s set shared state error", self.name, exc_info=True
+            )
+
+    def allow(self) -> bool:
+        """
+        判断是否允许调用
+
+        Returns:
+            是否允许调用
+
+        """
+        now = time.monotonic()
+        self._check_shared(now)
+        with self._lock:
+            self._check_cool_down(now)
+            if self._state == CircuitState.CLOSED.value:
+                return True
+            if self._state == CircuitState.HALF_OPEN.value and self._trial_calls < self.half_open_calls:
+                self._trial_calls += 1
+                return True
+            return False
+
+    def record_success(self) -> None:
+        """
+        记录一次调用成功
+        """
+        with self._lock:
+            if self._state == CircuitState.HALF_OPEN.value:
+                self._trial_successes += 1
+                if self._trial_successes >= self.half_open_calls:
+                    self._set_state(CircuitState.CLOSED.value)
+            elif self._state == CircuitState.CLOSED.value:
+                self._record(False)
+
+    def record_failure(self) -> None:
+        """
+        记录一次调用失败
+        """
+        with self._lock:
+            if self._state == CircuitState.HALF_OPEN.value:
+                self._open()
+            elif self._state == CircuitState.CLOSED.value:
+                self._record(True)
+                total = len(self._window)
+                if total >= self.min_calls and self._failures / total >= self.failure_rate:
+                    self._open()
+
+    def release(self) -> None:
+        """
+        放弃一次已放行的调用，不计入成功或失败，例如调用被取消；半开状态下归还试探调用的名额
+        """
+        with self._lock:
+            if self._state == CircuitState.HALF_OPEN.value and self._trial_calls > 0:
+                self._trial_calls -= 1
+
+    def _record(self, failed: bool) -> None:
+        # 调用方需持有锁
+        if len(self._window) < self.window_size:
+            self._window.append(failed)
+        else:
+            self._failures -= self._window[self._index]
+            self._window[self._index] = failed
+            self._index = (self._index + 1) % self.window_size
+        self._failures += failed
+
+    def stats(self) -> typing.Dict[str, typing.Any]:
+        """
+        获取统计数据
+
+        Returns:
+            状态、窗口内调用数和失败数
+
+        """
+        state = self.state
+        with self._lock:
+            return {"state": state, "calls": len(self._window), "failures": self._failures}
+
+    def reset(self) -> None:
+        """
+        重置为关闭状态
+        """
+        with self._lock:
+            self._set_state(CircuitState.CLOSED.value)
+            self._window = []
+            self._index = 0
+            self._failures = 0
+
+
+_breakers: typing.Dict[str, CircuitBreaker] = {}
+_breakers_lock = threading.Lock()
+
+
+def get_circuit_breaker(name: str, **kwargs: typing.Any) -> CircuitBreaker:
+    """
+    根据名称获取熔断器，不存在时创建
+
+    Args:
+        name: 名称
+        **kwargs: 创建时的参数，同 [CircuitBreaker](./#decorators.breaker.CircuitBreaker)；已存在时忽略
+
+    Returns:
+        熔断器
+
+    """
+    breaker = _breakers.get(name)
+    if breaker is None:
+        with _breakers_lock:
+            breaker = _breakers.get(name)
+            if breaker is None:
+                breaker = _breakers[name] = CircuitBreaker(name, **kwargs)
+    return breaker
+
+
+def circuit_breaker(
+    func: typing.Optional[typing.Callable] = None,
+    name: typing.Optional[str] = None,
+    default: typing.Any = False,
+    is_raise: bool = False,
+    failure_for: typing.Union[typing.Type, typing.Tuple] = Exception,
+    failure_rate: float = 0.5,
+    window_size: int = 20,
+    min_calls: int = 10,
+    cool_down: float = 30,
+    half_open_calls: int = 1,
+    shared_client: typing.Any = None,
+    logger_name: str = "pykit_tools.error",
+    logger_level: int = logging.ERROR,
+) -> typing.Callable:
+    """
+    `装饰器` 熔断器，下游故障时快速失败，避免持续调用及重试放大请求
+
+    熔断器打开时不调用函数，直接返回默认值或者抛出 [CircuitOpenError](./#decorators.breaker.CircuitOpenError)；
+    函数本身的异常会被记录后原样抛出，可以结合 handle_exception 使用：
+
+    ```python
+    @handle_exception(default=None, max_retries=3, retry_for=IOError)
+    @circuit_breaker(name="user-service", is_raise=True)
+    def get_user(user_id):
+        ...
+    ```
+
+    Args:
+        func: 函数，支持 async 函数
+        name: 熔断器名称，相同名称的函数共享熔断状态；默认使用函数路径
+        default: 熔断器打开时返回的默认值，可以是函数
+        is_raise: 熔断器打开时是否抛出 CircuitOpenError，设置True时default参数无效
+        failure_for: 记为失败的异常类/异常元组，其他异常记为成功
+        failure_rate: 失败率阈值，达到该值后打开熔断器
+        window_size: 统计失败率的最近调用次数
+        min_calls: 窗口内最少调用次数，达到后才计算失败率
+        cool_down: 熔断器打开的持续时间，单位秒(s)
+        half_open_calls: 半开状态允许试探调用的次数
+        shared_client: 共享熔断状态的缓存client，例如 `redis_tool.build_redis_client(settings.APP_CACHE_REDIS)`
+        logger_name: 日志名称
+        logger_level: 熔断器打开时日志的级别
+
+    Returns:
+        function
+
+    """
+    if not callable(func):
+        return partial(
+            circuit_breaker,
+            name=name,
+            default=default,
+            is_raise=is_raise,
+            failure_for=failure_for,
+            failure_rate=failure_rate,
+            window_size=window_size,
+            min_calls=min_calls,
+            cool_down=cool_down,
+            half_open_calls=half_open_calls,
+            shared_client=shared_client,
+            logger_name=logger_name,
+            logger_level=logger_level,
+        )
+
+    fn = typing.cast(typing.Callable, func)
+    breaker = get_circuit_breaker(
+        name or get_caller_location(fn),
+        failure_rate=failure_rate,
+        window_size=window_size,
+        min_calls=min_calls,
+        cool_down=cool_down,
+        half_open_calls=half_open_calls,
+        shared_client=shared_client,
+        logger_name=logger_name,
+        logger_level=logger_level,
+    )
+
+    def __reject() -> typing.Any:
+        if is_raise:
+            raise CircuitOpenError(breaker.name)
+        return default() if callable(default) else default
+
+    def __record(e: typing.Optional[BaseException]) -> None:
+        if e is not None and isinstance(e, failure_for):
+            breaker.record_failure()
+        else:
+            breaker.record_success()
+
+    if inspect.iscoroutinefunction(fn):
+
+        @wraps(fn)
+        async def _async_wrapper(*args: typing.Any, **kwargs: typing.Any) -> typing.Any:
+            if not breaker.allow():
+                return __reject()
+            try:
+                result = await fn(*args, **kwargs)
+            except asyncio.CancelledError:
+                # 被取消（包括超时）的调用没有结果，python3.7及以下 CancelledError 继承 Exception
+                breaker.release()
+                raise
+            except Exception as e:
+                __record(e)
+                raise
+            except BaseException:
+                breaker.release()
+                raise
+            __record(None)
+            return result
+
+        _async_wrapper.breaker = breaker  # type: ignore
+        return _async_wrapper
+
+    @wraps(fn)
+    def _wrapper(*args: typing.Any, **kwargs: typing.Any) -> typing.Any:
+        if not breaker.allow():
+            return __reject()
+        try:
+            result = fn(*args, **kwargs)
+        except Exception as e:
+            __record(e)
+            raise
+        except BaseException:
+            breaker.release()
+            raise
+        __record(None)
+        return result
+
+    _wrapper.breaker = breaker  # type: ignore
+    return _wrapper
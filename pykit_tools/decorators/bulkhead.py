@@ -0,0 +1,256 @@
+#!/usr/bin/env python
+# coding=utf-8
+import asyncio
+import inspect
+import typing
+import threading
+import collections
+from functools import wraps, partial
+
+from pykit_tools import fork
+from pykit_tools.utils import get_caller_location
+
+
+class BulkheadFullError(Exception):
+    """
+    舱壁已满（排队已满或者排队超时）时抛出的异常
+    """
+
+    def __init__(self, name: str) -> None:
+        super(BulkheadFullError, self).__init__(f"bulkhead {name} is full")
+        self.name = name
+
+
+class _Waiter(object):
+    """
+    排队等待的调用，释放时直接把执行名额交给队首的调用
+    """
+
+    __slots__ = ("granted", "wake")
+
+    def __init__(self, wake: typing.Callable[[], typing.Any]) -> None:
+        self.granted = False
+        self.wake = wake
+
+
+class Bulkhead(object):
+    """
+    舱壁：限制同时执行的调用数，超出的调用按先后顺序排队等待；线程和 asyncio 的调用共享同一个名额
+    """
+
+    def __init__(
+        self, name: str, max_concurrent: int = 10, max_queue: int = 0, queue_timeout: typing.Optional[float] = None
+    ) -> None:
+        """
+        初始化构造对象
+
+        Args:
+            name: 名称
+            max_concurrent: 最大同时执行的调用数
+            max_queue: 最大排队数，默认0不排队，超过 max_concurrent 的调用直接拒绝
+            queue_timeout: 排队的最长等待时间，单位秒(s)，默认None一直等待
+        """
+        self.name = name
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self._in_flight = 0
+        self._rejected = 0
+        self._waiters: typing.Deque[_Waiter] = collections.deque()
+        self._lock = threading.Lock()
+        fork.register_after_fork(self._after_fork)
+
+    def _after_fork(self) -> None:
+        # 父进程中其他线程的调用不会在子进程中继续执行
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self._waiters = collections.deque()
+
+    def _try_enter(self, wake: typing.Callable[[], typing.Any]) -> typing.Union[bool, _Waiter]:
+        # 调用方需持有锁；返回True可以直接执行，False拒绝，否则返回排队的waiter
+        if self._in_flight < self.max_concurrent and not self._waiters:
+            self._in_flight += 1
+            return True
+        if len(self._waiters) >= self.max_queue:
+            self._rejected += 1
+            return False
+        waiter = _Waiter(wake)
+        self._waiters.append(waiter)
+        return waiter
+
+    def _give_up(self, waiter: _Waiter) -> bool:
+        # 排队超时或者被取消；返回是否已经获得了执行名额
+        with self._lock:
+            if waiter.granted:
+                return True
+            self._waiters.remove(waiter)
+            self._rejected += 1
+            return False
+
+    def acquire(self) -> bool:
+        """
+        获取执行名额，排队时阻塞当前线程
+
+        Returns:
+            是否获取成功
+
+        """
+        event = threading.Event()
+        with self._lock:
+            waiter = self._try_enter(event.set)
+        if isinstance(waiter, bool):
+            return waiter
+        if event.wait(self.queue_timeout):
+            return True
+        return self._give_up(waiter)
+
+    async def acquire_async(self) -> bool:
+        """
+        获取执行名额，排队时不阻塞事件循环
+
+        Returns:
+            是否获取成功
+
+        """
+        loop = asyncio.get_event_loop()
+        future = loop.create_future()
+
+        def __set() -> None:
+            if not future.done():
+                future.set_result(True)
+
+        with self._lock:
+            waiter = self._try_enter(lambda: loop.call_soon_threadsafe(__set))
+        if isinstance(waiter, bool):
+            return waiter
+        try:
+            done, _ = await asyncio.wait({future}, timeout=self.queue_timeout)
+        except asyncio.CancelledError:
+            if self._give_up(waiter):
+                # 已经获得的名额交给下一个调用
+                self.release()
+            raise
+        return bool(done) or self._give_up(waiter)
+
+    def release(self) -> None:
+        """
+        释放执行名额，有排队的调用时直接交给队首的调用
+        """
+        with self._lock:
+            if not self._waiters:
+                self._in_flight -= 1
+                return
+            waiter = self._waiters.popleft()
+            waiter.granted = True
+        waiter.wake()
+
+    def stats(self) -> typing.Dict[str, typing.Any]:
+        """
+        获取统计数据
+
+        Returns:
+            正在执行的调用数 in_flight，排队数 queued，被拒绝的调用数 rejected
+
+        """
+        with self._lock:
+            return {"in_flight": self._in_flight, "queued": len(self._waiters), "rejected": self._rejected}
+
+
+_bulkheads: typing.Dict[str, Bulkhead] = {}
+_bulkheads_lock = threading.Lock()
+
+
+def get_bulkhead(name: str, **kwargs: typing.Any) -> Bulkhead:
+    """
+    根据名称获取舱壁，不存在时创建
+
+    Args:
+        name: 名称
+        **kwargs: 创建时的参数，同 [Bulkhead](./#decorators.bulkhead.Bulkhead)；已存在时忽略
+
+    Returns:
+        舱壁
+
+    """
+    bulkhead_ = _bulkheads.get(name)
+    if bulkhead_ is None:
+        with _bulkheads_lock:
+            bulkhead_ = _bulkheads.get(name)
+            if bulkhead_ is None:
+                bulkhead_ = _bulkheads[name] = Bulkhead(name, **kwargs)
+    return bulkhead_
+
+
+def bulkhead(
+    func: typing.Optional[typing.Callable] = None,
+    name: typing.Optional[str] = None,
+    max_concurrent: int = 10,
+    max_queue: int = 0,
+    queue_timeout: typing.Optional[float] = None,
+    default: typing.Any = False,
+    is_raise: bool = False,
+) -> typing.Callable:
+    """
+    `装饰器` 舱壁隔离，限制函数（或同一组函数）同时执行的调用数，避免一个慢依赖占满所有工作线程
+
+    装饰后的函数可通过 `bulkhead.stats()` 获取正在执行、排队及被拒绝的调用数
+
+    Args:
+        func: 函数，支持 async 函数
+        name: 名称，相同名称的函数共享名额；默认使用函数路径
+        max_concurrent: 最大同时执行的调用数
+        max_queue: 最大排队数，默认0不排队
+        queue_timeout: 排队的最长等待时间，单位秒(s)，默认None一直等待
+        default: 被拒绝时返回的默认值，可以是函数
+        is_raise: 被拒绝时是否抛出 [BulkheadFullError](./#decorators.bulkhead.BulkheadFullError)，设置True时default参数无效
+
+    Returns:
+        function
+
+    """
+    if not callable(func):
+        return partial(
+            bulkhead,
+            name=name,
+            max_concurrent=max_concurrent,
+            max_queue=max_queue,
+            queue_timeout=queue_timeout,
+            default=default,
+            is_raise=is_raise,
+        )
+
+    fn = typing.cast(typing.Callable, func)
+    _bulkhead = get_bulkhead(
+        name or get_caller_location(fn), max_concurrent=max_concurrent, max_queue=max_queue, queue_timeout=queue_timeout
+    )
+
+    def __reject() -> typing.Any:
+        if is_raise:
+            raise BulkheadFullError(_bulkhead.name)
+        return default() if callable(default) else default
+
+    if inspect.iscoroutinefunction(fn):
+
+        @wraps(fn)
+        async def _async_wrapper(*args: typing.Any, **kwargs: typing.Any) -> typing.Any:
+            if not await _bulkhead.acquire_async():
+                return __reject()
+            try:
+                return await fn(*args, **kwargs)
+            finally:
+                _bulkhead.release()
+
+        _async_wrapper.bulkhead = _bulkhead  # type: ignore
+        return _async_wrapper
+
+    @wraps(fn)
+    def _wrapper(*args: typing.Any, **kwargs: typing.Any) -> typing.Any:
+        if not _bulkhead.acquire():
+            return __reject()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            _bulkhead.release()
+
+    _wrapper.bulkhead = _bulkhead  # type: ignore
+    return _wrapper
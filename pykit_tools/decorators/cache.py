@@ -1,14 +1,20 @@
 #!/usr/bin/env python
 # coding=utf-8
 import json
+import time
+import zlib
+import types
 import inspect
+import weakref
+import threading
+import collections
 import logging
 import typing
 from functools import wraps, partial
 from py_enum import ChoiceEnum
 
 import pykit_tools
-from pykit_tools import str_tool, utils
+from pykit_tools import str_tool, utils, redis_tool, fork
 
 
 _g_cache_client: typing.Any = None
@@ -40,6 +46,143 @@ def get_global_cache_client() -> typing.Any:
     return _g_cache_client
 
 
+# 分块存储时manifest数据的前缀，json序列化的字符串不会以控制字符开头，不会与普通数据混淆
+_CHUNK_MANIFEST_PREFIX = "\x00chunked:"
+
+
+def _estimate_json_length(value: typing.Any, limit: int, max_nodes: int = 1000) -> int:
+    """
+    估算json序列化后长度的下限，用于在序列化前快速拒绝明显超长的数据
+
+    最多遍历 max_nodes 个节点，或者估算值超过 limit 后提前结束，结果一定不大于真实长度
+    """
+    total = 0
+    stack = [value]
+    nodes = 0
+    while stack and nodes < max_nodes and total <= limit:
+        nodes += 1
+        v = stack.pop()
+        if isinstance(v, str):
+            total += len(v) + 2
+        elif isinstance(v, dict):
+            # 括号、冒号、逗号
+            total += 2 + len(v) * 2 - 1 if v else 2
+            for k, item in v.items():
+                total += len(k) + 2 if isinstance(k, str) else 1
+                stack.append(item)
+        elif isinstance(v, (list, tuple)):
+            total += 2 + len(v) - 1 if v else 2
+            stack.extend(v)
+        else:
+            # 数字、true/false/null 至少1个字符
+            total += 1
+    return total
+
+
+def _bulk_get(client: typing.Any, keys: typing.List[str]) -> typing.List:
+    if hasattr(client, "get_many"):
+        return client.get_many(keys)
+    if hasattr(client, "pipeline"):
+        pipe = client.pipeline(transaction=False)
+        for k in keys:
+            pipe.get(k)
+        return pipe.execute()
+    return [client.get(k) for k in keys]
+
+
+def _bulk_set(client: typing.Any, mapping: typing.Dict[str, str], timeout: int) -> None:
+    if hasattr(client, "set_many"):
+        client.set_many(mapping, timeout)
+    elif hasattr(client, "pipeline"):
+        pipe = client.pipeline(transaction=False)
+        for k, v in mapping.items():
+            pipe.set(k, v, timeout)
+        pipe.execute()
+    else:
+        for k, v in mapping.items():
+            client.set(k, v, timeout)
+
+
+def _allow_value_cache(value: typing.Any, cannot_cache: typing.Any) -> bool:
+    if not cannot_cache:
+        # 没设置任何不允许缓存
+        return True
+    elif callable(cannot_cache):
+        v = cannot_cache(value)
+        return not v
+    elif isinstance(cannot_cache, (tuple, list)):
+        # 不在 不允许缓存列表中
+        return value not in cannot_cache
+    else:
+        raise TypeError("The 'cannot_cache' value format does not meet the requirements")
+
+
+class DecodeMemoMode(ChoiceEnum):
+    """
+    `枚举` 缓存数据解码结果复用的模式，定义值详见源码。
+
+    应用于装饰器 [method_deco_cache](./#decorators.cache.method_deco_cache) 的参数 decode_memo_mode
+    """
+
+    SHARED = ("shared", "直接返回同一个对象，调用方不能修改返回结果")
+    COPY = ("copy", "返回复制的对象，调用方可以修改返回结果")
+    READONLY = ("readonly", "返回只读对象，dict转为只读的MappingProxyType，list转为tuple")
+
+
+def _json_copy(value: typing.Any) -> typing.Any:
+    # json解码后只有dict/list是可变对象，比 copy.deepcopy 更快
+    if isinstance(value, dict):
+        return {k: _json_copy(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [_json_copy(v) for v in value]
+    return value
+
+
+def _json_freeze(value: typing.Any) -> typing.Any:
+    if isinstance(value, dict):
+        return types.MappingProxyType({k: _json_freeze(v) for k, v in value.items()})
+    if isinstance(value, list):
+        return tuple(_json_freeze(v) for v in value)
+    return value
+
+
+class _DecodeMemo(object):
+    """
+    缓存json字符串解码后的对象，相同的缓存字符串不再重复执行 json.loads
+
+    使用原始字符串作为key：查找时先比较长度和哈希值，命中后再比较内容，不会因哈希冲突返回错误的数据
+    """
+
+    def __init__(self, size: int, mode: str) -> None:
+        if mode not in DecodeMemoMode:
+            raise TypeError(f"decode_memo_mode={mode} not supported")
+        self.size = size
+        self.mode = mode
+        self._data: collections.OrderedDict = collections.OrderedDict()
+        self._lock = threading.Lock()
+        fork.register_after_fork(self._after_fork)
+
+    def _after_fork(self) -> None:
+        self._lock = threading.Lock()
+
+    def loads(self, value: str) -> typing.Any:
+        with self._lock:
+            data = self._data.get(value, self)
+            if data is not self:
+                self._data.move_to_end(value)
+        if data is self:
+            data = json.loads(value)
+            if self.mode == DecodeMemoMode.READONLY.value:
+                data = _json_freeze(data)
+            with self._lock:
+                self._data[value] = data
+                if len(self._data) > self.size:
+                    self._data.popitem(last=False)
+        if self.mode == DecodeMemoMode.COPY.value:
+            return _json_copy(data)
+        return data
+
+
 class CacheScene(ChoiceEnum):
     """
     `枚举` 缓存场景类型，定义值详见源码。
@@ -60,13 +203,17 @@ def method_deco_cache(
     cannot_cache: typing.Union[typing.List, typing.Tuple] = (None, False),
     cache_client: typing.Any = None,
     cache_max_length: int = 33554432,
+    cache_chunk_size: int = 0,
+    decode_memo_size: int = 0,
+    decode_memo_mode: str = DecodeMemoMode.SHARED.value,
     logger_name: str = "pykit_tools.error",
     logger_level: int = logging.ERROR,
 ) -> typing.Callable:
     """
     `装饰器` 方法缓存结果, 只能缓存json序列化的数据类型
 
-    注意：若是在类的实例方法上使用，需要注意 self 参数的影响，可设置key或者将类单例后使用
+    注意：若是在类的实例方法上使用，需要注意 self 参数的影响，可设置key或者将类单例后使用，
+    也可以使用 [instance_method_cache](./#decorators.cache.instance_method_cache)
 
     Args:
         func: 可以在放在参数添加 scene=CacheScene.DEGRADED.value,可以强制进行刷新
@@ -81,6 +228,15 @@ def method_deco_cache(
         cache_max_length: 序列化后缓存的字符串最大长度限制，
             此处设置最大缓存 32M = 32 * 1024 * 1024
             若是redis, A String value can be at max 512 Megabytes in length.
+            序列化前会先估算长度，明显超长的数据不会执行序列化；
+            开启分块存储时限制的是单个块的长度，序列化后的总长度不限制
+        cache_chunk_size: 分块存储的块大小，默认0不分块，不能超过 cache_max_length；
+            序列化后长度超过该值时，数据拆分成多个块存储在 `{key}:chunk:{i}` 中，key中存储块数量和校验值，
+            读写时使用批量操作(pipeline)，读取时校验失败视为无缓存；超过 cache_max_length 的数据也可以缓存
+        decode_memo_size: 复用解码结果的最大数量，默认0不开启；
+            开启后读取到相同的缓存字符串时直接返回之前 json.loads 的结果，适用于读多且数据较大的场景
+        decode_memo_mode: 复用解码结果的模式 [DecodeMemoMode](./#decorators.cache.DecodeMemoMode)，
+            默认 shared 返回同一个对象，调用方不能修改返回结果
         logger_name: 日志名称
         logger_level: 异常时设置日志的级别
     Returns:
@@ -97,22 +253,27 @@ def method_deco_cache(
             cannot_cache=cannot_cache,
             cache_client=cache_client,
             cache_max_length=cache_max_length,
+            cache_chunk_size=cache_chunk_size,
+            decode_memo_size=decode_memo_size,
+            decode_memo_mode=decode_memo_mode,
             logger_name=logger_name,
             logger_level=logger_level,
         )
 
+    if cache_chunk_size > cache_max_length:
+        raise ValueError(f"cache_chunk_size={cache_chunk_size} must not exceed cache_max_length={cache_max_length}")
+
     fn = typing.cast(typing.Callable, func)
     _location = utils.get_caller_location(fn)
 
     _redis_conf = pykit_tools.settings.APP_CACHE_REDIS
     if _redis_conf:
-        import redis  # type: ignore
-
-        __pool = redis.ConnectionPool(encoding="utf-8", decode_responses=True, **_redis_conf)
-        _inner_client = redis.StrictRedis(connection_pool=__pool)
+        _inner_client = redis_tool.build_redis_client(_redis_conf)
     else:
         _inner_client = utils.CacheMap()
 
+    _memo = _DecodeMemo(decode_memo_size, decode_memo_mode) if decode_memo_size > 0 else None
+
     def __get_cache_client() -> typing.Any:
         if cache_client:
             _client = cache_client
@@ -122,12 +283,38 @@ def method_deco_cache(
             _client = _inner_client
         return _client
 
+    def __load_chunks(_client: typing.Any, _key: str, manifest: str) -> typing.Optional[str]:
+        count, checksum = manifest.rsplit(":", 2)[1:]
+        chunks = _bulk_get(_client, [f"{_key}:chunk:{i}" for i in range(int(count))])
+        if any(c is None for c in chunks):
+            # 部分块已过期或被淘汰
+            return None
+        value = "".join(chunks)
+        if zlib.crc32(value.encode("utf-8")) != int(checksum):
+            logging.getLogger(logger_name).log(logger_level, f"{_location} cache chunks checksum error key=%s", _key)
+            return None
+        return value
+
+    def __save_cache_data(_client: typing.Any, _key: str, value: str) -> None:
+        if not cache_chunk_size or len(value) <= cache_chunk_size:
+            _client.set(_key, value, timeout)
+            return
+        chunks = {}
+        for i, start in enumerate(range(0, len(value), cache_chunk_size)):
+            end = start + cache_chunk_size
+            chunks[f"{_key}:chunk:{i}"] = value[start:end]
+        # 先写入所有块，再写入manifest，避免读取到不完整的数据
+        _bulk_set(_client, chunks, timeout)
+        _client.set(_key, f"{_CHUNK_MANIFEST_PREFIX}{len(chunks)}:{zlib.crc32(value.encode('utf-8'))}", timeout)
+
     def __load_cache_data(_client: typing.Any, _key: str) -> typing.Tuple[bool, typing.Any]:
         has_cache, data = False, None
         try:
             value = _client.get(_key)
+            if cache_chunk_size and isinstance(value, str) and value.startswith(_CHUNK_MANIFEST_PREFIX):
+                value = __load_chunks(_client, _key, value)
             if value is not None:
-                data = json.loads(value)
+                data = _memo.loads(value) if _memo else json.loads(value)
                 has_cache = True
         except Exception:
             logging.getLogger(logger_name).log(
@@ -135,19 +322,6 @@ def method_deco_cache(
             )
         return has_cache, data
 
-    def __allow_value_cache(value: typing.Any) -> bool:
-        if not cannot_cache:
-            # 没设置任何不允许缓存
-            return True
-        elif callable(cannot_cache):
-            v = cannot_cache(value)
-            return not v
-        elif isinstance(cannot_cache, (tuple, list)):
-            # 不在 不允许缓存列表中
-            return value not in cannot_cache
-        else:
-            raise TypeError("The 'cannot_cache' value format does not meet the requirements")
-
     @wraps(fn)
     def _wrapper(*args: typing.Any, **kwargs: typing.Any) -> typing.Any:
         # 内置参数，force缓存
@@ -165,7 +339,7 @@ def method_deco_cache(
         if _scene in (CacheScene.DEFAULT.value,):
             # 直接从缓存里获取结果
             has_cache, data = __load_cache_data(_client, _key)
-            if has_cache and __allow_value_cache(data):
+            if has_cache and _allow_value_cache(data, cannot_cache):
                 # 直接返回缓存结果
                 return data
 
@@ -175,23 +349,29 @@ def method_deco_cache(
             if _scene == CacheScene.DEGRADED.value:
                 # 降级处理
                 has_cache, data = __load_cache_data(_client, _key)
-                if has_cache and __allow_value_cache(data):
+                if has_cache and _allow_value_cache(data, cannot_cache):
                     return data
             raise
 
-        if not __allow_value_cache(ret):
+        if not _allow_value_cache(ret, cannot_cache):
             # 不需要缓存，直接返回
             return ret
 
         # 处理缓存，不影响函数结果返回
         try:
-            _cache_str = json.dumps(ret, separators=(",", ":"))
-            if len(_cache_str) > cache_max_length:
+            if cache_chunk_size:
+                # 分块存储时每个块都不超过 cache_max_length
+                _cache_str = json.dumps(ret, separators=(",", ":"))
+            elif _estimate_json_length(ret, cache_max_length) > cache_max_length:
+                _cache_str = None
+            else:
+                _cache_str = json.dumps(ret, separators=(",", ":"))
+            if _cache_str is None or (not cache_chunk_size and len(_cache_str) > cache_max_length):
                 logging.getLogger(logger_name).log(
                     logger_level, f"{_location} Cache too long, key=%s limit is %s", _key, cache_max_length
                 )
             else:
-                _client.set(_key, _cache_str, timeout)
+                __save_cache_data(_client, _key, _cache_str)
         except Exception:
             logging.getLogger(logger_name).log(
                 logger_level, f"{_location} set cache_data error key=%s ret=%s", _key, ret, exc_info=True
@@ -202,43 +382,255 @@ def method_deco_cache(
     return _wrapper
 
 
-def singleton_refresh_regular(cls: typing.Optional[typing.Type] = None, timeout: int = 5) -> typing.Callable:
+def instance_method_cache(
+    func: typing.Optional[typing.Callable] = None,
+    identity: typing.Union[str, typing.Callable] = "cache_key",
+    timeout: int = 60,
+    weak_local: bool = False,
+    cannot_cache: typing.Union[typing.List, typing.Tuple] = (None, False),
+    cache_client: typing.Any = None,
+    logger_name: str = "pykit_tools.error",
+    logger_level: int = logging.ERROR,
+) -> typing.Callable:
+    """
+    `装饰器` 实例方法缓存结果，使用实例声明的稳定标识构造缓存key，而不是 str(self)
+
+    示例：
+    ```python
+    class Tenant(object):
+        def __init__(self, tenant_id):
+            self.cache_key = tenant_id
+
+        @instance_method_cache(timeout=300)
+        def get_config(self, name):
+            ...
+    ```
+
+    Args:
+        func: 实例方法
+        identity: 实例的唯一标识，默认读取实例属性 cache_key（若是方法则调用获取）；
+            也可以传递函数，根据实例返回唯一标识
+        timeout: 缓存超时时间，单位 秒(s)
+        weak_local: 是否使用实例级别的本地缓存，默认False同 method_deco_cache 使用全局的缓存client；
+            设置为True时每个实例的缓存保存在 WeakKeyDictionary 中，实例被回收后缓存数据随之释放，
+            不需要json序列化，此时不使用 identity 和 cache_client
+        cannot_cache: 不允许缓存的数值，同 method_deco_cache
+        cache_client: 缓存client对象，同 method_deco_cache
+        logger_name: 日志名称
+        logger_level: 异常时设置日志的级别
+
+    Returns:
+        function
+
+    """
+    if not callable(func):
+        return partial(
+            instance_method_cache,
+            identity=identity,
+            timeout=timeout,
+            weak_local=weak_local,
+            cannot_cache=cannot_cache,
+            cache_client=cache_client,
+            logger_name=logger_name,
+            logger_level=logger_level,
+        )
+
+    fn = typing.cast(typing.Callable, func)
+    _location = utils.get_caller_location(fn)
+
+    if weak_local:
+        _local_caches: weakref.WeakKeyDictionary = weakref.WeakKeyDictionary()
+
+        @wraps(fn)
+        def _local_wrapper(self: typing.Any, *args: typing.Any, **kwargs: typing.Any) -> typing.Any:
+            cache_map = _local_caches.get(self)
+            if cache_map is None:
+                cache_map = _local_caches.setdefault(self, utils.CacheMap())
+            _key = str_tool.compute_md5(*args, **kwargs) if args or kwargs else "-"
+            value = cache_map.get(_key)
+            if value is not None and _allow_value_cache(value, cannot_cache):
+                return value
+            value = fn(self, *args, **kwargs)
+            if _allow_value_cache(value, cannot_cache):
+                cache_map.set(_key, value, timeout)
+            return value
+
+        return _local_wrapper
+
+    def _get_identity(self: typing.Any) -> typing.Any:
+        if callable(identity):
+            return identity(self)
+        value = getattr(self, identity, None)
+        if value is None:
+            raise TypeError(f"{type(self).__name__} has no cache identity attribute '{identity}'")
+        return value() if callable(value) else value
+
+    def _make_key(self: typing.Any, *args: typing.Any, **kwargs: typing.Any) -> str:
+        return f"method:{fn.__name__}:{str_tool.compute_md5(_location, _get_identity(self), *args, **kwargs)}"
+
+    return method_deco_cache(
+        fn,
+        key=_make_key,
+        timeout=timeout,
+        cannot_cache=cannot_cache,
+        cache_client=cache_client,
+        logger_name=logger_name,
+        logger_level=logger_level,
+    )
+
+
+def singleton_refresh_regular(
+    cls: typing.Optional[typing.Type] = None,
+    timeout: int = 5,
+    refresh_ahead: float = 0,
+    close_delay: typing.Optional[float] = None,
+    fork_policy: str = fork.ForkPolicy.KEEP.value,
+    logger_name: str = "pykit_tools.error",
+    logger_level: int = logging.ERROR,
+) -> typing.Callable:
     """
     `装饰器` 带定时刷新的单例装饰器
 
     应用场景：例如某对象实例化后带有session相关信息，有一定有效期的情况可以在类上加上该装饰器
 
+    同一组参数并发调用时最多只会有一个线程在构建实例，其他线程等待构建完成后使用同一个实例；
+    过期的实例在之后构建实例时清理（每 timeout 秒最多一次），可通过被装饰类的 `singleton_stats()` 获取实例数和正在构建的数量
+
     Args:
         cls: 类
         timeout: 单例使用超时时间，单位秒(s)
+        refresh_ahead: 提前刷新时间，单位秒(s)，默认0不开启；
+            开启后在实例过期前 refresh_ahead 秒内被调用时，由一个后台线程构建新实例并替换，调用方继续使用旧实例，
+            不需要等待实例构建；后台构建失败时会记录日志，实例过期后由调用方重新构建
+        close_delay: 实例被替换或过期清理后，延迟多少秒调用旧实例的 close() 方法（若有），默认None不调用；
+            只是固定的延迟，不会跟踪旧实例是否仍在使用，需要大于调用方使用一次实例的最长耗时
+        fork_policy: fork后子进程中对已构建实例的处理策略 [ForkPolicy](./#fork.ForkPolicy)，默认继续使用
+        logger_name: 日志名称
+        logger_level: 异常时设置日志的级别
 
     Returns:
         function
 
     示例：
     ```python
-    @singleton_refresh_regular
-    class YouClass(Singleton):
+    @singleton_refresh_regular(timeout=3600, refresh_ahead=60, close_delay=10)
+    class YouClass(object):
         pass
     ```
     """
     if cls is None:
-        return partial(singleton_refresh_regular, timeout=timeout)
+        return partial(
+            singleton_refresh_regular,
+            timeout=timeout,
+            refresh_ahead=refresh_ahead,
+            close_delay=close_delay,
+            fork_policy=fork_policy,
+            logger_name=logger_name,
+            logger_level=logger_level,
+        )
 
     if not inspect.isclass(cls):
         raise TypeError(f"this decorator can only be applied to classes, not {type(cls)}")
+    if fork_policy not in fork.ForkPolicy:
+        raise TypeError(f"fork_policy={fork_policy} not supported")
 
     _cls = typing.cast(typing.Type, cls)
+    _location = utils.get_caller_location(_cls)
+
+    # 实例数据, eg: { key: (expire_at, instance) }
+    _entries: typing.Dict[str, typing.Tuple[float, typing.Any]] = {}
+    _lock = threading.Lock()
+    # 构建实例的锁，保证同一个key最多只有一个线程在构建
+    _key_locks: typing.Dict[str, threading.Lock] = {}
+    # 正在后台刷新的key
+    _refreshing: typing.Set[str] = set()
+    # 下一次清理过期实例的时间
+    _next_sweep = time.time() + timeout
+
+    def __after_fork() -> None:
+        nonlocal _lock, _key_locks
+        # 后台刷新线程不会在子进程中存在，其他线程可能持有锁
+        _lock = threading.Lock()
+        _key_locks = {}
+        _refreshing.clear()
+        if fork_policy == fork.ForkPolicy.DROP.value:
+            _entries.clear()
+
+    fork.register_after_fork(__after_fork)
+
+    def __close(ins: typing.Any) -> None:
+        try:
+            ins.close()
+        except Exception:
+            logging.getLogger(logger_name).log(logger_level, f"{_location} close instance error", exc_info=True)
+
+    def __close_later(ins: typing.Any) -> None:
+        if close_delay is not None and callable(getattr(ins, "close", None)):
+            timer = threading.Timer(close_delay, __close, args=(ins,))
+            timer.daemon = True
+            timer.start()
+
+    def __sweep(now: float) -> None:
+        nonlocal _next_sweep
+        with _lock:
+            if now < _next_sweep:
+                return
+            _next_sweep = now + timeout
+            expired = [k for k, entry in list(_entries.items()) if entry[0] <= now and k not in _key_locks]
+            removed = [_entries.pop(k) for k in expired]
+        for _, ins in removed:
+            __close_later(ins)
+
+    def __build(_key: str, args: typing.Tuple, kwargs: typing.Dict) -> typing.Any:
+        with _lock:
+            key_lock = _key_locks.setdefault(_key, threading.Lock())
+        try:
+            with key_lock:
+                entry = _entries.get(_key)
+                if entry is not None and entry[0] - time.time() > refresh_ahead:
+                    # 其他线程已构建了新的实例
+                    return entry[1]
+                ins = _cls(*args, **kwargs)
+                _entries[_key] = (time.time() + timeout, ins)
+        finally:
+            # 实例已写入（或构建失败），等待中的线程会读取到实例，移除该key的锁
+            with _lock:
+                if _key_locks.get(_key) is key_lock:
+                    del _key_locks[_key]
+        if entry is not None:
+            __close_later(entry[1])
+        __sweep(time.time())
+        return ins
 
-    cache_map = utils.CacheMap()
+    def __refresh(_key: str, args: typing.Tuple, kwargs: typing.Dict) -> None:
+        try:
+            __build(_key, args, kwargs)
+        except Exception:
+            logging.getLogger(logger_name).log(
+                logger_level, f"{_location} refresh instance error key=%s", _key, exc_info=True
+            )
+        finally:
+            with _lock:
+                _refreshing.discard(_key)
 
     @wraps(_cls)
     def _wrapper(*args: typing.Any, **kwargs: typing.Any) -> typing.Any:
-        _key = str_tool.compute_md5(utils.get_caller_location(_cls), *args, **kwargs)
-        ins = cache_map.get(_key)
-        if ins is None:
-            ins = _cls(*args, **kwargs)
-            cache_map.set(_key, ins, timeout=timeout)
-        return ins
-
+        _key = str_tool.compute_md5(_location, *args, **kwargs)
+        entry = _entries.get(_key)
+        now = time.time()
+        if entry is None or entry[0] <= now:
+            return __build(_key, args, kwargs)
+
+        if refresh_ahead > 0 and entry[0] - now <= refresh_ahead:
+            with _lock:
+                if _key in _refreshing:
+                    return entry[1]
+                _refreshing.add(_key)
+            threading.Thread(target=__refresh, args=(_key, args, kwargs), daemon=True).start()
+        return entry[1]
+
+    def __stats() -> typing.Dict[str, int]:
+        return {"instances": len(_entries), "building": len(_key_locks)}
+
+    _wrapper.singleton_stats = __stats  # type: ignore
     return _wrapper
@@ -1,23 +1,172 @@
 #!/usr/bin/env python
 # coding=utf-8
 import time
+import signal
 import random
+import asyncio
+import inspect
+import itertools
+import fractions
+import concurrent.futures
 import logging
+import queue
 import typing
+import threading
 from functools import wraps, partial
+from py_enum import ChoiceEnum
 
+from pykit_tools import fork, histogram, tracing, profiling, usage
+from pykit_tools.log import suppress
 from pykit_tools.utils import get_caller_location
 
 
+class RetryBackoff(ChoiceEnum):
+    """
+    `枚举` 重试等待时间的退避策略，定义值详见源码。
+
+    应用于装饰器 [handle_exception](./#decorators.common.handle_exception)
+    """
+
+    CONSTANT = ("constant", "固定等待 retry_delay")
+    EXPONENTIAL = ("exponential", "指数退避，第n次重试等待 retry_delay * 2^(n-1)")
+    # 参考 https://aws.amazon.com/blogs/architecture/exponential-backoff-and-jitter/
+    DECORRELATED = ("decorrelated", "去相关抖动，等待时间在 [retry_delay, 上次等待时间*3] 之间随机")
+
+
+def _compute_delay(
+    backoff: str, count: int, prev_delay: float, retry_delay: float, max_delay: typing.Optional[float], jitter: bool
+) -> float:
+    """
+    计算第count次失败后的重试等待时间
+    """
+    if backoff == RetryBackoff.DECORRELATED.value:
+        delay = random.uniform(retry_delay, max(prev_delay, retry_delay) * 3)
+        jitter = False
+    elif backoff == RetryBackoff.EXPONENTIAL.value:
+        delay = retry_delay * 2 ** (count - 1)
+    else:
+        delay = retry_delay
+    if max_delay is not None:
+        delay = min(delay, max_delay)
+    if jitter:
+        delay = random.randint(0, 100) * delay / 100.0
+    return delay
+
+
+class RetryBudget(object):
+    """
+    重试预算：令牌桶，每次成功调用存入 ratio 个令牌，每次重试消耗1个令牌，令牌不足时不再重试；
+    使重试次数不超过成功调用次数的固定比例，避免下游故障时重试放大请求（重试风暴）
+
+    同一个下游依赖使用同一个名称，通过 [get_retry_budget](./#decorators.common.get_retry_budget) 获取
+    """
+
+    def __init__(self, name: str, ratio: float = 0.1, max_tokens: float = 10) -> None:
+        """
+        初始化构造对象
+
+        Args:
+            name: 名称，一般为下游依赖的名称
+            ratio: 每次成功调用存入的令牌数，即允许重试的比例，eg: 0.1 表示重试次数不超过成功调用次数的10%
+            max_tokens: 令牌桶容量，也是初始令牌数，允许少量调用后即可重试
+        """
+        self.name = name
+        self.ratio = ratio
+        self.max_tokens = max_tokens
+        self._tokens = float(max_tokens)
+        self._deposits = 0
+        self._withdrawals = 0
+        self._rejections = 0
+        self._lock = threading.Lock()
+        fork.register_after_fork(self._after_fork)
+
+    def _after_fork(self) -> None:
+        self._lock = threading.Lock()
+
+    def deposit(self) -> None:
+        """
+        记录一次成功调用，存入 ratio 个令牌
+        """
+        with self._lock:
+            self._deposits += 1
+            self._tokens = min(self.max_tokens, self._tokens + self.ratio)
+
+    def withdraw(self) -> bool:
+        """
+        申请一次重试，消耗1个令牌
+
+        Returns:
+            是否允许重试
+
+        """
+        with self._lock:
+            if self._tokens < 1:
+                self._rejections += 1
+                return False
+            self._tokens -= 1
+            self._withdrawals += 1
+            return True
+
+    def stats(self) -> typing.Dict[str, typing.Any]:
+        """
+        获取统计数据
+
+        Returns:
+            当前令牌数 tokens，成功调用次数 deposits，允许的重试次数 withdrawals，预算不足被跳过的重试次数 rejections
+
+        """
+        with self._lock:
+            return {
+                "name": self.name,
+                "tokens": self._tokens,
+                "deposits": self._deposits,
+                "withdrawals": self._withdrawals,
+                "rejections": self._rejections,
+            }
+
+
+_retry_budgets: typing.Dict[str, RetryBudget] = {}
+_retry_budgets_lock = threading.Lock()
+
+
+def get_retry_budget(name: str, **kwargs: typing.Any) -> RetryBudget:
+    """
+    根据名称获取重试预算，不存在时创建
+
+    Args:
+        name: 名称
+        **kwargs: 创建时的参数，同 [RetryBudget](./#decorators.common.RetryBudget)；已存在时忽略
+
+    Returns:
+        重试预算
+
+    """
+    budget = _retry_budgets.get(name)
+    if budget is None:
+        with _retry_budgets_lock:
+            budget = _retry_budgets.get(name)
+            if budget is None:
+                budget = _retry_budgets[name] = RetryBudget(name, **kwargs)
+    return budget
+
+
 def handle_exception(
     func: typing.Optional[typing.Callable] = None,
     default: typing.Any = False,
     is_raise: bool = False,
     retry_for: typing.Union[typing.Type, typing.Tuple] = Exception,
     max_retries: int = 1,
-    retry_delay: int = 0,
+    retry_delay: float = 0,
     retry_jitter: bool = True,
+    retry_backoff: str = RetryBackoff.CONSTANT.value,
+    retry_max_delay: typing.Optional[float] = None,
+    retry_if_result: typing.Optional[typing.Callable] = None,
+    deadline: typing.Optional[float] = None,
+    retry_budget: typing.Union[str, RetryBudget, None] = None,
     log_args: bool = True,
+    log_args_max_bytes: int = 1024,
+    log_compact_retries: bool = True,
+    log_dedup_window: float = 0,
     logger_name: str = "pykit_tools.error",
     logger_level: int = logging.ERROR,
     logger_pre_level: int = logging.WARNING,
@@ -25,16 +174,28 @@ def handle_exception(
     """
     `装饰器` 用于捕获函数异常，并在出现异常的时候返回默认值
 
+    支持 async 函数：await 函数的执行结果，重试时使用 `asyncio.sleep` 等待；任务被取消时直接抛出 `CancelledError`
+
     Args:
         func: 函数
         default: 出现异常后的默认值
         is_raise: 是否抛出异常；设置True时，default参数无效且一定会抛出异常，主要用于重试场景最后依然抛出异常
         retry_for: 需要重试的异常类/异常元组，仅当异常匹配才进行重试
         max_retries: 最大重试次数
-        retry_delay: 重试等待时间，默认值0（不推荐开启）
+        retry_delay: 重试等待时间，单位秒(s)，支持小数，默认值0（不推荐开启）
         retry_jitter: 重试抖动，用于将随机性引入指数退避延迟，以防止队列中的所有任务同时执行；
-                若设置为true, 随机范围值在[0, retry_delay]之间，随机值为真实delay时间
+                若设置为true, 随机范围值在[0, delay]之间，随机值为真实delay时间
+        retry_backoff: 重试等待时间的退避策略 [RetryBackoff](./#decorators.common.RetryBackoff)，默认固定等待
+        retry_max_delay: 单次重试的最大等待时间，单位秒(s)，默认None不限制
+        retry_if_result: 根据返回值判断是否需要重试的函数，返回True时重试；重试次数用完后返回最后一次的结果
+        deadline: 总耗时限制，单位秒(s)，默认None不限制；若已耗时加上下次等待时间超过该值，则不再重试
+        retry_budget: 重试预算 [RetryBudget](./#decorators.common.RetryBudget) 或者其名称，默认None不限制；
+                同一个下游依赖共享预算，预算不足时不再重试，直接返回默认值或抛出异常
         log_args: 异常时将参数输出到日志
+        log_args_max_bytes: 参数输出到日志的最大字节数，超过时截断，小于等于0时不限制
+        log_compact_retries: 还会重试的异常只输出一行（异常类型和信息），不输出异常堆栈和参数
+        log_dedup_window: 异常日志去重的时间窗口，单位秒(s)，默认0不去重；
+                相同特征（异常类型和代码位置）的异常在窗口内只输出一次，窗口结束时输出被忽略的数量 suppressed
         logger_name: 日志名称，仅记录异常时使用
         logger_level: 异常时设置日志的级别
         logger_pre_level: 重试最后一次之前的日志级别，避免多次重试会有多次错误输出
@@ -52,66 +213,158 @@ def handle_exception(
             max_retries=max_retries,
             retry_delay=retry_delay,
             retry_jitter=retry_jitter,
+            retry_backoff=retry_backoff,
+            retry_max_delay=retry_max_delay,
+            retry_if_result=retry_if_result,
+            deadline=deadline,
+            retry_budget=retry_budget,
             log_args=log_args,
+            log_args_max_bytes=log_args_max_bytes,
+            log_compact_retries=log_compact_retries,
+            log_dedup_window=log_dedup_window,
             logger_name=logger_name,
             logger_level=logger_level,
             logger_pre_level=logger_pre_level,
         )
 
+    if retry_backoff not in RetryBackoff:
+        raise TypeError(f"retry_backoff={retry_backoff} not supported")
+
     fn = typing.cast(typing.Callable, func)
+    budget = get_retry_budget(retry_budget) if isinstance(retry_budget, str) else retry_budget
+
+    def __on_flush(signature: typing.Hashable, suppressed: int) -> None:
+        # 窗口结束时输出被忽略的数量，错误不再出现时也不会丢失；特征为 exception_signature(e, location, level)
+        _signature = typing.cast(typing.Tuple, signature)
+        location, _level = _signature[-2:]
+        logging.getLogger(logger_name).log(_level, f"{location} %s suppressed=%d", _signature[1], suppressed)
+
+    dedup = suppress.ErrorDeduplicator(log_dedup_window, on_flush=__on_flush) if log_dedup_window > 0 else None
+
+    def __next_delay(count: int, prev_delay: float, start: float) -> typing.Optional[float]:
+        # 返回下次重试的等待时间，不能重试时返回None
+        if count >= max_retries:
+            return None
+        delay = _compute_delay(retry_backoff, count, prev_delay, retry_delay, retry_max_delay, retry_jitter)
+        if deadline is not None and time.monotonic() - start + delay >= deadline:
+            return None
+        if budget is not None and not budget.withdraw():
+            return None
+        return delay
+
+    def __on_error(
+        e: Exception, count: int, prev_delay: float, start: float, args: typing.Tuple, kwargs: typing.Dict
+    ) -> typing.Optional[float]:
+        # 记录异常日志，返回下次重试的等待时间，不再重试时返回None
+        delay = __next_delay(count, prev_delay, start) if isinstance(e, retry_for) else None
+        _level = logger_pre_level if delay is not None else logger_level
+        logger = logging.getLogger(logger_name)
+        if not logger.isEnabledFor(_level):
+            return delay
+        location = get_caller_location(fn)
+        suppressed: typing.Optional[int] = 0
+        if dedup is not None:
+            suppressed = dedup.check(suppress.exception_signature(e, location, _level))
+            if suppressed is None:
+                return delay
+        compact = delay is not None and log_compact_retries
+        if compact:
+            msg, params = f"{location} retry=%d %s: %s", [count, type(e).__name__, str(e)]
+        else:
+            msg, params = f"{location} retry=%d %s", [count, str(e)]
+        if suppressed:
+            msg += " suppressed=%d"
+            params.append(suppressed)
+        if log_args and not compact:
+            msg += "\n\targs: %s\n\tkwargs: %s"
+            params += [
+                suppress.truncate_repr(args, log_args_max_bytes),
+                suppress.truncate_repr(kwargs, log_args_max_bytes),
+            ]
+        logger.log(_level, msg, *params, exc_info=not compact)
+        return delay
+
+    def __on_result(result: typing.Any, count: int, prev_delay: float, start: float) -> typing.Optional[float]:
+        # 根据返回值判断是否重试，返回下次重试的等待时间，不再重试时返回None
+        if retry_if_result is None or not retry_if_result(result):
+            if budget is not None:
+                budget.deposit()
+            return None
+        delay = __next_delay(count, prev_delay, start)
+        if delay is not None:
+            logging.getLogger(logger_name).log(
+                logger_pre_level, f"{get_caller_location(fn)} retry=%d for result %s", count, result
+            )
+        return delay
+
+    if inspect.iscoroutinefunction(fn):
+
+        @wraps(fn)
+        async def _async_wrapper(*args: typing.Any, **kwargs: typing.Any) -> typing.Any:
+            result = None
+            has_err: bool = True
+            start = time.monotonic()
+            delay: typing.Optional[float] = 0.0
+
+            count = 0
+            while count < max_retries:
+                count += 1
+                try:
+                    result = await fn(*args, **kwargs)
+                    has_err = False
+                except asyncio.CancelledError:
+                    # 任务被取消时不捕获、不重试
+                    raise
+                except Exception as e:
+                    has_err = True
+                    delay = __on_error(e, count, delay or 0.0, start, args, kwargs)
+                    if delay is None:
+                        if is_raise:
+                            raise
+                        break
+                else:
+                    delay = __on_result(result, count, delay or 0.0, start)
+                    if delay is None:
+                        break
+
+                if delay:
+                    await asyncio.sleep(delay)
+
+            if has_err:
+                result = default() if callable(default) else default
+
+            return result
+
+        return _async_wrapper
 
     @wraps(fn)
     def _wrapper(*args: typing.Any, **kwargs: typing.Any) -> typing.Any:
         result = None
-        location = get_caller_location(fn)
         has_err: bool = True
+        start = time.monotonic()
+        delay: typing.Optional[float] = 0.0
 
         count = 0
-        while has_err and count < max_retries:
+        while count < max_retries:
             count += 1
             try:
                 result = fn(*args, **kwargs)
                 has_err = False
             except Exception as e:
                 has_err = True
-                _level = logger_pre_level if count < max_retries else logger_level
-                if log_args:
-                    logging.getLogger(logger_name).log(
-                        _level,
-                        f"{location} retry=%d %s\n\targs: %s\n\tkwargs: %s",
-                        count,
-                        str(e),
-                        args,
-                        kwargs,
-                        exc_info=True,
-                    )
-                else:
-                    logging.getLogger(logger_name).log(
-                        _level,
-                        f"{location} retry=%d %s",
-                        count,
-                        str(e),
-                        exc_info=True,
-                    )
-                if isinstance(e, retry_for):
-                    # 重试场景
-                    if count < max_retries:
-                        # 延迟重试，最后一次异常时不用延迟
-                        if retry_delay > 0:
-                            delay = retry_delay
-                            if retry_jitter:
-                                delay = int(random.randint(0, 100) * delay / 100.0)
-                            if delay > 0:
-                                time.sleep(delay)
-                    else:
-                        # 最后一次异常时抛出异常
-                        if is_raise:
-                            raise
-                else:
-                    # 其他异常不重试
+                delay = __on_error(e, count, delay or 0.0, start, args, kwargs)
+                if delay is None:
+                    # 不匹配retry_for、重试次数用完或者超过总耗时限制
                     if is_raise:
                         raise
                     break
+            else:
+                delay = __on_result(result, count, delay or 0.0, start)
+                if delay is None:
+                    break
+
+            if delay:
+                time.sleep(delay)
 
         if has_err:
             result = default() if callable(default) else default
@@ -125,16 +378,48 @@ def time_record(
     func: typing.Optional[typing.Callable] = None,
     format_key: typing.Optional[typing.Callable] = None,
     format_ret: typing.Optional[typing.Callable] = None,
+    aggregate: bool = False,
+    aggregate_interval: float = 60,
+    sample_rate: typing.Optional[float] = None,
+    slow_ms: typing.Optional[float] = None,
+    trace: bool = False,
+    profiler: typing.Optional[profiling.CallProfiler] = None,
+    cpu_time: bool = False,
+    gc_stats: bool = False,
+    memory: bool = False,
     logger_name: str = "pykit_tools.error",
     logger_level: int = logging.ERROR,
 ) -> typing.Callable:
     """
     `装饰器` 函数耗时统计
 
+    支持 async 函数，统计的是 await 的实际耗时；任务被取消时与正常结束一样按聚合、采样规则记录后抛出 `CancelledError`
+
+    聚合模式下不再每次调用输出日志，耗时记录到该函数的直方图 [LatencyHistogram](./#histogram.LatencyHistogram) 中，
+    每隔 aggregate_interval 秒输出一行统计数据（count/errors/min/p50/p90/p99/max），
+    装饰后的函数可通过 `snapshot()` 获取当前的统计数据
+
+    非聚合模式下可以只输出部分调用的日志：异常和耗时超过 slow_ms 的调用一定输出，其余调用按 sample_rate 采样；
+    不输出日志的调用不会构建key、调用 format_key/format_ret 及格式化耗时
+
+    开启 trace 时同时记录调用树 [traced](./#tracing.traced)：嵌套调用的被装饰函数记录父调用、自身耗时和总耗时，
+    根调用结束时输出一条调用树的记录
+
     Args:
         func:
-        format_key: 根据函数输入的参数，格式化日志记录的唯一标记key
-        format_ret: 根据函数返回的结果，格式化日志记录的结果ret
+        format_key: 根据函数输入的参数，格式化日志记录的唯一标记key，聚合模式下不使用
+        format_ret: 根据函数返回的结果，格式化日志记录的结果ret，聚合模式下不使用
+        aggregate: 是否使用聚合模式
+        aggregate_interval: 聚合模式下输出统计数据的间隔，单位秒(s)
+        sample_rate: 采样率，取值 [0, 1]，按调用次数均匀输出，eg: 0.4 时每5次调用输出2次；
+                默认None，未设置 slow_ms 时为1（全部输出），设置 slow_ms 时为0（只输出慢调用）
+        slow_ms: 慢调用的耗时阈值，单位毫秒(ms)，超过该值的调用一定输出日志
+        trace: 是否记录调用树
+        profiler: 性能分析 [CallProfiler](./#profiling.CallProfiler)，按调用次数或在慢调用后分析函数调用，不支持 async 函数
+        cpu_time: 日志及聚合数据中是否增加当前线程的CPU时间 cpu_ms
+        gc_stats: 日志及聚合数据中是否增加调用期间垃圾回收的次数 gc 和暂停时间 gc_ms
+        memory: 日志及聚合数据中是否增加 tracemalloc 统计的净增内存 mem_kb 和峰值内存 mem_peak_kb，会开启 tracemalloc；
+                各项数据说明详见 [ResourceMeter](./#usage.ResourceMeter)
         logger_name: 日志名称，仅记录异常时使用
         logger_level: 异常时设置日志的级别
 
@@ -147,6 +432,15 @@ def time_record(
             time_record,
             format_key=format_key,
             format_ret=format_ret,
+            aggregate=aggregate,
+            aggregate_interval=aggregate_interval,
+            sample_rate=sample_rate,
+            slow_ms=slow_ms,
+            trace=trace,
+            profiler=profiler,
+            cpu_time=cpu_time,
+            gc_stats=gc_stats,
+            memory=memory,
             logger_name=logger_name,
             logger_level=logger_level,
         )
@@ -154,38 +448,508 @@ def time_record(
     fn = typing.cast(typing.Callable, func)
 
     logger = logging.getLogger(logger_name)
+    try:
+        location = get_caller_location(fn)
+    except Exception:
+        location = getattr(fn, "__name__", repr(fn))
+    if profiler is not None:
+        if inspect.iscoroutinefunction(fn):
+            raise TypeError("profiler does not support async function")
+        fn = profiler.wrap(fn, location)
+    if trace:
+        fn = tracing.traced(fn, name=location)
 
-    @wraps(fn)
-    def _wrapper(*args: typing.Any, **kwargs: typing.Any) -> typing.Any:
-        _start = time.monotonic()
-        location = fn.__name__
+    hist: typing.Optional[histogram.LatencyHistogram] = None
+    if aggregate:
+        hist = histogram.LatencyHistogram()
+        histogram.register(location, hist, logger, interval=aggregate_interval)
+
+    meter: typing.Optional[usage.ResourceMeter] = None
+    if cpu_time or gc_stats or memory:
+        meter = usage.ResourceMeter(cpu=cpu_time, gc_stats=gc_stats, memory=memory)
+
+    if sample_rate is None:
+        sample_rate = 1.0 if slow_ms is None else 0.0
+    if not 0 <= sample_rate <= 1:
+        raise ValueError(f"sample_rate={sample_rate} must be between 0 and 1")
+    # 按调用次数均匀采样：采样率化为分数 p/q，第k次调用在 k*p % q < p 时输出，每q次调用恰好输出p次；整数运算避免浮点误差
+    fraction = fractions.Fraction(sample_rate).limit_denominator(1000000)
+    numerator, denominator = fraction.numerator, fraction.denominator
+    counter = itertools.count()
+
+    def __get_key(args: typing.Tuple, kwargs: typing.Dict) -> str:
+        # 仅在需要输出日志时构建key
         key = "-"
+        if hist is not None:
+            return key
         try:
-            location = get_caller_location(fn)
             if args:
                 key = str(args[0])
             if callable(format_key):
                 key = format_key(*args, **kwargs)
         except Exception:
             pass
+        return key
 
-        ret = None
+    def __on_result(
+        args: typing.Tuple, kwargs: typing.Dict, cost_ms: float, ret: typing.Any, state: typing.Any, cancelled: bool
+    ) -> None:
+        # 资源使用数据追加在日志末尾
+        extra = usage.format_fields(meter.stop(state)) if meter is not None else ""
+        key = __get_key(args, kwargs)
+        cost = "%.3f" % cost_ms
+        if cancelled:
+            logger.info(f"{location} %s %s cancelled{extra}", key, cost)
+            return
+        _ret = "-" if ret is None else ret
+        try:
+            if callable(format_ret):
+                _ret = format_ret(ret)
+            logger.info(f"{location} %s %s %s{extra}", key, cost, _ret)
+        except Exception as e:
+            logger.log(logger_level, f"{location} %s %s %s{extra}", key, cost, e, exc_info=True)
+
+    def __on_done(
+        args: typing.Tuple,
+        kwargs: typing.Dict,
+        start: float,
+        ret: typing.Any,
+        state: typing.Any,
+        cancelled: bool = False,
+    ) -> None:
+        # 正常结束和被取消的调用：聚合模式记录到直方图，否则慢调用一定输出，其余按调用次数采样
+        cost_ms = (time.monotonic() - start) * 1000
+        if hist is not None:
+            hist.record(cost_ms, fields=meter.stop(state) if meter is not None else None)
+        elif (slow_ms is not None and cost_ms >= slow_ms) or (
+            numerator and next(counter) * numerator % denominator < numerator
+        ):
+            __on_result(args, kwargs, cost_ms, ret, state, cancelled)
+
+    def __on_error(args: typing.Tuple, kwargs: typing.Dict, start: float, exc: Exception, state: typing.Any) -> None:
+        cost_ms = (time.monotonic() - start) * 1000
+        fields = meter.stop(state) if meter is not None else None
+        if hist is not None:
+            hist.record(cost_ms, error=True, fields=fields)
+        cost = "%.3f" % cost_ms
+        extra = usage.format_fields(fields) if fields else ""
+        logger.log(logger_level, f"{location} %s %s %s{extra}", __get_key(args, kwargs), cost, exc, exc_info=True)
+
+    if inspect.iscoroutinefunction(fn):
+
+        @wraps(fn)
+        async def _async_wrapper(*args: typing.Any, **kwargs: typing.Any) -> typing.Any:
+            _start = time.monotonic()
+            state: typing.Any = meter.start() if meter is not None else None
+            try:
+                ret = await fn(*args, **kwargs)
+            except asyncio.CancelledError:
+                # 被取消不是异常，与正常结束的调用一样聚合或采样输出
+                __on_done(args, kwargs, _start, None, state, cancelled=True)
+                raise
+            except Exception as exc:
+                __on_error(args, kwargs, _start, exc, state)
+                raise
+            __on_done(args, kwargs, _start, ret, state)
+            return ret
+
+        if hist is not None:
+            _async_wrapper.snapshot = hist.snapshot  # type: ignore
+        return _async_wrapper
+
+    @wraps(fn)
+    def _wrapper(*args: typing.Any, **kwargs: typing.Any) -> typing.Any:
+        _start = time.monotonic()
+        state: typing.Any = meter.start() if meter is not None else None
         try:
             ret = fn(*args, **kwargs)
         except Exception as exc:
-            cost = "%.3f" % ((time.monotonic() - _start) * 1000)
-            logger.log(logger_level, f"{location} %s %s %s", key, cost, exc, exc_info=True)
+            __on_error(args, kwargs, _start, exc, state)
             raise
-        else:
-            cost = "%.3f" % ((time.monotonic() - _start) * 1000)
-            _ret = "-" if ret is None else ret
+        __on_done(args, kwargs, _start, ret, state)
+        return ret
+
+    if hist is not None:
+        _wrapper.snapshot = hist.snapshot  # type: ignore
+    return _wrapper
+
+
+class _DaemonExecutor(object):
+    """
+    使用守护线程的线程池：ThreadPoolExecutor 的线程在进程退出时会被等待结束，超时放弃的调用一直不结束时进程无法退出；
+    守护线程在进程退出时直接结束，放弃的调用不会阻塞退出
+    """
+
+    def __init__(self, max_workers: int, thread_name_prefix: str) -> None:
+        self.max_workers = max_workers
+        self.thread_name_prefix = thread_name_prefix
+        self._queue: queue.Queue = queue.Queue()
+        self._idle = threading.Semaphore(0)
+        self._threads: typing.List[threading.Thread] = []
+        self._lock = threading.Lock()
+
+    def submit(self, fn: typing.Callable, *args: typing.Any, **kwargs: typing.Any) -> concurrent.futures.Future:
+        future: concurrent.futures.Future = concurrent.futures.Future()
+        self._queue.put((future, fn, args, kwargs))
+        # 有空闲线程时直接使用，否则在未达到上限时新建线程
+        if not self._idle.acquire(timeout=0):
+            with self._lock:
+                if len(self._threads) < self.max_workers:
+                    name = f"{self.thread_name_prefix}_{len(self._threads)}"
+                    thread = threading.Thread(target=self._work, name=name, daemon=True)
+                    thread.start()
+                    self._threads.append(thread)
+        return future
+
+    def _work(self) -> None:
+        while True:
+            future, fn, args, kwargs = self._queue.get()
+            # 已取消的调用不再执行
+            if future.set_running_or_notify_cancel():
+                try:
+                    result = fn(*args, **kwargs)
+                except BaseException as e:
+                    future.set_exception(e)
+                else:
+                    future.set_result(result)
+            del future, fn, args, kwargs
+            self._idle.release()
+
+
+class _LazyExecutor(object):
+    """
+    首次使用时才创建的线程池，fork后子进程中重新创建
+    """
+
+    def __init__(self, max_workers: int, thread_name_prefix: str) -> None:
+        self.max_workers = max_workers
+        self.thread_name_prefix = thread_name_prefix
+        self._executor: typing.Optional[_DaemonExecutor] = None
+        self._lock = threading.Lock()
+        fork.register_after_fork(self._after_fork)
+
+    def _after_fork(self) -> None:
+        # 线程池的线程不会被fork到子进程中
+        self._lock = threading.Lock()
+        self._executor = None
+
+    def get(self) -> _DaemonExecutor:
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    self._executor = _DaemonExecutor(self.max_workers, self.thread_name_prefix)
+        return self._executor
+
+
+class _HedgeState(object):
+    """
+    对冲调用的状态：最近调用耗时的滑动窗口、计数器和线程池
+    """
+
+    def __init__(
+        self,
+        delay: typing.Optional[float],
+        percentile: float,
+        window_size: int,
+        min_samples: int,
+        max_ratio: float,
+        max_workers: int,
+    ) -> None:
+        self.fixed_delay = delay
+        self.percentile = percentile
+        self.window_size = window_size
+        self.min_samples = min_samples
+        self.max_ratio = max_ratio
+        self.executor = _LazyExecutor(max_workers, "pykit_tools.hedged")
+        self._latencies: typing.List[float] = []
+        self._index = 0
+        self._calls = 0
+        self._fired = 0
+        self._won = 0
+        self._lock = threading.Lock()
+        fork.register_after_fork(self._after_fork)
+
+    def _after_fork(self) -> None:
+        self._lock = threading.Lock()
+
+    def delay(self) -> typing.Optional[float]:
+        # 统计一次调用，返回对冲等待时间，样本不足时返回None不对冲
+        with self._lock:
+            self._calls += 1
+            if self.fixed_delay is not None:
+                return self.fixed_delay
+            if len(self._latencies) < self.min_samples:
+                return None
+            latencies = sorted(self._latencies)
+        idx = min(len(latencies) - 1, int(len(latencies) * self.percentile / 100))
+        return latencies[idx]
+
+    def record_done(self, start: float, future: typing.Any) -> None:
+        # 第一次调用完成时的回调
+        if not future.cancelled():
+            self.record(time.monotonic() - start)
+
+    def record(self, cost: float) -> None:
+        # 记录第一次调用的耗时
+        with self._lock:
+            if len(self._latencies) < self.window_size:
+                self._latencies.append(cost)
+            else:
+                self._latencies[self._index] = cost
+                self._index = (self._index + 1) % self.window_size
+
+    def fire(self) -> bool:
+        # 对冲调用次数不超过总调用次数的 max_ratio
+        with self._lock:
+            if self._fired + 1 > self._calls * self.max_ratio:
+                return False
+            self._fired += 1
+            return True
+
+    def win(self) -> None:
+        with self._lock:
+            self._won += 1
+
+    def stats(self) -> typing.Dict[str, typing.Any]:
+        with self._lock:
+            return {"calls": self._calls, "fired": self._fired, "won": self._won}
+
+
+def hedged(
+    func: typing.Optional[typing.Callable] = None,
+    delay: typing.Optional[float] = None,
+    percentile: float = 95,
+    window_size: int = 100,
+    min_samples: int = 20,
+    max_ratio: float = 0.1,
+    max_workers: int = 16,
+) -> typing.Callable:
+    """
+    `装饰器` 对冲调用，用于降低长尾耗时：第一次调用超过等待时间仍未完成时，再发起一次相同的调用，返回先完成的结果
+
+    仅适用于幂等的读操作（例如从多个副本读取数据）；普通函数在线程池中执行，async 函数使用 asyncio task 执行，
+    先成功的结果返回后，取消（未开始执行的）或者忽略另一次调用；两次调用都失败时抛出先完成的异常
+
+    装饰后的函数可通过 `hedge_stats()` 获取调用次数 calls、对冲次数 fired、对冲调用先完成的次数 won
+
+    Args:
+        func: 函数，支持 async 函数
+        delay: 固定的对冲等待时间，单位秒(s)；默认None，使用最近调用耗时的 percentile 分位值
+        percentile: 自适应等待时间使用的分位数
+        window_size: 统计耗时的最近调用次数
+        min_samples: 自适应模式下最少的耗时样本数，样本不足时不对冲
+        max_ratio: 对冲调用次数占总调用次数的最大比例，避免下游整体变慢时请求翻倍
+        max_workers: 线程池的最大线程数，仅普通函数使用
+
+    Returns:
+        function
+
+    """
+    if not callable(func):
+        return partial(
+            hedged,
+            delay=delay,
+            percentile=percentile,
+            window_size=window_size,
+            min_samples=min_samples,
+            max_ratio=max_ratio,
+            max_workers=max_workers,
+        )
+
+    fn = typing.cast(typing.Callable, func)
+    state = _HedgeState(delay, percentile, window_size, min_samples, max_ratio, max_workers)
+
+    if inspect.iscoroutinefunction(fn):
+
+        @wraps(fn)
+        async def _async_wrapper(*args: typing.Any, **kwargs: typing.Any) -> typing.Any:
+            hedge_delay = state.delay()
+            primary = asyncio.ensure_future(fn(*args, **kwargs))
+            primary.add_done_callback(partial(state.record_done, time.monotonic()))
+            tasks = {primary}
             try:
-                if callable(format_ret):
-                    _ret = format_ret(ret)
-                logger.info(f"{location} %s %s %s", key, cost, _ret)
-            except Exception as e:
-                logger.log(logger_level, f"{location} %s %s %s", key, cost, e, exc_info=True)
+                if hedge_delay is not None:
+                    done, _ = await asyncio.wait(tasks, timeout=hedge_delay)
+                    if not done and state.fire():
+                        tasks.add(asyncio.ensure_future(fn(*args, **kwargs)))
+                pending: typing.Set = set(tasks)
+                error = None
+                while pending:
+                    done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                    for task in done:
+                        if task.exception() is None:
+                            if task is not primary:
+                                state.win()
+                            return task.result()
+                        error = error or task.exception()
+                raise typing.cast(BaseException, error)
+            finally:
+                for task in tasks:
+                    if not task.done():
+                        task.cancel()
 
-        return ret
+        _async_wrapper.hedge_stats = state.stats  # type: ignore
+        return _async_wrapper
+
+    @wraps(fn)
+    def _wrapper(*args: typing.Any, **kwargs: typing.Any) -> typing.Any:
+        hedge_delay = state.delay()
+        start = time.monotonic()
+        if hedge_delay is None:
+            # 不对冲时直接在当前线程中调用
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                state.record(time.monotonic() - start)
+
+        executor = state.executor.get()
+        # 在工作线程中继续使用当前的调用上下文（tracing）
+        primary = executor.submit(tracing.bind_context(fn), *args, **kwargs)
+        primary.add_done_callback(partial(state.record_done, start))
+        futures = [primary]
+        done, _ = concurrent.futures.wait(futures, timeout=hedge_delay)
+        if not done and state.fire():
+            futures.append(executor.submit(tracing.bind_context(fn), *args, **kwargs))
+        pending: typing.Set = set(futures)
+        error = None
+        while pending:
+            done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    for other in pending:
+                        other.cancel()
+                    if future is not primary:
+                        state.win()
+                    return future.result()
+                error = error or future.exception()
+        raise typing.cast(BaseException, error)
+
+    _wrapper.hedge_stats = state.stats  # type: ignore
+    return _wrapper
+
+
+class TimeoutMode(ChoiceEnum):
+    """
+    `枚举` 同步函数的超时实现方式，定义值详见源码。
+
+    应用于装饰器 [call_timeout](./#decorators.common.call_timeout)，async 函数始终使用 `asyncio.wait_for`
+    """
+
+    # 工作线程为守护线程，进程退出时不等待放弃的调用
+    THREAD = ("thread", "在工作线程中执行，超时后放弃等待，工作线程会继续执行直到函数结束")
+    # 仅在主线程中生效，非主线程中调用时回退为 thread 模式；不支持 Windows；
+    # 嵌套使用时外层的计时器先到期则由外层处理，调用结束后恢复外层的计时器
+    SIGNAL = ("signal", "在当前线程中执行，使用 SIGALRM 信号中断超时的调用")
+
+
+class CallTimeoutError(TimeoutError):
+    """
+    调用超时抛出的异常，继承 TimeoutError，可以作为 handle_exception 的 retry_for
+    """
+
+    def __init__(self, location: str, seconds: float, elapsed: float) -> None:
+        super(CallTimeoutError, self).__init__(f"{location} timeout after {elapsed:.3f}s (limit {seconds}s)")
+        self.location = location
+        self.seconds = seconds
+        self.elapsed = elapsed
+
+
+def call_timeout(
+    func: typing.Optional[typing.Callable] = None,
+    seconds: float = 10,
+    mode: str = TimeoutMode.THREAD.value,
+    max_workers: int = 16,
+) -> typing.Callable:
+    """
+    `装饰器` 限制单次调用的耗时，超时抛出 [CallTimeoutError](./#decorators.common.CallTimeoutError)
+
+    结合 handle_exception 使用时放在内层，每次重试单独计时：
+
+    ```python
+    @handle_exception(max_retries=3, retry_for=TimeoutError)
+    @call_timeout(seconds=2)
+    def fetch(url):
+        ...
+    ```
+
+    Args:
+        func: 函数，支持 async 函数
+        seconds: 超时时间，单位秒(s)，支持小数
+        mode: 同步函数的超时实现方式 [TimeoutMode](./#decorators.common.TimeoutMode)，默认使用工作线程
+        max_workers: thread 模式下线程池的最大线程数；超时放弃的调用仍会占用线程直到结束，线程用完后新的调用排队等待也计入耗时
+
+    Returns:
+        function
+
+    """
+    if not callable(func):
+        return partial(call_timeout, seconds=seconds, mode=mode, max_workers=max_workers)
+
+    if mode not in TimeoutMode:
+        raise TypeError(f"mode={mode} not supported")
+    if mode == TimeoutMode.SIGNAL.value and not hasattr(signal, "SIGALRM"):
+        raise TypeError("mode=signal requires SIGALRM")
+
+    fn = typing.cast(typing.Callable, func)
+
+    if inspect.iscoroutinefunction(fn):
+
+        @wraps(fn)
+        async def _async_wrapper(*args: typing.Any, **kwargs: typing.Any) -> typing.Any:
+            start = time.monotonic()
+            try:
+                return await asyncio.wait_for(fn(*args, **kwargs), seconds)
+            except asyncio.TimeoutError:
+                raise CallTimeoutError(get_caller_location(fn), seconds, time.monotonic() - start) from None
+
+        return _async_wrapper
+
+    executor = _LazyExecutor(max_workers, "pykit_tools.timeout")
+
+    def __call_in_thread(args: typing.Tuple, kwargs: typing.Dict) -> typing.Any:
+        start = time.monotonic()
+        future = executor.get().submit(tracing.bind_context(fn), *args, **kwargs)
+        done, _ = concurrent.futures.wait([future], timeout=seconds)
+        if not done:
+            # 未开始执行的直接取消，已在执行的放弃等待
+            future.cancel()
+            raise CallTimeoutError(get_caller_location(fn), seconds, time.monotonic() - start)
+        return future.result()
+
+    def __call_with_signal(args: typing.Tuple, kwargs: typing.Dict) -> typing.Any:
+        start = time.monotonic()
+        # 外层（例如嵌套的 call_timeout）已设置的计时器
+        outer, interval = signal.getitimer(signal.ITIMER_REAL)
+        outer_first = 0 < outer <= seconds
+        outer_fired = False
+
+        def __on_alarm(signum: int, frame: typing.Any) -> None:
+            nonlocal outer_fired
+            elapsed = time.monotonic() - start
+            if outer_first and not outer_fired and callable(previous):
+                # 外层的计时器先到期，交给外层的处理函数；处理函数没有抛出异常时继续等待本次调用到期
+                outer_fired = True
+                previous(signum, frame)
+                if elapsed < seconds:
+                    signal.setitimer(signal.ITIMER_REAL, seconds - elapsed)
+                    return
+            raise CallTimeoutError(get_caller_location(fn), seconds, elapsed)
+
+        previous = signal.signal(signal.SIGALRM, __on_alarm)
+        signal.setitimer(signal.ITIMER_REAL, outer if outer_first else seconds)
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+            signal.signal(signal.SIGALRM, previous)
+            if outer and not outer_fired:
+                # 恢复外层的计时器，已到期的立即触发
+                signal.setitimer(signal.ITIMER_REAL, max(outer - (time.monotonic() - start), 1e-6), interval)
+
+    @wraps(fn)
+    def _wrapper(*args: typing.Any, **kwargs: typing.Any) -> typing.Any:
+        if mode == TimeoutMode.SIGNAL.value and threading.current_thread() is threading.main_thread():
+            return __call_with_signal(args, kwargs)
+        return __call_in_thread(args, kwargs)
 
     return _wrapper
@@ -0,0 +1,362 @@
+#!/usr/bin/env python
+# coding=utf-8
+import time
+import asyncio
+import inspect
+import typing
+import logging
+import threading
+from functools import wraps, partial
+from py_enum import ChoiceEnum
+
+import pykit_tools
+from pykit_tools import fork, redis_tool
+from pykit_tools.log import suppress
+from pykit_tools.utils import get_caller_location
+
+
+class RateLimitBackend(ChoiceEnum):
+    """
+    `枚举` 限流的存储后端，定义值详见源码。
+
+    应用于装饰器 [rate_limit](./#decorators.rate_limit.rate_limit)
+    """
+
+    LOCAL = ("local", "进程内令牌桶，仅限制当前进程")
+    REDIS = ("redis", "redis中使用GCRA算法，多个进程/机器共享配额")
+
+
+class RateLimitFailure(ChoiceEnum):
+    """
+    `枚举` 限流的存储后端不可用（例如redis连接失败）时的处理方式，定义值详见源码。
+
+    应用于装饰器 [rate_limit](./#decorators.rate_limit.rate_limit)
+    """
+
+    RAISE = ("raise", "抛出后端的异常")
+    # 适用于限流只是保护，后端故障时不应影响业务的场景
+    ALLOW = ("allow", "不限流直接调用（fail-open）")
+    # 适用于必须遵守配额（例如第三方接口超额会被封禁）的场景
+    REJECT = ("reject", "视为超过限流（fail-closed），返回 default 或抛出 RateLimitExceeded")
+
+
+class RateLimitExceeded(Exception):
+    """
+    超过限流且不等待（或等待超时）时抛出的异常
+    """
+
+    def __init__(self, name: str, retry_after: float) -> None:
+        super(RateLimitExceeded, self).__init__(f"rate limit {name} exceeded, retry after {retry_after:.3f}s")
+        self.name = name
+        self.retry_after = retry_after
+
+
+class TokenBucket(object):
+    """
+    进程内线程安全的令牌桶：每秒生成 rate 个令牌，最多保存 burst 个
+    """
+
+    def __init__(self, name: str, rate: float, burst: typing.Optional[int] = None) -> None:
+        """
+        初始化构造对象
+
+        Args:
+            name: 名称
+            rate: 每秒允许的调用次数
+            burst: 允许的突发调用次数（令牌桶容量），默认与rate相同且最小为1
+        """
+        self.name = name
+        self.rate = rate
+        self.burst = burst or max(1, int(rate))
+        self._tokens = float(self.burst)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+        fork.register_after_fork(self._after_fork)
+
+    def _after_fork(self) -> None:
+        self._lock = threading.Lock()
+
+    def try_acquire(self) -> float:
+        """
+        尝试获取一个令牌
+
+        Returns:
+            0表示获取成功，否则为需要等待的时间，单位秒(s)
+
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            # 浮点数累加误差
+            if self._tokens >= 1 - 1e-9:
+                self._tokens -= 1
+                return 0.0
+            return (1 - self._tokens) / self.rate
+
+
+# GCRA(Generic Cell Rate Algorithm)：只保存理论到达时间(TAT)，使用redis服务器时间避免多台机器时钟不一致
+# ARGV[1] 每个令牌的间隔(微秒)，ARGV[2] 突发容量对应的时间(微秒)；返回0表示允许，否则为需要等待的微秒数
+_GCRA_SCRIPT = """
+-- redis 5 之前的版本在写操作前调用非确定性命令 TIME 需要开启命令复制；redis 5+ 默认开启，调用无影响
+if redis.replicate_commands then
+    redis.replicate_commands()
+end
+local now = redis.call("TIME")
+now = tonumber(now[1]) * 1000000 + tonumber(now[2])
+local emission = tonumber(ARGV[1])
+local tat = tonumber(redis.call("GET", KEYS[1]) or now)
+if tat < now then
+    tat = now
+end
+local new_tat = tat + emission
+local wait = new_tat - tonumber(ARGV[2]) - now
+if wait > 0 then
+    return math.ceil(wait)
+end
+redis.call("SET", KEYS[1], string.format("%.0f", new_tat), "PX", math.ceil((new_tat - now) / 1000))
+return 0
+"""
+
+
+class RedisGCRALimiter(object):
+    """
+    基于redis的分布式限流，使用lua脚本原子执行GCRA算法，多个进程/机器共享同一个配额
+    """
+
+    def __init__(self, name: str, rate: float, burst: typing.Optional[int] = None, client: typing.Any = None) -> None:
+        """
+        初始化构造对象
+
+        Args:
+            name: 名称，作为redis的key
+            rate: 每秒允许的调用次数
+            burst: 允许的突发调用次数，默认与rate相同且最小为1
+            client: redis客户端，支持 [RedisRingClient](./#redis_tool.RedisRingClient)；
+                默认使用 `settings.APP_CACHE_REDIS` 构建
+        """
+        if client is None:
+            conf = pykit_tools.settings.APP_CACHE_REDIS
+            if not conf:
+                raise ValueError("settings.APP_CACHE_REDIS is required for redis rate limit")
+            client = redis_tool.build_redis_client(conf)
+        self.name = name
+        self.rate = rate
+        self.burst = burst or max(1, int(rate))
+        self.client = client
+        self.key = f"rate_limit:{name}"
+        self._emission = 1000000.0 / rate
+        self._scripts: typing.Dict[int, typing.Any] = {}
+
+    def _script(self) -> typing.Any:
+        client = self.client
+        if isinstance(client, redis_tool.RedisRingClient):
+            client = client.get_client(self.key)
+        script = self._scripts.get(id(client))
+        if script is None:
+            # register_script 使用evalsha执行，脚本不存在时自动加载
+            script = self._scripts[id(client)] = client.register_script(_GCRA_SCRIPT)
+        return script
+
+    def try_acquire(self) -> float:
+        """
+        尝试获取一个令牌
+
+        Returns:
+            0表示获取成功，否则为需要等待的时间，单位秒(s)
+
+        """
+        wait = self._script()(keys=[self.key], args=[self._emission, self._emission * self.burst])
+        return int(wait) / 1000000.0
+
+
+_limiters: typing.Dict[typing.Tuple[str, str], typing.Any] = {}
+_limiters_lock = threading.Lock()
+
+
+def _on_error_flush(signature: typing.Hashable, suppressed: int) -> None:
+    # 后端恢复后输出最后一个窗口内被忽略的错误数
+    name, exc_type = typing.cast(typing.Tuple, signature)
+    logging.getLogger("pykit_tools.error").error(
+        "pykit_tools rate_limit %s backend error %s, suppressed=%d", name, exc_type.__name__, suppressed
+    )
+
+
+# 后端不可用时每个限流器每分钟只输出一次错误日志
+_error_dedup = suppress.ErrorDeduplicator(60, on_flush=_on_error_flush)
+
+
+def get_rate_limiter(
+    name: str,
+    rate: float,
+    burst: typing.Optional[int] = None,
+    backend: str = RateLimitBackend.LOCAL.value,
+    client: typing.Any = None,
+) -> typing.Union[TokenBucket, RedisGCRALimiter]:
+    """
+    根据名称获取限流器，不存在时创建；相同名称的函数共享配额，rate和burst必须与已创建的限流器一致
+
+    Args:
+        name: 名称
+        rate: 每秒允许的调用次数
+        burst: 允许的突发调用次数
+        backend: 存储后端 [RateLimitBackend](./#decorators.rate_limit.RateLimitBackend)
+        client: redis客户端，仅redis后端使用
+
+    Returns:
+        限流器
+
+    Raises:
+        ValueError: 同名的限流器已存在且rate或burst不同
+
+    """
+    if backend not in RateLimitBackend:
+        raise TypeError(f"backend={backend} not supported")
+    limiter = _limiters.get((backend, name))
+    if limiter is None:
+        with _limiters_lock:
+            limiter = _limiters.get((backend, name))
+            if limiter is None:
+                if backend == RateLimitBackend.REDIS.value:
+                    limiter = RedisGCRALimiter(name, rate, burst=burst, client=client)
+                else:
+                    limiter = TokenBucket(name, rate, burst=burst)
+                _limiters[(backend, name)] = limiter
+                return limiter
+    if limiter.rate != rate or limiter.burst != (burst or max(1, int(rate))):
+        raise ValueError(
+            f"rate limiter {name} already exists with rate={limiter.rate} burst={limiter.burst}, "
+            f"got rate={rate} burst={burst}"
+        )
+    return limiter
+
+
+def rate_limit(
+    func: typing.Optional[typing.Callable] = None,
+    rate: float = 10,
+    burst: typing.Optional[int] = None,
+    name: typing.Optional[str] = None,
+    backend: str = RateLimitBackend.LOCAL.value,
+    client: typing.Any = None,
+    block: bool = True,
+    max_wait: typing.Optional[float] = None,
+    default: typing.Any = False,
+    is_raise: bool = False,
+    on_backend_error: str = RateLimitFailure.RAISE.value,
+) -> typing.Callable:
+    """
+    `装饰器` 限流，限制函数每秒的调用次数，例如调用有QPS配额的第三方接口
+
+    ```python
+    # 多个进程/机器共享每秒20次的配额，超过时等待
+    @rate_limit(rate=20, name="sms-api", backend="redis")
+    def send_sms(mobile, content):
+        ...
+    ```
+
+    Args:
+        func: 函数，支持 async 函数（等待时使用 `asyncio.sleep`；redis后端在默认线程池中执行，不阻塞事件循环）
+        rate: 每秒允许的调用次数
+        burst: 允许的突发调用次数，默认与rate相同且最小为1
+        name: 名称，相同名称的函数共享配额，rate和burst必须相同；默认使用函数路径
+        backend: 存储后端 [RateLimitBackend](./#decorators.rate_limit.RateLimitBackend)，默认进程内令牌桶
+        client: redis客户端，仅redis后端使用，默认使用 `settings.APP_CACHE_REDIS` 构建
+        block: 超过限流时是否等待；False时直接失败
+        max_wait: 最长等待时间，单位秒(s)，默认None一直等待；预计等待时间超过该值时直接失败
+        default: 失败时返回的默认值，可以是函数
+        is_raise: 失败时是否抛出 [RateLimitExceeded](./#decorators.rate_limit.RateLimitExceeded)，设置True时default参数无效
+        on_backend_error: 存储后端不可用时的处理方式 [RateLimitFailure](./#decorators.rate_limit.RateLimitFailure)，
+            默认抛出后端的异常；放行或拒绝时错误日志每分钟最多输出一次
+
+    Returns:
+        function
+
+    """
+    if not callable(func):
+        return partial(
+            rate_limit,
+            rate=rate,
+            burst=burst,
+            name=name,
+            backend=backend,
+            client=client,
+            block=block,
+            max_wait=max_wait,
+            default=default,
+            is_raise=is_raise,
+            on_backend_error=on_backend_error,
+        )
+
+    if on_backend_error not in RateLimitFailure:
+        raise TypeError(f"on_backend_error={on_backend_error} not supported")
+
+    fn = typing.cast(typing.Callable, func)
+    limiter = get_rate_limiter(name or get_caller_location(fn), rate, burst=burst, backend=backend, client=client)
+
+    def __backend_error(e: Exception) -> float:
+        # 后端不可用：返回0放行，或者返回-1视为超过限流
+        if on_backend_error == RateLimitFailure.RAISE.value:
+            raise e
+        suppressed = _error_dedup.check((limiter.name, type(e)))
+        if suppressed is not None:
+            logging.getLogger("pykit_tools.error").error(
+                "pykit_tools rate_limit %s backend error, %s the call, suppressed=%d",
+                limiter.name,
+                on_backend_error,
+                suppressed,
+                exc_info=True,
+            )
+        return 0.0 if on_backend_error == RateLimitFailure.ALLOW.value else -1.0
+
+    def __next_wait(start: float) -> typing.Optional[float]:
+        # 返回需要等待的时间，0表示可以调用，None表示直接失败
+        try:
+            wait = limiter.try_acquire()
+        except Exception as e:
+            wait = __backend_error(e)
+            if wait < 0:
+                if is_raise:
+                    raise RateLimitExceeded(limiter.name, 0.0) from e
+                return None
+        if not wait:
+            return 0.0
+        if not block or (max_wait is not None and time.monotonic() - start + wait > max_wait):
+            if is_raise:
+                raise RateLimitExceeded(limiter.name, wait)
+            return None
+        return wait
+
+    if inspect.iscoroutinefunction(fn):
+        remote = backend == RateLimitBackend.REDIS.value
+
+        @wraps(fn)
+        async def _async_wrapper(*args: typing.Any, **kwargs: typing.Any) -> typing.Any:
+            start = time.monotonic()
+            while True:
+                if remote:
+                    # redis的网络调用不阻塞事件循环
+                    wait = await asyncio.get_event_loop().run_in_executor(None, __next_wait, start)
+                else:
+                    wait = __next_wait(start)
+                if wait is None:
+                    return default() if callable(default) else default
+                if not wait:
+                    return await fn(*args, **kwargs)
+                await asyncio.sleep(wait)
+
+        _async_wrapper.limiter = limiter  # type: ignore
+        return _async_wrapper
+
+    @wraps(fn)
+    def _wrapper(*args: typing.Any, **kwargs: typing.Any) -> typing.Any:
+        start = time.monotonic()
+        while True:
+            wait = __next_wait(start)
+            if wait is None:
+                return default() if callable(default) else default
+            if not wait:
+                return fn(*args, **kwargs)
+            time.sleep(wait)
+
+    _wrapper.limiter = limiter  # type: ignore
+    return _wrapper
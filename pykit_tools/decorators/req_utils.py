@@ -8,12 +8,15 @@ import json as json_tool
 
 from functools import wraps, partial
 
+from pykit_tools import tracing
+
 
 def requests_logger(
     func: typing.Optional[typing.Callable] = None,
     default_ua: str = "",
     logger_name: str = "pykit_tools.requests",
     logger_level: int = logging.ERROR,
+    trace: bool = False,
 ) -> typing.Callable:
     """
     `装饰器` 应用于对 requests 库的请求进行日志记录.
@@ -31,6 +34,7 @@ def requests_logger(
         default_ua: 默认的 User-Agent
         logger_name: 日志名称，仅记录异常时使用
         logger_level: 异常时设置日志的级别
+        trace: 是否记录到调用树 [tracing](./#tracing)，名称为 `{METHOD} {host}`，附加属性 url 和 status
 
     Returns:
         function:
@@ -75,7 +79,9 @@ def requests_logger(
     ```
     """
     if not callable(func):
-        return partial(requests_logger, default_ua=default_ua, logger_name=logger_name, logger_level=logger_level)
+        return partial(
+            requests_logger, default_ua=default_ua, logger_name=logger_name, logger_level=logger_level, trace=trace
+        )
 
     fn = typing.cast(typing.Callable, func)
     logger = logging.getLogger(logger_name)
@@ -120,7 +126,12 @@ def requests_logger(
         length = 0
         _start = time.monotonic()
         try:
-            response = fn(method, url, headers=headers, timeout=timeout, **kwargs)
+            if trace:
+                with tracing.span(f"{method.upper()} {host}", url=url) as span:
+                    response = fn(method, url, headers=headers, timeout=timeout, **kwargs)
+                    span.attrs["status"] = response.status_code
+            else:
+                response = fn(method, url, headers=headers, timeout=timeout, **kwargs)
             response.encoding = "utf-8"
             code = response.status_code
             length = len(response.content)
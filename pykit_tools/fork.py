@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+# coding=utf-8
+import os
+import types
+import typing
+import logging
+import weakref
+import threading
+
+from py_enum import ChoiceEnum
+
+
+class ForkPolicy(ChoiceEnum):
+    """
+    `枚举` fork后子进程中对已构建实例的处理策略，定义值详见源码。
+
+    应用于 [SingletonMeta](./#patterns.singleton.SingletonMeta) 的类属性 singleton_fork_policy
+    和装饰器 [singleton_refresh_regular](./#decorators.cache.singleton_refresh_regular)
+    """
+
+    KEEP = ("keep", "继续使用父进程中构建的实例")
+    DROP = ("drop", "丢弃父进程中构建的实例，子进程中使用时重新构建")  # 适用于持有socket连接等不能跨进程共享的实例
+
+
+class _Callbacks(object):
+    """
+    回调函数列表，绑定方法使用弱引用保存，对象被回收后自动失效
+    """
+
+    def __init__(self) -> None:
+        self.refs: typing.List[typing.Callable[[], typing.Any]] = []
+        # 数量达到该值时清理已失效的回调，避免无限增长
+        self.prune_at = 64
+
+    def append(self, callback: typing.Callable) -> None:
+        if len(self.refs) >= self.prune_at:
+            self.refs = [ref for ref in self.refs if ref() is not None]
+            self.prune_at = max(64, len(self.refs) * 2)
+        if isinstance(callback, types.MethodType):
+            self.refs.append(weakref.WeakMethod(callback))
+        else:
+            self.refs.append(lambda: callback)
+
+    def run(self) -> None:
+        alive = []
+        for ref in self.refs:
+            fn = ref()
+            if fn is None:
+                continue
+            alive.append(ref)
+            try:
+                fn()
+            except Exception:
+                logging.getLogger("pykit_tools.error").exception("pykit_tools fork callback %s error", fn)
+        self.refs = alive
+
+
+_lock = threading.Lock()
+_before_callbacks = _Callbacks()
+_child_callbacks = _Callbacks()
+
+
+def register_before_fork(callback: typing.Callable) -> None:
+    """
+    注册fork前在父进程中执行的回调函数，例如：刷新日志缓冲区
+
+    Args:
+        callback: 无参数的函数；若是对象的绑定方法则使用弱引用，对象被回收后不再调用
+
+    """
+    with _lock:
+        _before_callbacks.append(callback)
+
+
+def register_after_fork(callback: typing.Callable) -> None:
+    """
+    注册fork后在子进程中执行的回调函数，例如：重置连接池、重建锁、重新打开文件
+
+    Args:
+        callback: 无参数的函数；若是对象的绑定方法则使用弱引用，对象被回收后不再调用
+
+    """
+    with _lock:
+        _child_callbacks.append(callback)
+
+
+def run_before_fork() -> None:
+    """
+    执行fork前的回调函数，通过 os.register_at_fork 自动调用，一般不需要手动调用
+    """
+    with _lock:
+        _before_callbacks.run()
+
+
+def run_after_fork() -> None:
+    """
+    执行fork后子进程中的回调函数，通过 os.register_at_fork 自动调用；
+    使用 os.fork 以外的方式创建子进程或 python3.6（没有 os.register_at_fork）时，可在子进程中手动调用
+    """
+    global _lock
+    # fork时其他线程可能持有锁，子进程中重建
+    _lock = threading.Lock()
+    _child_callbacks.run()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(before=run_before_fork, after_in_child=run_after_fork)
@@ -0,0 +1,249 @@
+#!/usr/bin/env python
+# coding=utf-8
+import time
+import atexit
+import typing
+import logging
+import threading
+
+from pykit_tools import fork
+
+
+class LatencyHistogram(object):
+    """
+    耗时直方图：对数-线性分桶（类似HdrHistogram），内存固定，记录时只需一次加锁的计数
+
+    耗时以微秒为单位分桶：小于 2^precision_bits 微秒时每个值一个桶，之后每个2的幂区间分成 2^(precision_bits-1) 个桶，
+    分位值的相对误差不超过 1/2^(precision_bits-1)
+    """
+
+    def __init__(self, precision_bits: int = 6, max_bits: int = 40) -> None:
+        """
+        初始化构造对象
+
+        Args:
+            precision_bits: 精度位数，默认6（相对误差约3%）
+            max_bits: 最大可记录值的位数，默认40（约12天），超过时记录到最后一个桶
+        """
+        self.precision_bits = precision_bits
+        self.max_bits = max_bits
+        self._linear = 1 << precision_bits
+        self._half = 1 << (precision_bits - 1)
+        self._size = self._linear + (max_bits - precision_bits) * self._half
+        self._lock = threading.Lock()
+        self._reset()
+        fork.register_after_fork(self._after_fork)
+
+    def _after_fork(self) -> None:
+        # 子进程不重复输出父进程fork前的统计数据
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self) -> None:
+        self._counts = [0] * self._size
+        self._count = 0
+        self._errors = 0
+        self._min = float("inf")
+        self._max = 0.0
+        # 附加的资源使用数据，eg: { "cpu_ms": [总和, 最大值] }
+        self._fields: typing.Dict[str, typing.List[float]] = {}
+
+    def _index(self, value: int) -> int:
+        if value < self._linear:
+            return value
+        shift = value.bit_length() - self.precision_bits
+        index = self._linear + (shift - 1) * self._half + (value >> shift) - self._half
+        return min(index, self._size - 1)
+
+    def _value(self, index: int) -> float:
+        # 桶的中间值，单位微秒
+        if index < self._linear:
+            return float(index)
+        shift = (index - self._linear) // self._half + 1
+        lower = ((index - self._linear) % self._half + self._half) << shift
+        return lower + ((1 << shift) - 1) / 2.0
+
+    def record(self, cost: float, error: bool = False, fields: typing.Optional[typing.Dict[str, float]] = None) -> None:
+        """
+        记录一次耗时
+
+        Args:
+            cost: 耗时，单位毫秒(ms)
+            error: 是否异常
+            fields: 附加的资源使用数据，eg: [ResourceMeter](./#usage.ResourceMeter) 的结果，统计总和及最大值
+        """
+        index = self._index(max(0, int(cost * 1000)))
+        with self._lock:
+            self._counts[index] += 1
+            self._count += 1
+            self._errors += error
+            if cost < self._min:
+                self._min = cost
+            if cost > self._max:
+                self._max = cost
+            if fields:
+                for name, value in fields.items():
+                    item = self._fields.get(name)
+                    if item is None:
+                        self._fields[name] = [value, value]
+                    else:
+                        item[0] += value
+                        if value > item[1]:
+                            item[1] = value
+
+    def snapshot(self, reset: bool = False, percentiles: typing.Iterable[float] = (50, 90, 99)) -> typing.Dict:
+        """
+        获取统计数据
+
+        Args:
+            reset: 是否重置统计数据
+            percentiles: 需要计算的分位数
+
+        Returns:
+            count 调用次数，errors 异常次数，min/max 最小/最大耗时，p50/p90/p99 等分位耗时；耗时单位毫秒(ms)；
+            有附加数据时增加 `{name}_sum`/`{name}_max`，eg: cpu_ms_sum、cpu_ms_max
+
+        """
+        with self._lock:
+            counts, count, errors, _min, _max = self._counts, self._count, self._errors, self._min, self._max
+            fields = self._fields
+            if reset:
+                self._reset()
+            else:
+                counts = list(counts)
+                fields = {k: list(v) for k, v in fields.items()}
+        data: typing.Dict[str, typing.Any] = {"count": count, "errors": errors, "min": 0.0, "max": 0.0}
+        for name, (total, peak) in fields.items():
+            data[f"{name}_sum"] = total
+            data[f"{name}_max"] = peak
+        targets = sorted(percentiles)
+        for p in targets:
+            data[f"p{p:g}"] = 0.0
+        if not count:
+            return data
+        data.update({"min": _min, "max": _max})
+        seen = 0
+        i = 0
+        for index, n in enumerate(counts):
+            if not n:
+                continue
+            seen += n
+            while i < len(targets) and seen >= count * targets[i] / 100.0:
+                # 分位值限制在实际的最小和最大值之间
+                value = self._value(index) / 1000.0
+                data[f"p{targets[i]:g}"] = min(max(value, _min), _max)
+                i += 1
+            if i >= len(targets):
+                break
+        return data
+
+
+class _Reporter(object):
+    """
+    定时将直方图的统计数据输出到日志
+    """
+
+    def __init__(self) -> None:
+        # eg: { location: [histogram, logger, interval, last_flush] }
+        self._items: typing.Dict[str, typing.List] = {}
+        self._lock = threading.Lock()
+        self._thread: typing.Optional[threading.Thread] = None
+        self._tick = 1.0
+        # 注册了更短的输出间隔时唤醒后台线程，不必等到当前的休眠结束
+        self._wakeup = threading.Event()
+
+    def _after_fork(self) -> None:
+        # 后台线程不会被fork到子进程中；装饰器一般在fork前注册，已有注册的直方图时直接在子进程中重新启动
+        self._lock = threading.Lock()
+        self._thread = None
+        self._wakeup = threading.Event()
+        now = time.monotonic()
+        for item in self._items.values():
+            item[3] = now
+        if self._items:
+            self._start()
+
+    def _start(self) -> None:
+        self._thread = threading.Thread(target=self._run, name="pykit_tools.histogram", daemon=True)
+        self._thread.start()
+
+    def register(self, location: str, histogram: LatencyHistogram, logger: logging.Logger, interval: float) -> None:
+        with self._lock:
+            self._items[location] = [histogram, logger, interval, time.monotonic()]
+            if interval < self._tick:
+                self._tick = interval
+                self._wakeup.set()
+            if self._thread is None:
+                self._start()
+
+    def _run(self) -> None:
+        thread = self._thread
+        while thread is self._thread:
+            if self._wakeup.wait(self._tick):
+                self._wakeup.clear()
+            self.flush()
+
+    def flush(self, force: bool = False) -> None:
+        now = time.monotonic()
+        with self._lock:
+            items = [(k, v) for k, v in self._items.items() if force or now - v[3] >= v[2]]
+            for _, item in items:
+                item[3] = now
+        for location, (histogram, logger, _, _) in items:
+            data = histogram.snapshot(reset=True)
+            if not data["count"]:
+                continue
+            # 附加的资源使用数据
+            extra = "".join(f" {k}={v:.3f}" for k, v in data.items() if k.endswith(("_sum", "_max")))
+            logger.info(
+                f"{location} count=%d errors=%d min=%.3f p50=%.3f p90=%.3f p99=%.3f max=%.3f{extra}",
+                data["count"],
+                data["errors"],
+                data["min"],
+                data["p50"],
+                data["p90"],
+                data["p99"],
+                data["max"],
+            )
+
+    def snapshot(self) -> typing.Dict[str, typing.Dict]:
+        with self._lock:
+            items = list(self._items.items())
+        return {location: item[0].snapshot() for location, item in items}
+
+
+_reporter = _Reporter()
+fork.register_after_fork(_reporter._after_fork)
+# 进程退出时输出剩余的统计数据
+atexit.register(_reporter.flush, True)
+
+
+def register(location: str, histogram: LatencyHistogram, logger: logging.Logger, interval: float = 60) -> None:
+    """
+    注册直方图，后台线程每隔 interval 秒输出一行统计数据到日志并重置
+
+    Args:
+        location: 名称，一般为函数路径
+        histogram: 直方图
+        logger: 输出统计数据的logger
+        interval: 输出间隔，单位秒(s)
+    """
+    _reporter.register(location, histogram, logger, interval)
+
+
+def flush() -> None:
+    """
+    立即输出所有已注册直方图的统计数据并重置
+    """
+    _reporter.flush(force=True)
+
+
+def snapshot() -> typing.Dict[str, typing.Dict]:
+    """
+    获取所有已注册直方图当前的统计数据（不重置）
+
+    Returns:
+        eg: { location: {"count": 10, "errors": 0, "min": 0.1, "p50": ..., "max": 3.2} }
+
+    """
+    return _reporter.snapshot()
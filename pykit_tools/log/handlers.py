@@ -7,6 +7,8 @@ import typing
 import logging
 from logging.handlers import TimedRotatingFileHandler
 
+from pykit_tools import fork
+
 
 class MultiProcessTimedRotatingFileHandler(TimedRotatingFileHandler):
     """
@@ -26,6 +28,17 @@ class MultiProcessTimedRotatingFileHandler(TimedRotatingFileHandler):
         self.stream: typing.Optional[io.TextIOWrapper] = None  # type: ignore
         if not self.delay:
             self.stream = self._open()
+        # fork前刷新缓冲区，避免子进程重复写入父进程未刷新的日志；fork后子进程重新打开文件
+        fork.register_before_fork(self.flush)
+        fork.register_after_fork(self._after_fork)
+
+    def _after_fork(self) -> None:
+        if self.stream:
+            self.stream.close()
+            self.stream = None
+        self.useFileName = self._compute_fn()
+        if not self.delay:
+            self.stream = self._open()
 
     def _open(self) -> io.TextIOWrapper:
         errors = getattr(self, "errors", None)
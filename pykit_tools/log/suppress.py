@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+# coding=utf-8
+import time
+import typing
+import reprlib
+import threading
+
+from pykit_tools import fork
+
+
+def truncate_repr(value: typing.Any, max_bytes: int = 1024) -> str:
+    """
+    获取对象的repr并截断到指定字节数；先使用 reprlib 限制容器元素数和字符串长度，避免完整格式化超大参数
+
+    Args:
+        value: 对象
+        max_bytes: 最大字节数（utf-8编码），小于等于0时不限制
+
+    Returns:
+        repr字符串，截断时末尾追加 `...(truncated)`
+
+    """
+    if max_bytes <= 0:
+        return repr(value)
+    r = reprlib.Repr()
+    r.maxlevel = 4
+    r.maxstring = r.maxother = r.maxlong = max_bytes
+    r.maxlist = r.maxtuple = r.maxdict = r.maxset = r.maxfrozenset = r.maxdeque = r.maxarray = 32
+    text = r.repr(value)
+    data = text.encode("utf-8")
+    if len(data) <= max_bytes:
+        return text
+    return data[:max_bytes].decode("utf-8", errors="ignore") + "...(truncated)"
+
+
+def exception_signature(e: BaseException, *extra: typing.Hashable) -> typing.Tuple:
+    """
+    计算异常的特征：异常类型和抛出异常的代码位置，不包含异常信息（通常包含id等变化的值）
+
+    Args:
+        e: 异常
+        *extra: 额外的特征，例如函数路径
+
+    Returns:
+        可哈希的元组
+
+    """
+    where: typing.Tuple = ()
+    tb = e.__traceback__
+    if tb is not None:
+        # 直接取最后一帧，不使用 traceback.extract_tb（遍历所有帧并读取源码行）
+        while tb.tb_next is not None:
+            tb = tb.tb_next
+        where = (tb.tb_frame.f_code.co_filename, tb.tb_lineno)
+    return (type(e).__module__, type(e).__qualname__) + where + extra
+
+
+class ErrorDeduplicator(object):
+    """
+    错误日志去重：同一个特征在时间窗口内只输出一次，其余的只计数，
+    下一个窗口第一次输出时带上被忽略的数量
+
+    设置 on_flush 时，窗口内有被忽略的错误后由后台定时器在窗口结束时回调被忽略的数量，
+    错误不再出现（例如故障恢复）时最后一个窗口的数量也不会丢失
+    """
+
+    def __init__(
+        self,
+        window: float = 60,
+        max_entries: int = 1024,
+        on_flush: typing.Optional[typing.Callable[[typing.Hashable, int], None]] = None,
+    ) -> None:
+        """
+        初始化构造对象
+
+        Args:
+            window: 时间窗口，单位秒(s)
+            max_entries: 最多记录的特征数，超过后清理已过期的特征
+            on_flush: 窗口结束时的回调，参数为特征和窗口内被忽略的数量，eg: 输出一行汇总日志
+        """
+        self.window = window
+        self.max_entries = max_entries
+        self.on_flush = on_flush
+        # eg: { signature: [窗口开始时间, 窗口内被忽略的数量] }
+        self._entries: typing.Dict[typing.Hashable, typing.List] = {}
+        self._lock = threading.Lock()
+        self._timer: typing.Optional[threading.Timer] = None
+        fork.register_after_fork(self._after_fork)
+
+    def _after_fork(self) -> None:
+        # 定时器线程不会被fork到子进程中；父进程的计数由父进程输出，子进程重新计数
+        self._lock = threading.Lock()
+        self._timer = None
+        self._entries = {}
+
+    def _schedule(self, delay: float) -> None:
+        # 调用方持有锁；同一时间最多一个定时器
+        if self.on_flush is None or self._timer is not None:
+            return
+        self._timer = threading.Timer(max(delay, 0.0), self._on_timer)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def _on_timer(self) -> None:
+        with self._lock:
+            self._timer = None
+        self.flush()
+        now = time.monotonic()
+        with self._lock:
+            # 还有未结束的窗口内有被忽略的错误，在最早结束的窗口结束时再次执行
+            starts = [v[0] for v in self._entries.values() if v[1]]
+            if starts:
+                self._schedule(min(starts) + self.window - now)
+
+    def flush(self) -> typing.Dict[typing.Hashable, int]:
+        """
+        移除已结束的窗口，返回并回调 on_flush 窗口内被忽略的数量
+
+        Returns:
+            eg: { signature: 被忽略的数量 }，只包含数量大于0的特征
+
+        """
+        now = time.monotonic()
+        with self._lock:
+            expired = [k for k, v in self._entries.items() if now - v[0] >= self.window]
+            result = {k: self._entries.pop(k)[1] for k in expired}
+        result = {k: v for k, v in result.items() if v}
+        if self.on_flush is not None:
+            for signature, suppressed in result.items():
+                self.on_flush(signature, suppressed)
+        return result
+
+    def check(self, signature: typing.Hashable) -> typing.Optional[int]:
+        """
+        判断是否需要输出日志
+
+        Args:
+            signature: 错误特征，eg: [exception_signature](./#log.suppress.exception_signature) 的结果
+
+        Returns:
+            None表示窗口内已输出过，需要忽略；否则为上一个窗口内被忽略的数量
+
+        """
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(signature)
+            if entry is not None and now - entry[0] < self.window:
+                entry[1] += 1
+                if entry[1] == 1:
+                    self._schedule(entry[0] + self.window - now)
+                return None
+            if entry is None and len(self._entries) >= self.max_entries:
+                self._entries = {k: v for k, v in self._entries.items() if now - v[0] < self.window}
+                if len(self._entries) >= self.max_entries:
+                    self._entries.clear()
+            self._entries[signature] = [now, 0]
+            return entry[1] if entry is not None else 0
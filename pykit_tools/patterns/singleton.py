@@ -1,31 +1,247 @@
 #!/usr/bin/env python
 # coding=utf-8
 import typing
+import weakref
+import threading
+import collections
 
-from pykit_tools import str_tool, utils
+from pykit_tools import str_tool, utils, fork
+
+
+_MISSING = object()
+
+
+def _instance_key(cls: type, args: typing.Tuple, kwargs: typing.Dict) -> typing.Hashable:
+    """
+    计算实例的唯一key：无参数时直接使用类本身；参数可哈希时使用带参数类型的元组（避免 1/True/1.0 相等被合并），
+    参数不可哈希或者为元组等容器（元素类型无法区分）时回退为md5字符串
+    """
+    if not args and not kwargs:
+        return cls
+    values = list(args) + list(kwargs.values())
+    if any(isinstance(v, (tuple, frozenset)) for v in values):
+        return str_tool.compute_md5(utils.get_caller_location(cls), *args, **kwargs)
+    key: typing.Tuple = (cls, tuple((type(a), a) for a in args))
+    if kwargs:
+        key += (tuple((k, type(v), v) for k, v in sorted(kwargs.items())),)
+    try:
+        hash(key)
+    except TypeError:
+        return str_tool.compute_md5(utils.get_caller_location(cls), *args, **kwargs)
+    return key
+
+
+class StrongRegistry(object):
+    """
+    单例实例注册表：强引用保存所有实例，实例不会被回收（默认策略）
+    """
+
+    def __init__(self, on_evict: typing.Optional[typing.Callable] = None) -> None:
+        """
+        初始化构造对象
+
+        Args:
+            on_evict: 实例被移除时的回调函数，参数为实例，eg: `lambda ins: ins.close()`
+        """
+        self.on_evict = on_evict
+        self._data: typing.MutableMapping = {}
+
+    def _evict(self, values: typing.Iterable) -> None:
+        if self.on_evict is None:
+            return
+        for value in values:
+            self.on_evict(value)
+
+    def get(self, key: typing.Hashable, default: typing.Any = None) -> typing.Any:
+        """
+        根据key获取实例，不存在时返回default
+        """
+        return self._data.get(key, default)
+
+    def set(self, key: typing.Hashable, value: typing.Any) -> None:
+        """
+        保存实例
+        """
+        self._data[key] = value
+
+    def values(self) -> typing.List:
+        """
+        获取所有实例
+        """
+        return list(self._data.values())
+
+    def clear(self) -> None:
+        """
+        移除所有实例，会对每个实例调用 on_evict
+        """
+        values = self.values()
+        self._data.clear()
+        self._evict(values)
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+class WeakRegistry(StrongRegistry):
+    """
+    单例实例注册表：弱引用保存实例，实例不再被使用后会被回收，下次调用重新构建
+    """
+
+    def __init__(self, on_evict: typing.Optional[typing.Callable] = None) -> None:
+        super(WeakRegistry, self).__init__(on_evict=on_evict)
+        self._data = weakref.WeakValueDictionary()
+
+
+class LRURegistry(StrongRegistry):
+    """
+    单例实例注册表：最多保存 capacity 个实例，超过后移除最久未使用的实例
+    """
+
+    def __init__(self, capacity: int = 128, on_evict: typing.Optional[typing.Callable] = None) -> None:
+        """
+        初始化构造对象
+
+        Args:
+            capacity: 最多保存的实例数量
+            on_evict: 实例被移除时的回调函数，参数为实例，eg: `lambda ins: ins.close()`
+        """
+        super(LRURegistry, self).__init__(on_evict=on_evict)
+        self.capacity = capacity
+        self._data: collections.OrderedDict = collections.OrderedDict()
+        self._lock = threading.Lock()
+        fork.register_after_fork(self._after_fork)
+
+    def _after_fork(self) -> None:
+        self._lock = threading.Lock()
+
+    def get(self, key: typing.Hashable, default: typing.Any = None) -> typing.Any:
+        with self._lock:
+            value = self._data.get(key, _MISSING)
+            if value is _MISSING:
+                return default
+            self._data.move_to_end(key)
+        return value
+
+    def set(self, key: typing.Hashable, value: typing.Any) -> None:
+        evicted = []
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.capacity:
+                evicted.append(self._data.popitem(last=False)[1])
+        self._evict(evicted)
+
+    def values(self) -> typing.List:
+        with self._lock:
+            return list(self._data.values())
+
+    def clear(self) -> None:
+        with self._lock:
+            values = list(self._data.values())
+            self._data.clear()
+        self._evict(values)
 
 
 class SingletonMeta(type):
     """
     设计模式：单例类
 
+    线程安全：同一个key并发实例化时只会构建一次（双重检查+每个key一把锁）；
+    实例已存在时直接从注册表中获取，不需要加锁
+
+    每个类使用单独的注册表，可通过类属性 `singleton_registry` 指定注册表的构造函数：
+
+    - `StrongRegistry` 默认，强引用保存所有实例
+    - `WeakRegistry` 弱引用保存实例，实例不再被使用后会被回收
+    - `LRURegistry` 最多保存指定数量的实例，可设置移除实例时的回调函数
+
+    通过类属性 `singleton_fork_policy` 设置fork后子进程中对已构建实例的处理策略 [ForkPolicy](./#fork.ForkPolicy)，
+    持有socket连接等不能跨进程共享的实例可设置为 `drop`
+
     eg: 示例
         ```python
         class YouClass(metaclass=SingletonMeta)
             pass
+
+        class TenantClient(Singleton):
+            # 按租户构建实例，最多保留100个，移除时关闭连接
+            singleton_registry = functools.partial(LRURegistry, capacity=100, on_evict=lambda c: c.close())
+
+            def __init__(self, tenant_id):
+                ...
         ```
     """
 
-    _instances: dict = {}
+    singleton_registry: typing.Callable[[], StrongRegistry] = StrongRegistry
+    singleton_fork_policy: str = fork.ForkPolicy.KEEP.value
+
+    def __init__(cls, *args: typing.Any, **kwargs: typing.Any) -> None:
+        super(SingletonMeta, cls).__init__(*args, **kwargs)
+        if cls.singleton_fork_policy not in fork.ForkPolicy:
+            raise TypeError(f"singleton_fork_policy={cls.singleton_fork_policy} not supported")
+        # 每个类单独的注册表和锁，子类不共享
+        cls._singleton_instances = cls.singleton_registry()
+        cls._singleton_lock = threading.Lock()
+        # 正在构建实例的key的锁
+        cls._singleton_key_locks: typing.Dict = {}
+        fork.register_after_fork(cls._singleton_after_fork)
+
+    def _singleton_after_fork(cls) -> None:
+        cls._singleton_lock = threading.Lock()
+        cls._singleton_key_locks = {}
+        if cls.singleton_fork_policy == fork.ForkPolicy.DROP.value:
+            # 直接丢弃，不调用 on_evict，避免关闭父进程仍在使用的连接
+            cls._singleton_instances = cls.singleton_registry()
 
     def __call__(cls, *args: typing.Any, **kwargs: typing.Any) -> typing.Any:
-        _key = str_tool.compute_md5(utils.get_caller_location(cls), *args, **kwargs)
-        if _key not in cls._instances:
-            cls._instances[_key] = super(SingletonMeta, cls).__call__(*args, **kwargs)
-        return cls._instances[_key]
+        _key = _instance_key(cls, args, kwargs)
+        registry = cls._singleton_instances
+        ins = registry.get(_key, _MISSING)
+        if ins is not _MISSING:
+            return ins
+
+        with cls._singleton_lock:
+            key_lock = cls._singleton_key_locks.setdefault(_key, threading.Lock())
+        try:
+            with key_lock:
+                ins = registry.get(_key, _MISSING)
+                if ins is _MISSING:
+                    ins = super(SingletonMeta, cls).__call__(*args, **kwargs)
+                    registry.set(_key, ins)
+        finally:
+            # 实例已写入（或构建失败），等待中的线程会读取到实例，可以移除该key的锁
+            with cls._singleton_lock:
+                if cls._singleton_key_locks.get(_key) is key_lock:
+                    del cls._singleton_key_locks[_key]
+        return ins
 
 
 class Singleton(metaclass=SingletonMeta):
     """可以提供给类直接继承"""
 
     pass
+
+
+def instances_of(cls: SingletonMeta) -> typing.List:
+    """
+    获取单例类已构建的所有实例（不包含子类的实例）
+
+    Args:
+        cls: 单例类
+
+    Returns:
+        实例列表
+
+    """
+    return cls._singleton_instances.values()
+
+
+def reset(cls: SingletonMeta) -> None:
+    """
+    移除单例类已构建的所有实例，下次调用时重新构建；会对每个实例调用注册表的 on_evict
+
+    Args:
+        cls: 单例类
+
+    """
+    cls._singleton_instances.clear()
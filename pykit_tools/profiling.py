@@ -0,0 +1,253 @@
+#!/usr/bin/env python
+# coding=utf-8
+import io
+import os
+import re
+import time
+import typing
+import pstats
+import cProfile
+import logging
+import itertools
+import threading
+import tracemalloc
+from functools import wraps
+
+from py_enum import ChoiceEnum
+
+from pykit_tools import fork
+
+
+class ProfileFormat(ChoiceEnum):
+    """
+    `枚举` 性能分析结果的输出格式，定义值详见源码。
+
+    应用于 [CallProfiler](./#profiling.CallProfiler)
+    """
+
+    TEXT = ("text", "按累计耗时排序的前 top 个函数的文本，开启内存分析时追加峰值内存和分配最多的代码行")
+    # 可通过 `python -m pstats` 或 snakeviz 等工具查看；开启内存分析时内存数据另外输出到同名的 .memory.txt 文件
+    PSTATS = ("pstats", "cProfile 的原始数据 .pstats 文件")
+
+
+# 同一时间只进行一个分析，cProfile 不能同时开启多个，tracemalloc 是全局的
+_capture_lock = threading.Lock()
+
+
+def _after_fork() -> None:
+    global _capture_lock
+    _capture_lock = threading.Lock()
+
+
+fork.register_after_fork(_after_fork)
+
+# python3.9 开始支持，不支持时只有本次分析开启的 tracemalloc 才能得到调用期间的峰值内存
+_reset_peak: typing.Optional[typing.Callable[[], None]] = getattr(tracemalloc, "reset_peak", None)
+
+
+class CallProfiler(object):
+    """
+    函数调用的性能分析：每 every 次调用分析1次，或者在出现慢调用后分析下一次调用，
+    使用 cProfile 记录函数耗时，可选使用 tracemalloc 记录峰值内存和分配最多的代码行
+
+    两次分析的间隔不小于 min_interval 秒，输出目录中最多保留 max_files 个文件，超过时删除最早的文件
+
+    ```python
+    profiler = CallProfiler("/data/profiles", every=10000, slow_ms=500, memory=True)
+
+    @time_record(profiler=profiler)
+    def handle(request):
+        ...
+    ```
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        every: int = 0,
+        slow_ms: typing.Optional[float] = None,
+        output: str = ProfileFormat.TEXT.value,
+        top: int = 30,
+        memory: bool = False,
+        min_interval: float = 60,
+        max_files: int = 50,
+    ) -> None:
+        """
+        初始化构造对象
+
+        Args:
+            directory: 输出目录，不存在时自动创建；建议使用单独的目录，轮转时会删除其中最早的分析结果文件
+            every: 每多少次调用分析1次，默认0不按次数分析
+            slow_ms: 慢调用的耗时阈值，单位毫秒(ms)；慢调用结束后才能判断，所以分析的是其后的下一次调用
+            output: 输出格式 [ProfileFormat](./#profiling.ProfileFormat)
+            top: 输出的函数数和内存分配的代码行数
+            memory: 是否使用 tracemalloc 分析内存，开启期间所有线程的内存分配都会变慢
+            min_interval: 两次分析的最小间隔，单位秒(s)，限制分析带来的额外开销
+            max_files: 输出目录中最多保留的文件数
+        """
+        if output not in ProfileFormat:
+            raise TypeError(f"output={output} not supported")
+        self.directory = directory
+        self.every = every
+        self.slow_ms = slow_ms
+        self.output = output
+        self.top = top
+        self.memory = memory
+        self.min_interval = min_interval
+        self.max_files = max_files
+        self._counter = itertools.count(1)
+        self._armed = False
+        self._last: typing.Optional[float] = None
+        self._captures = 0
+        self._skipped = 0
+
+    def _due(self) -> bool:
+        if self._armed or (self.every and not next(self._counter) % self.every):
+            now = time.monotonic()
+            if self._last is not None and now - self._last < self.min_interval:
+                self._armed = False
+                self._skipped += 1
+                return False
+            return True
+        return False
+
+    def wrap(self, fn: typing.Callable, name: str) -> typing.Callable:
+        """
+        包装函数，满足条件的调用进行分析；一般通过 time_record(profiler=...) 使用
+
+        Args:
+            fn: 函数，不支持 async 函数（await 期间会记录到其他任务的调用）
+            name: 名称，用于输出文件名，一般为函数路径
+
+        Returns:
+            function
+
+        """
+
+        @wraps(fn)
+        def _wrapper(*args: typing.Any, **kwargs: typing.Any) -> typing.Any:
+            if self._due() and _capture_lock.acquire(blocking=False):
+                try:
+                    return self._capture(name, fn, args, kwargs)
+                finally:
+                    _capture_lock.release()
+            if self.slow_ms is None:
+                return fn(*args, **kwargs)
+            start = time.monotonic()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                if (time.monotonic() - start) * 1000 >= self.slow_ms:
+                    self._armed = True
+
+        return _wrapper
+
+    def _capture(self, name: str, fn: typing.Callable, args: typing.Tuple, kwargs: typing.Dict) -> typing.Any:
+        self._armed = False
+        self._last = time.monotonic()
+        # 在 cProfile 开启前准备内存分析，tracemalloc 的调用不记录到分析结果中
+        started = False
+        if self.memory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                started = True
+            elif _reset_peak is not None:
+                _reset_peak()
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # 已开启了其他的分析工具
+            if started:
+                tracemalloc.stop()
+            self._skipped += 1
+            return fn(*args, **kwargs)
+        self._captures += 1
+        error: typing.Optional[BaseException] = None
+        start = time.monotonic()
+        try:
+            return fn(*args, **kwargs)
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            cost_ms = (time.monotonic() - start) * 1000
+            profile.disable()
+            snapshot: typing.Optional[tracemalloc.Snapshot] = None
+            peak: typing.Optional[int] = None
+            if self.memory:
+                if started or _reset_peak is not None:
+                    peak = tracemalloc.get_traced_memory()[1]
+                snapshot = tracemalloc.take_snapshot()
+                if started:
+                    tracemalloc.stop()
+            try:
+                self._write(name, profile, cost_ms, error, snapshot, peak)
+            except Exception:
+                logging.getLogger("pykit_tools.error").exception("pykit_tools profile %s write error", name)
+
+    def _header(self, name: str, cost_ms: float, error: typing.Optional[BaseException]) -> str:
+        when = time.strftime("%Y-%m-%d %H:%M:%S")
+        return f"{name} {when} pid={os.getpid()} cost={cost_ms:.3f}ms error={error!r}\n\n"
+
+    def _memory_text(self, snapshot: tracemalloc.Snapshot, peak: typing.Optional[int]) -> str:
+        snapshot = snapshot.filter_traces((tracemalloc.Filter(False, tracemalloc.__file__),))
+        # 无法得到调用期间的峰值内存时不输出
+        head = f"memory peak={peak / 1024:.1f}KiB, " if peak is not None else "memory "
+        lines = [f"{head}top {self.top} lines still allocated:"]
+        for stat in snapshot.statistics("lineno")[: self.top]:
+            frame = stat.traceback[0]
+            lines.append(f"{stat.size / 1024:10.1f}KiB {stat.count:8d} {frame.filename}:{frame.lineno}")
+        return "\n".join(lines) + "\n"
+
+    def _write(
+        self,
+        name: str,
+        profile: cProfile.Profile,
+        cost_ms: float,
+        error: typing.Optional[BaseException],
+        snapshot: typing.Optional[tracemalloc.Snapshot],
+        peak: typing.Optional[int],
+    ) -> None:
+        os.makedirs(self.directory, exist_ok=True)
+        safe_name = re.sub(r"[^\w.-]+", "_", name)
+        prefix = os.path.join(self.directory, f"{safe_name}-{time.strftime('%Y%m%d%H%M%S')}-{os.getpid()}")
+        prefix = f"{prefix}-{self._captures}"
+        header = self._header(name, cost_ms, error)
+        if self.output == ProfileFormat.PSTATS.value:
+            profile.dump_stats(f"{prefix}.pstats")
+            if snapshot is not None:
+                with open(f"{prefix}.memory.txt", "w", encoding="utf-8") as f:
+                    f.write(header + self._memory_text(snapshot, peak))
+        else:
+            stream = io.StringIO()
+            stream.write(header)
+            pstats.Stats(profile, stream=stream).sort_stats("cumulative").print_stats(self.top)
+            if snapshot is not None:
+                stream.write(self._memory_text(snapshot, peak))
+            with open(f"{prefix}.txt", "w", encoding="utf-8") as f:
+                f.write(stream.getvalue())
+        self._rotate()
+
+    def _rotate(self) -> None:
+        # 只处理分析结果文件，按修改时间删除最早的文件
+        paths = [os.path.join(self.directory, n) for n in os.listdir(self.directory) if n.endswith((".pstats", ".txt"))]
+        if len(paths) <= self.max_files:
+            return
+        paths.sort(key=os.path.getmtime)
+        for path in paths[: len(paths) - self.max_files]:
+            try:
+                os.remove(path)
+            except OSError:
+                # 多进程同时轮转
+                pass
+
+    def stats(self) -> typing.Dict[str, typing.Any]:
+        """
+        获取统计数据
+
+        Returns:
+            分析次数 captures，因间隔限制跳过的次数 skipped
+
+        """
+        return {"captures": self._captures, "skipped": self._skipped}
@@ -0,0 +1,295 @@
+#!/usr/bin/env python
+# coding=utf-8
+import time
+import bisect
+import struct
+import typing
+import hashlib
+import threading
+
+from pykit_tools import fork
+
+
+def build_redis_client(conf: typing.Union[typing.Dict, typing.List, typing.Tuple]) -> typing.Any:
+    """
+    根据配置构建redis客户端，配置格式同 `settings.APP_CACHE_REDIS`
+
+    Args:
+        conf: 单个redis连接配置(dict)，返回 `redis.StrictRedis`；
+            多个节点的配置列表(list)，返回基于一致性哈希的 [RedisRingClient](./#redis_tool.RedisRingClient)
+
+    Returns:
+        redis client
+
+    """
+    if isinstance(conf, (list, tuple)):
+        return RedisRingClient(conf)
+
+    import redis  # type: ignore
+
+    pool = redis.ConnectionPool(encoding="utf-8", decode_responses=True, **conf)
+    # fork后子进程不能使用父进程的连接
+    fork.register_after_fork(pool.reset)
+    return redis.StrictRedis(connection_pool=pool)
+
+
+class HashRing(object):
+    """
+    一致性哈希环，每个节点会映射为多个虚拟节点，使key分布更均匀；
+    增删节点时只会影响相邻虚拟节点上的key
+    """
+
+    def __init__(self, nodes: typing.Iterable[str], replicas: int = 160) -> None:
+        """
+        初始化构造对象
+
+        Args:
+            nodes: 节点名称列表
+            replicas: 每个节点的虚拟节点数，需是4的倍数（每个md5值拆分成4个点）
+        """
+        self.nodes: typing.List[str] = list(nodes)
+        self.replicas = replicas
+        self._points: typing.List[int] = []
+        self._point_nodes: typing.List[str] = []
+        self._build()
+
+    def _build(self) -> None:
+        ring: typing.List[typing.Tuple[int, str]] = []
+        for node in self.nodes:
+            for i in range(self.replicas // 4):
+                digest = hashlib.md5(f"{node}-{i}".encode("utf-8")).digest()
+                for point in struct.unpack("<4I", digest):
+                    ring.append((point, node))
+        ring.sort()
+        self._points = [p for p, _ in ring]
+        self._point_nodes = [n for _, n in ring]
+
+    @staticmethod
+    def _hash(key: str) -> int:
+        digest = hashlib.md5(key.encode("utf-8")).digest()
+        return int.from_bytes(digest[:4], "little")
+
+    def get_node(self, key: str, skip: typing.Optional[typing.Container[str]] = None) -> typing.Optional[str]:
+        """
+        获取key所在的节点
+
+        Args:
+            key: 键
+            skip: 需要跳过的节点，沿哈希环顺时针查找下一个节点
+
+        Returns:
+            节点名称，没有可用节点时返回None
+
+        """
+        if not self._points:
+            return None
+        idx = bisect.bisect(self._points, self._hash(key))
+        total = len(self._points)
+        for i in range(total):
+            node = self._point_nodes[(idx + i) % total]
+            if not skip or node not in skip:
+                return node
+        return None
+
+
+class RedisRingClient(object):
+    """
+    基于一致性哈希的多节点redis客户端，不依赖Redis Cluster即可水平扩展缓存
+
+    - 按key路由到节点，节点连接异常时会被标记为不可用，key临时路由到哈希环上的下一个节点，
+      `retry_interval` 秒后再重新尝试该节点
+    - 批量操作按节点分组，每个节点使用一次pipeline完成
+
+    eg: 示例
+        ```python
+        # settings.py
+        APP_CACHE_REDIS = [
+            {"host": "10.0.0.1", "port": 6379, "db": 0, "socket_timeout": 1},
+            {"host": "10.0.0.2", "port": 6379, "db": 0, "socket_timeout": 1},
+        ]
+        ```
+    """
+
+    def __init__(
+        self,
+        nodes: typing.Union[typing.List[typing.Dict], typing.Tuple[typing.Dict, ...]],
+        replicas: int = 160,
+        retry_interval: float = 30,
+    ) -> None:
+        """
+        初始化构造对象
+
+        Args:
+            nodes: 节点连接配置列表，同 redis.ConnectionPool 参数；可额外传递 name 作为节点名称（默认 host:port/db）
+            replicas: 每个节点的虚拟节点数
+            retry_interval: 节点被标记不可用后，重试该节点的间隔，单位秒(s)
+        """
+        import redis  # type: ignore
+
+        if not nodes:
+            raise ValueError("nodes must not be empty")
+        self.retry_interval = retry_interval
+        self.clients: typing.Dict[str, typing.Any] = {}
+        for conf in nodes:
+            conf = dict(conf)
+            name = (
+                conf.pop("name", None)
+                or f"{conf.get('host', 'localhost')}:{conf.get('port', 6379)}/{conf.get('db', 0)}"
+            )
+            if name in self.clients:
+                raise ValueError(f"duplicate node {name}")
+            pool = redis.ConnectionPool(encoding="utf-8", decode_responses=True, **conf)
+            self.clients[name] = redis.StrictRedis(connection_pool=pool)
+        self.ring = HashRing(self.clients.keys(), replicas=replicas)
+        # 不可用的节点, eg: { name: retry_at }
+        self._down: typing.Dict[str, float] = {}
+        self._lock = threading.Lock()
+        self._errors = (redis.ConnectionError, redis.TimeoutError)
+        fork.register_after_fork(self._after_fork)
+
+    def _after_fork(self) -> None:
+        # fork后子进程不能使用父进程的连接，其他线程可能持有锁
+        self._lock = threading.Lock()
+        for client in self.clients.values():
+            client.connection_pool.reset()
+
+    def _down_nodes(self) -> typing.Set[str]:
+        if not self._down:
+            return set()
+        now = time.time()
+        with self._lock:
+            for name, retry_at in list(self._down.items()):
+                if retry_at <= now:
+                    # 到达重试时间，重新启用
+                    self._down.pop(name, None)
+            return set(self._down)
+
+    def mark_down(self, name: str) -> None:
+        """
+        标记节点不可用
+
+        Args:
+            name: 节点名称
+        """
+        with self._lock:
+            self._down[name] = time.time() + self.retry_interval
+
+    def get_node(self, key: str) -> str:
+        """
+        获取key所在的可用节点
+
+        Args:
+            key: 键
+
+        Returns:
+            节点名称
+
+        Raises:
+            redis.ConnectionError: 所有节点都不可用
+
+        """
+        name = self.ring.get_node(key, skip=self._down_nodes())
+        if name is None:
+            raise self._errors[0]("all redis nodes are marked down")
+        return name
+
+    def get_client(self, key: str) -> typing.Any:
+        """
+        获取key所在节点的 redis.StrictRedis 客户端，可用于执行未封装的命令
+
+        Args:
+            key: 键
+
+        Returns:
+            redis client
+
+        """
+        return self.clients[self.get_node(key)]
+
+    def _execute(self, name: str, method: str, *args: typing.Any, **kwargs: typing.Any) -> typing.Any:
+        try:
+            return getattr(self.clients[name], method)(*args, **kwargs)
+        except self._errors:
+            self.mark_down(name)
+            raise
+
+    def _group(self, keys: typing.Iterable[str]) -> typing.Dict[str, typing.List[str]]:
+        skip = self._down_nodes()
+        groups: typing.Dict[str, typing.List[str]] = {}
+        for key in keys:
+            name = self.ring.get_node(key, skip=skip)
+            if name is None:
+                raise self._errors[0]("all redis nodes are marked down")
+            groups.setdefault(name, []).append(key)
+        return groups
+
+    def _pipeline(self, name: str, fill: typing.Callable[[typing.Any], typing.Any]) -> typing.List:
+        try:
+            pipe = self.clients[name].pipeline(transaction=False)
+            fill(pipe)
+            return pipe.execute()
+        except self._errors:
+            self.mark_down(name)
+            raise
+
+    def get(self, name: str) -> typing.Any:
+        """
+        同 redis.StrictRedis.get
+        """
+        return self._execute(self.get_node(name), "get", name)
+
+    def set(self, name: str, value: typing.Any, ex: typing.Any = None, **kwargs: typing.Any) -> typing.Any:
+        """
+        同 redis.StrictRedis.set
+        """
+        return self._execute(self.get_node(name), "set", name, value, ex=ex, **kwargs)
+
+    def delete(self, *names: str) -> int:
+        """
+        同 redis.StrictRedis.delete，多个key时按节点分组删除
+        """
+        count = 0
+        for node, keys in self._group(names).items():
+            count += self._execute(node, "delete", *keys)
+        return count
+
+    def get_many(self, keys: typing.List[str]) -> typing.List:
+        """
+        批量获取数据，按节点分组后使用pipeline获取
+
+        Args:
+            keys: 键列表
+
+        Returns:
+            与keys顺序一致的值列表，不存在的key为None
+
+        """
+        result: typing.Dict[str, typing.Any] = {}
+        for node, _keys in self._group(keys).items():
+            values = self._pipeline(node, lambda pipe: [pipe.get(k) for k in _keys])
+            result.update(zip(_keys, values))
+        return [result.get(k) for k in keys]
+
+    def set_many(self, mapping: typing.Dict[str, typing.Any], timeout: typing.Any = None) -> None:
+        """
+        批量设置数据，按节点分组后使用pipeline设置
+
+        Args:
+            mapping: 键值对
+            timeout: 超时时间，单位秒(s)
+        """
+        for node, _keys in self._group(mapping.keys()).items():
+            self._pipeline(node, lambda pipe: [pipe.set(k, mapping[k], ex=timeout) for k in _keys])
+
+    def delete_many(self, keys: typing.List[str]) -> int:
+        """
+        批量删除数据
+
+        Args:
+            keys: 键列表
+
+        Returns:
+            删除的数量
+
+        """
+        return self.delete(*keys)
@@ -0,0 +1,405 @@
+#!/usr/bin/env python
+# coding=utf-8
+import os
+import json
+import time
+import random
+import typing
+import inspect
+import logging
+import threading
+import contextlib
+from functools import wraps, partial
+
+from pykit_tools import fork
+from pykit_tools.utils import get_caller_location
+
+try:
+    import contextvars
+except ImportError:  # pragma: no cover
+    # python3.6 没有 contextvars，无法传递当前调用，不记录调用树
+    contextvars = None  # type: ignore
+
+
+class Span(object):
+    """
+    一次调用的耗时记录；通过 contextvars 传递当前调用，同一线程及其创建的 asyncio 任务中的调用自动成为子调用
+    """
+
+    __slots__ = (
+        "name",
+        "trace_id",
+        "span_id",
+        "parent",
+        "start",
+        "timestamp",
+        "thread_id",
+        "total",
+        "child_total",
+        "error",
+        "attrs",
+        "children",
+        "dropped",
+    )
+
+    def __init__(self, name: str, parent: typing.Optional["Span"] = None, **attrs: typing.Any) -> None:
+        self.name = name
+        self.parent = parent
+        self.trace_id: str = parent.trace_id if parent is not None else "%016x" % random.getrandbits(64)
+        self.span_id = "%08x" % random.getrandbits(32)
+        self.start = time.monotonic()
+        # 开始时间的时间戳，单位秒(s)
+        self.timestamp = time.time()
+        self.thread_id = threading.get_ident()
+        self.total: typing.Optional[float] = None
+        self.child_total = 0.0
+        self.error: typing.Optional[str] = None
+        self.attrs = attrs
+        self.children: typing.List[Span] = []
+        # 超过 max_children 未记录的子调用数
+        self.dropped = 0
+
+    @property
+    def self_time(self) -> float:
+        """
+        自身耗时（总耗时减去子调用的耗时），单位秒(s)；并发执行的子调用耗时之和可能超过总耗时，此时为0
+        """
+        return max(0.0, (self.total or 0.0) - self.child_total)
+
+    def to_dict(self) -> typing.Dict[str, typing.Any]:
+        """
+        转换为调用树的结构化数据
+
+        Returns:
+            eg: {"trace_id": "..", "span_id": "..", "parent_id": None, "name": "a.b", "timestamp": 1700000000.0,
+                 "total_ms": 3.2, "self_ms": 1.1, "error": None, "children": [...]}
+
+        """
+        data: typing.Dict[str, typing.Any] = {
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent.span_id if self.parent is not None else None,
+            "name": self.name,
+            "timestamp": self.timestamp,
+            "thread_id": self.thread_id,
+            "total_ms": round((self.total or 0.0) * 1000, 3),
+            "self_ms": round(self.self_time * 1000, 3),
+            "error": self.error,
+        }
+        if self.attrs:
+            data["attrs"] = self.attrs
+        if self.dropped:
+            data["dropped"] = self.dropped
+        data["children"] = [child.to_dict() for child in list(self.children)]
+        return data
+
+
+class LoggerSink(object):
+    """
+    默认的输出：每个调用树以一行json输出到日志
+    """
+
+    def __init__(self, logger_name: str = "pykit_tools.trace", logger_level: int = logging.INFO) -> None:
+        self.logger_name = logger_name
+        self.logger_level = logger_level
+
+    def __call__(self, record: typing.Dict[str, typing.Any]) -> None:
+        logger = logging.getLogger(self.logger_name)
+        if logger.isEnabledFor(self.logger_level):
+            logger.log(self.logger_level, "%s", json.dumps(record, ensure_ascii=False, default=str))
+
+
+class ChromeTraceSink(object):
+    """
+    以 Chrome Trace Event Format 输出调用树，可以直接在 Perfetto(https://ui.perfetto.dev) 或 chrome://tracing 中打开查看
+
+    每个调用输出一对开始/结束事件(B/E)，带进程号pid和线程号tid；文件为流式写入的json数组（不写结尾的 `]`，查看工具可以直接打开），
+    超过 max_bytes 时按 `path.1`、`path.2` ... 轮转
+
+    同一线程中并发执行的 asyncio 子调用时间上有重叠，查看时可能显示为错位的层级
+    """
+
+    def __init__(self, path: str, max_bytes: int = 100 * 1024 * 1024, backup_count: int = 5) -> None:
+        """
+        初始化构造对象
+
+        Args:
+            path: 文件路径，支持 `{pid}` 占位符，多进程使用时每个进程写入各自的文件，eg: /tmp/trace.{pid}.json
+            max_bytes: 单个文件的最大字节数，小于等于0时不轮转
+            backup_count: 轮转保留的文件数
+        """
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self._stream: typing.Optional[typing.TextIO] = None
+        self._filename = ""
+        self._size = 0
+        # 已输出线程名称的线程
+        self._threads: typing.Set[int] = set()
+        self._lock = threading.Lock()
+        fork.register_before_fork(self.flush)
+        fork.register_after_fork(self._after_fork)
+
+    def _after_fork(self) -> None:
+        # 子进程重新打开文件，路径中的pid随之变化
+        self._lock = threading.Lock()
+        if self._stream is not None:
+            self._stream.close()
+            self._stream = None
+
+    def _open(self) -> typing.TextIO:
+        self._filename = self.path.format(pid=os.getpid())
+        stream = open(self._filename, "a", encoding="utf-8")
+        self._size = stream.tell()
+        self._threads = set()
+        if not self._size:
+            self._write(stream, "[\n")
+        return stream
+
+    def _write(self, stream: typing.TextIO, data: str) -> None:
+        stream.write(data)
+        self._size += len(data.encode("utf-8"))
+
+    def _rotate(self) -> None:
+        typing.cast(typing.TextIO, self._stream).close()
+        self._stream = None
+        if self.backup_count > 0:
+            for i in range(self.backup_count - 1, 0, -1):
+                source = f"{self._filename}.{i}"
+                if os.path.exists(source):
+                    os.replace(source, f"{self._filename}.{i + 1}")
+            os.replace(self._filename, f"{self._filename}.1")
+        else:
+            os.remove(self._filename)
+
+    def _events(self, record: typing.Dict[str, typing.Any], pid: int) -> typing.Iterator[typing.Dict[str, typing.Any]]:
+        # 先序遍历：父调用的开始事件在子调用之前，结束事件在子调用之后
+        begin = int(record["timestamp"] * 1000000)
+        args = {"self_ms": record["self_ms"]}
+        args.update(record.get("attrs") or {})
+        if record["error"]:
+            args["error"] = record["error"]
+        tid = record["thread_id"]
+        yield {"name": record["name"], "ph": "B", "ts": begin, "pid": pid, "tid": tid, "args": args}
+        for child in record["children"]:
+            yield from self._events(child, pid)
+        end = begin + int(record["total_ms"] * 1000)
+        yield {"name": record["name"], "ph": "E", "ts": end, "pid": pid, "tid": tid}
+
+    def __call__(self, record: typing.Dict[str, typing.Any]) -> None:
+        pid = os.getpid()
+        events = list(self._events(record, pid))
+        with self._lock:
+            if self._stream is not None and self.max_bytes > 0 and self._size >= self.max_bytes:
+                self._rotate()
+            if self._stream is None:
+                self._stream = self._open()
+            stream = self._stream
+            tids = {e["tid"] for e in events} - self._threads
+            if tids:
+                # 线程名称的元数据事件，每个文件只输出一次
+                names = {t.ident: t.name for t in threading.enumerate()}
+                for tid in tids:
+                    name = names.get(tid, str(tid))
+                    events.insert(0, {"name": "thread_name", "ph": "M", "pid": pid, "tid": tid, "args": {"name": name}})
+                self._threads.update(tids)
+            data = "".join(
+                json.dumps(e, ensure_ascii=False, default=str, separators=(",", ":")) + ",\n" for e in events
+            )
+            self._write(stream, data)
+            stream.flush()
+
+    def flush(self) -> None:
+        with self._lock:
+            if self._stream is not None:
+                self._stream.flush()
+
+    def close(self) -> None:
+        """
+        关闭文件
+        """
+        with self._lock:
+            if self._stream is not None:
+                self._stream.close()
+                self._stream = None
+
+
+_current_span: "contextvars.ContextVar[typing.Optional[Span]]" = (
+    contextvars.ContextVar("pykit_tools_span", default=None) if contextvars is not None else None  # type: ignore
+)
+_sink: typing.Callable[[typing.Dict[str, typing.Any]], typing.Any] = LoggerSink()
+_lock = threading.Lock()
+# 每个调用最多记录的子调用数，避免循环中的调用占用过多内存
+max_children = 256
+
+
+def set_sink(sink: typing.Optional[typing.Callable[[typing.Dict[str, typing.Any]], typing.Any]]) -> None:
+    """
+    设置调用树的输出；根调用结束时以 [Span.to_dict](./#tracing.Span.to_dict) 的结果调用一次
+
+    Args:
+        sink: 接收一个dict参数的函数，eg: 写入文件、发送到队列；None时恢复为默认的 [LoggerSink](./#tracing.LoggerSink)
+    """
+    global _sink
+    _sink = sink if sink is not None else LoggerSink()
+
+
+def current_span() -> typing.Optional[Span]:
+    """
+    获取当前上下文中正在执行的调用
+
+    Returns:
+        没有时返回None
+
+    """
+    if contextvars is None:
+        return None
+    return _current_span.get()
+
+
+def start_span(name: str, **attrs: typing.Any) -> typing.Tuple[Span, typing.Optional["contextvars.Token"]]:
+    """
+    开始一个调用，成为当前上下文中正在执行调用的子调用，必须与 [finish_span](./#tracing.finish_span) 成对使用
+
+    Args:
+        name: 名称，一般为函数路径
+        **attrs: 附加的属性，需要可以json序列化
+
+    Returns:
+        (调用, contextvars的token)；没有 contextvars 时token为None，调用不会输出
+
+    """
+    if contextvars is None:
+        return Span(name, **attrs), None
+    span = Span(name, _current_span.get(), **attrs)
+    return span, _current_span.set(span)
+
+
+def finish_span(
+    span: Span, token: typing.Optional["contextvars.Token"], error: typing.Optional[BaseException] = None
+) -> None:
+    """
+    结束一个调用，累加到父调用；根调用结束时输出整个调用树
+
+    Args:
+        span: [start_span](./#tracing.start_span) 返回的调用
+        token: [start_span](./#tracing.start_span) 返回的token
+        error: 调用抛出的异常
+    """
+    span.total = time.monotonic() - span.start
+    if error is not None:
+        span.error = f"{type(error).__name__}: {error}"
+    if token is None:
+        return
+    try:
+        _current_span.reset(token)
+    except ValueError:
+        # token在其他上下文中创建（例如跨任务结束的调用），只能直接设置
+        _current_span.set(span.parent)
+
+    parent = span.parent
+    if parent is not None:
+        # 子调用可能在其他线程中结束
+        with _lock:
+            parent.child_total += span.total
+            if len(parent.children) < max_children:
+                parent.children.append(span)
+            else:
+                parent.dropped += 1
+        return
+
+    try:
+        _sink(span.to_dict())
+    except Exception:
+        logging.getLogger("pykit_tools.error").exception("pykit_tools tracing sink %s error", _sink)
+
+
+@contextlib.contextmanager
+def span(name: str, **attrs: typing.Any) -> typing.Iterator[Span]:
+    """
+    记录一段代码的调用，eg:
+
+    ```python
+    with tracing.span("load_user", user_id=1):
+        ...
+    ```
+
+    Args:
+        name: 名称
+        **attrs: 附加的属性，需要可以json序列化
+
+    """
+    _span, token = start_span(name, **attrs)
+    try:
+        yield _span
+    except BaseException as e:
+        finish_span(_span, token, e)
+        raise
+    finish_span(_span, token)
+
+
+def traced(func: typing.Optional[typing.Callable] = None, name: typing.Optional[str] = None) -> typing.Callable:
+    """
+    `装饰器` 记录函数的调用，嵌套调用的函数组成调用树，根调用结束时输出到 [set_sink](./#tracing.set_sink) 设置的输出
+
+    也可以通过 time_record(trace=True) 使用
+
+    Args:
+        func: 函数，支持 async 函数
+        name: 名称，默认使用函数路径
+
+    Returns:
+        function
+
+    """
+    if not callable(func):
+        return partial(traced, name=name)
+
+    fn = typing.cast(typing.Callable, func)
+    if contextvars is None:
+        return fn
+    _name = name or get_caller_location(fn)
+
+    if inspect.iscoroutinefunction(fn):
+
+        @wraps(fn)
+        async def _async_wrapper(*args: typing.Any, **kwargs: typing.Any) -> typing.Any:
+            _span, token = start_span(_name)
+            try:
+                ret = await fn(*args, **kwargs)
+            except BaseException as e:
+                finish_span(_span, token, e)
+                raise
+            finish_span(_span, token)
+            return ret
+
+        return _async_wrapper
+
+    @wraps(fn)
+    def _wrapper(*args: typing.Any, **kwargs: typing.Any) -> typing.Any:
+        _span, token = start_span(_name)
+        try:
+            ret = fn(*args, **kwargs)
+        except BaseException as e:
+            finish_span(_span, token, e)
+            raise
+        finish_span(_span, token)
+        return ret
+
+    return _wrapper
+
+
+def bind_context(fn: typing.Callable) -> typing.Callable:
+    """
+    绑定当前的调用上下文，在其他线程中执行时调用仍是当前调用的子调用，eg: `executor.submit(bind_context(fn), *args)`
+
+    Args:
+        fn: 函数
+
+    Returns:
+        在当前上下文的副本中执行的函数；没有 contextvars 时返回原函数
+
+    """
+    if contextvars is None:
+        return fn
+    return partial(contextvars.copy_context().run, fn)
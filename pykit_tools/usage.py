@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+# coding=utf-8
+import gc
+import time
+import typing
+import threading
+import tracemalloc
+from functools import partial
+
+from pykit_tools import fork
+
+# python3.7 开始支持 time.thread_time，之前的版本在支持的系统上使用 clock_gettime，都不支持时不统计CPU时间
+_thread_time: typing.Optional[typing.Callable[[], float]] = getattr(time, "thread_time", None)
+if _thread_time is None and hasattr(time, "CLOCK_THREAD_CPUTIME_ID"):  # pragma: no cover
+    _thread_time = partial(time.clock_gettime, time.CLOCK_THREAD_CPUTIME_ID)
+# python3.9 开始支持，不支持时不统计峰值内存
+_reset_peak: typing.Optional[typing.Callable[[], None]] = getattr(tracemalloc, "reset_peak", None)
+
+
+class _GCMonitor(object):
+    """
+    通过 gc.callbacks 累计进程内垃圾回收的次数和暂停时间，首次使用时才注册回调
+    """
+
+    def __init__(self) -> None:
+        self.collections = 0
+        self.pause = 0.0
+        self._start: typing.Optional[float] = None
+        self._installed = False
+        self._lock = threading.Lock()
+        fork.register_after_fork(self._after_fork)
+
+    def _after_fork(self) -> None:
+        self._lock = threading.Lock()
+
+    def install(self) -> None:
+        if self._installed:
+            return
+        with self._lock:
+            if not self._installed:
+                gc.callbacks.append(self._callback)
+                self._installed = True
+
+    def _callback(self, phase: str, info: typing.Dict) -> None:
+        # 回收期间持有GIL，start和stop成对出现
+        if phase == "start":
+            self._start = time.monotonic()
+        elif self._start is not None:
+            self.pause += time.monotonic() - self._start
+            self.collections += 1
+            self._start = None
+
+
+_gc_monitor = _GCMonitor()
+
+
+class ResourceMeter(object):
+    """
+    统计一次调用的资源使用，每项单独开启，只有开启的项才有额外开销
+
+    - cpu_ms: 当前线程的CPU时间 `time.thread_time`，单位毫秒(ms)，远小于耗时说明在等待IO或锁
+    - gc / gc_ms: 调用期间进程内垃圾回收的次数和暂停时间，单位毫秒(ms)
+    - mem_kb / mem_peak_kb: 调用期间 tracemalloc 统计的净增内存和峰值内存，单位KiB
+
+    python3.9 之前的版本没有 `tracemalloc.reset_peak`，不输出 mem_peak_kb；无法获取线程CPU时间的系统不输出 cpu_ms
+
+    async 函数在 await 期间会执行其他任务，统计的是整个线程的数据；多线程同时调用时 gc 和内存的数据包含其他线程
+    """
+
+    def __init__(self, cpu: bool = False, gc_stats: bool = False, memory: bool = False) -> None:
+        """
+        初始化构造对象
+
+        Args:
+            cpu: 是否统计CPU时间
+            gc_stats: 是否统计垃圾回收
+            memory: 是否统计内存，未开启 tracemalloc 时自动开启，开启后所有的内存分配都会变慢
+        """
+        self.cpu = cpu
+        self.gc_stats = gc_stats
+        self.memory = memory
+        if gc_stats:
+            _gc_monitor.install()
+        if memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def start(self) -> typing.Tuple[float, int, float, int]:
+        """
+        调用开始时记录
+
+        Returns:
+            传给 stop 的开始状态
+
+        """
+        cpu = _thread_time() if self.cpu and _thread_time is not None else 0.0
+        current = 0
+        if self.memory:
+            current = tracemalloc.get_traced_memory()[0]
+            if _reset_peak is not None:
+                _reset_peak()
+        return cpu, _gc_monitor.collections, _gc_monitor.pause, current
+
+    def stop(self, state: typing.Tuple[float, int, float, int]) -> typing.Dict[str, float]:
+        """
+        调用结束时计算资源使用
+
+        Args:
+            state: start 的返回值
+
+        Returns:
+            开启的项，eg: {"cpu_ms": 1.2, "gc": 0, "gc_ms": 0.0}
+
+        """
+        cpu, collections, pause, current = state
+        fields: typing.Dict[str, float] = {}
+        if self.cpu and _thread_time is not None:
+            fields["cpu_ms"] = (_thread_time() - cpu) * 1000
+        if self.gc_stats:
+            fields["gc"] = _gc_monitor.collections - collections
+            fields["gc_ms"] = (_gc_monitor.pause - pause) * 1000
+        if self.memory:
+            now, peak = tracemalloc.get_traced_memory()
+            fields["mem_kb"] = (now - current) / 1024
+            if _reset_peak is not None:
+                fields["mem_peak_kb"] = max(0, peak - current) / 1024
+        return fields
+
+
+def format_fields(fields: typing.Dict[str, float]) -> str:
+    """
+    格式化为日志的后缀，eg: " cpu_ms=1.200 gc=0 gc_ms=0.000"
+    """
+    return "".join(f" {k}={v:.3f}" if isinstance(v, float) else f" {k}={v}" for k, v in fields.items())
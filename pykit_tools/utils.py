@@ -1,8 +1,15 @@
 #!/usr/bin/env python
 # coding=utf-8
+import os
 import time
-import importlib
+import struct
+import pickle
 import typing
+import threading
+import itertools
+import importlib
+
+from pykit_tools import fork
 
 
 def find_method_by_str(method_path: str) -> typing.Optional[typing.Callable]:
@@ -40,32 +47,78 @@ def get_caller_location(caller: typing.Callable) -> str:
     return location
 
 
+# CacheMap 快照文件头及每条数据的长度前缀
+_SNAPSHOT_MAGIC = b"PKCM\x01"
+_SNAPSHOT_LENGTH = struct.Struct(">I")
+
+
 class CacheMap(object):
     """
     缓存对象
 
     Tip: 注意
         若是key太多，容易OOM内存溢出； 且进程销毁会回收
+
+    原子操作（`get_or_set`/`add`/`incr`/`decr`/`cas`）均在锁内完成，线程安全，语义与Redis对应命令保持一致：
+
+    - `add` 对应 `SET key value EX timeout NX`
+    - `incr`/`decr` 对应 `INCRBY`/`DECRBY`，key不存在时从0开始计数
+    - `gets`/`cas` 对应 `WATCH` + `MULTI/EXEC` 的乐观锁
+
+    可通过 `dump`/`load` 将数据保存到快照文件，用于新进程启动时预热缓存
     """
 
     def __init__(self) -> None:
         # 缓存数据, eg: { key: (timeout, value) }
         self.cache: dict = {}
+        # 数据版本号, eg: { key: version }，每次写入都会变化，用于 cas
+        self._versions: dict = {}
+        self._version_seq = itertools.count(1)
+        self._lock = threading.RLock()
+        # get_or_set 中同一个key的构建锁，避免并发重复执行 factory
+        self._key_locks: dict = {}
+        fork.register_after_fork(self._after_fork)
+
+    def _after_fork(self) -> None:
+        # fork时其他线程可能持有锁，子进程中重建
+        self._lock = threading.RLock()
+        self._key_locks = {}
+
+    def _set_value(self, key: str, value: typing.Any, timeout: float) -> None:
+        # 调用方需持有锁
+        self.cache[key] = time.time() + timeout, value
+        self._versions[key] = next(self._version_seq)
+
+    def _get_data(self, key: str, now: float) -> typing.Tuple[bool, typing.Any]:
+        # 调用方需持有锁；返回 (是否存在, 值)
+        data = self.cache.get(key)
+        if not isinstance(data, (tuple, list)) or len(data) != 2:
+            return False, None
+        timeout, value = data
+        if timeout < now:
+            self.cache.pop(key, None)
+            self._versions.pop(key, None)
+            return False, None
+        return True, value
 
     def clean(self) -> None:
         """
         清理过期的数据
         """
         now = time.time()
-        for key, (timeout, value) in list(self.cache.items()):
-            if timeout < now:
-                self.cache.pop(key, None)
+        with self._lock:
+            for key, (timeout, value) in list(self.cache.items()):
+                if timeout < now:
+                    self.cache.pop(key, None)
+                    self._versions.pop(key, None)
 
     def clear(self) -> None:
         """
         清理所有缓存过的数据
         """
-        self.cache = {}
+        with self._lock:
+            self.cache = {}
+            self._versions = {}
 
     def delete(self, key: str) -> typing.Any:
         """
@@ -78,7 +131,9 @@ class CacheMap(object):
             返回删除的值
 
         """
-        return self.cache.pop(key, None)
+        with self._lock:
+            self._versions.pop(key, None)
+            return self.cache.pop(key, None)
 
     def get(self, key: str) -> typing.Any:
         """
@@ -98,7 +153,8 @@ class CacheMap(object):
         timeout, value = data
         if timeout < now:
             # 过了超时时间
-            self.cache.pop(key, None)
+            with self._lock:
+                self._get_data(key, now)
             return None
         return value
 
@@ -115,6 +171,246 @@ class CacheMap(object):
             值
 
         """
-        t = time.time() + timeout
-        self.cache[key] = t, value
+        with self._lock:
+            self._set_value(key, value, timeout)
         return value
+
+    def get_many(self, keys: typing.List[str]) -> typing.List:
+        """
+        批量获取数据，同 redis `MGET`
+
+        Args:
+            keys: 键列表
+
+        Returns:
+            与keys顺序一致的值列表，不存在的key为None
+
+        """
+        return [self.get(key) for key in keys]
+
+    def set_many(self, mapping: typing.Dict[str, typing.Any], timeout: int = 60) -> None:
+        """
+        批量设置数据
+
+        Args:
+            mapping: 键值对
+            timeout: 超时时间，单位秒(s)
+        """
+        with self._lock:
+            for key, value in mapping.items():
+                self._set_value(key, value, timeout)
+
+    def add(self, key: str, value: typing.Any, timeout: int = 60) -> bool:
+        """
+        仅当key不存在（或已过期）时设置数据，同 redis `SET key value EX timeout NX`
+
+        Args:
+            key: 键
+            value: 值
+            timeout: 超时时间，单位秒(s)
+
+        Returns:
+            是否设置成功
+
+        """
+        with self._lock:
+            exists, _ = self._get_data(key, time.time())
+            if exists:
+                return False
+            self._set_value(key, value, timeout)
+        return True
+
+    def get_or_set(self, key: str, factory: typing.Any, timeout: int = 60) -> typing.Any:
+        """
+        获取数据，若不存在则设置数据并返回；同一个key并发调用时 factory 只会执行一次
+
+        Args:
+            key: 键
+            factory: 值；若是callable则调用后的返回值作为值
+            timeout: 超时时间，单位秒(s)
+
+        Returns:
+            数据值
+
+        """
+        with self._lock:
+            exists, value = self._get_data(key, time.time())
+            if exists:
+                return value
+            if not callable(factory):
+                self._set_value(key, factory, timeout)
+                return factory
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+
+        # factory 可能耗时较长，不持有全局锁，只持有该key的锁
+        try:
+            with key_lock:
+                with self._lock:
+                    exists, value = self._get_data(key, time.time())
+                if not exists:
+                    value = factory()
+                    with self._lock:
+                        self._set_value(key, value, timeout)
+        finally:
+            # 数据已写入（或 factory 抛出异常），等待中的线程会读取到数据，可以移除该key的锁
+            with self._lock:
+                if self._key_locks.get(key) is key_lock:
+                    del self._key_locks[key]
+        return value
+
+    def incr(self, key: str, delta: int = 1, timeout: int = 60) -> int:
+        """
+        原子增加数值，同 redis `INCRBY`
+
+        key不存在时从0开始计数，并使用 timeout 作为过期时间；
+        key已存在时保持原有的过期时间不变（同redis，便于实现固定窗口计数）
+
+        Args:
+            key: 键
+            delta: 增加的数值
+            timeout: key不存在时设置的超时时间，单位秒(s)
+
+        Returns:
+            增加后的数值
+
+        Raises:
+            ValueError: 已有数据不是整数
+
+        """
+        with self._lock:
+            now = time.time()
+            exists, value = self._get_data(key, now)
+            if not exists:
+                value = delta
+                self._set_value(key, value, timeout)
+                return value
+            if not isinstance(value, int) or isinstance(value, bool):
+                raise ValueError(f"value of key={key} is not an integer")
+            value += delta
+            expire_at = self.cache[key][0]
+            self.cache[key] = expire_at, value
+            self._versions[key] = next(self._version_seq)
+        return value
+
+    def decr(self, key: str, delta: int = 1, timeout: int = 60) -> int:
+        """
+        原子减少数值，同 redis `DECRBY`，参数说明见 `incr`
+
+        Returns:
+            减少后的数值
+
+        """
+        return self.incr(key, -delta, timeout=timeout)
+
+    def gets(self, key: str) -> typing.Tuple[typing.Any, typing.Optional[int]]:
+        """
+        获取数据及其版本号，配合 `cas` 使用
+
+        Args:
+            key: 键
+
+        Returns:
+            (数据值, 版本号)；key不存在时返回 (None, None)
+
+        """
+        with self._lock:
+            exists, value = self._get_data(key, time.time())
+            if not exists:
+                return None, None
+            return value, self._versions.get(key)
+
+    def cas(self, key: str, value: typing.Any, version: typing.Optional[int], timeout: int = 60) -> bool:
+        """
+        比较并设置（compare-and-swap）：仅当数据版本号仍等于 version 时才设置成功
+
+        Args:
+            key: 键
+            value: 值
+            version: `gets` 获取到的版本号；为None时表示期望key不存在
+            timeout: 超时时间，单位秒(s)
+
+        Returns:
+            是否设置成功
+
+        """
+        with self._lock:
+            exists, _ = self._get_data(key, time.time())
+            current = self._versions.get(key) if exists else None
+            if current != version:
+                return False
+            self._set_value(key, value, timeout)
+        return True
+
+    def dump(self, path: str) -> int:
+        """
+        将未过期的缓存数据写入快照文件，可用于进程重启时预热缓存
+
+        逐条序列化写入文件（过期时间为绝对时间），不会一次性在内存中构建整个快照；
+        先写入临时文件再重命名，避免写入过程中断导致快照损坏；无法序列化的数据会被忽略。
+
+        Args:
+            path: 快照文件路径
+
+        Returns:
+            写入的数据条数
+
+        """
+        now = time.time()
+        with self._lock:
+            items = list(self.cache.items())
+
+        count = 0
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_path, "wb") as f:
+                f.write(_SNAPSHOT_MAGIC)
+                for key, data in items:
+                    if not isinstance(data, (tuple, list)) or len(data) != 2 or data[0] < now:
+                        continue
+                    try:
+                        body = pickle.dumps((key, data[0], data[1]), protocol=pickle.HIGHEST_PROTOCOL)
+                    except Exception:
+                        continue
+                    f.write(_SNAPSHOT_LENGTH.pack(len(body)))
+                    f.write(body)
+                    count += 1
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        return count
+
+    def load(self, path: str) -> int:
+        """
+        从 `dump` 生成的快照文件中加载缓存数据，已过期的数据会被忽略
+
+        注意：快照使用 pickle 序列化，只能加载可信来源的文件
+
+        Args:
+            path: 快照文件路径
+
+        Returns:
+            加载的数据条数
+
+        """
+        count = 0
+        with open(path, "rb") as f:
+            if f.read(len(_SNAPSHOT_MAGIC)) != _SNAPSHOT_MAGIC:
+                raise ValueError(f"{path} is not a CacheMap snapshot file")
+            while True:
+                head = f.read(_SNAPSHOT_LENGTH.size)
+                if len(head) < _SNAPSHOT_LENGTH.size:
+                    break
+                (length,) = _SNAPSHOT_LENGTH.unpack(head)
+                body = f.read(length)
+                if len(body) < length:
+                    # 文件被截断
+                    break
+                key, expire_at, value = pickle.loads(body)
+                if expire_at < time.time():
+                    continue
+                with self._lock:
+                    self.cache[key] = expire_at, value
+                    self._versions[key] = next(self._version_seq)
+                count += 1
+        return count
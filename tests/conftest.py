@@ -1,6 +1,8 @@
 #!/usr/bin/env python
 # coding=utf-8
 import os
+import sys
+import asyncio
 import pytest
 import tempfile
 
@@ -12,3 +14,42 @@ def clean_dir():
         os.chdir(new_path)
         yield
         os.chdir(old_cwd)
+
+
+def pytest_addoption(parser):
+    parser.addoption("--run-benchmark", action="store_true", default=False, help="run tests marked as benchmark")
+
+
+def pytest_configure(config):
+    config.addinivalue_line("markers", "benchmark: 耗时对比测试，需要 --run-benchmark 开启，建议同时使用 --no-cov")
+
+
+def pytest_collection_modifyitems(config, items):
+    if config.getoption("--run-benchmark"):
+        return
+    skip = pytest.mark.skip(reason="need --run-benchmark option to run")
+    for item in items:
+        if "benchmark" in item.keywords:
+            item.add_marker(skip)
+
+
+@pytest.fixture
+def benchmark_env():
+    # 覆盖率统计等逐行追踪会放大纯python代码的耗时，耗时对比没有意义
+    if sys.gettrace() is not None:
+        pytest.skip("benchmark is not reliable with tracing (coverage/debugger), use --no-cov")
+
+
+@pytest.fixture
+def run_async():
+    # asyncio.run 在 python3.7 才支持，每次使用新的事件循环执行
+    def _run(coro):
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            return loop.run_until_complete(coro)
+        finally:
+            asyncio.set_event_loop(None)
+            loop.close()
+
+    return _run
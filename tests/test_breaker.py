@@ -0,0 +1,212 @@
+#!/usr/bin/env python
+# coding=utf-8
+import time
+import asyncio
+import logging
+
+import pytest
+
+from pykit_tools.utils import CacheMap
+from pykit_tools.decorators.common import handle_exception
+from pykit_tools.decorators.breaker import (
+    CircuitState,
+    CircuitOpenError,
+    CircuitBreaker,
+    get_circuit_breaker,
+    circuit_breaker,
+)
+
+
+def test_circuit_breaker_state(caplog, monkeypatch):
+    caplog.set_level(logging.DEBUG, "pykit_tools.error")
+    now = [100.0]
+    monkeypatch.setattr(time, "monotonic", lambda: now[0])
+
+    breaker = CircuitBreaker("test:state", failure_rate=0.5, window_size=4, min_calls=4, cool_down=10)
+    for _ in range(3):
+        assert breaker.allow()
+        breaker.record_failure()
+    # 未达到最少调用次数
+    assert breaker.state == CircuitState.CLOSED.value
+
+    # 环形缓冲区只保留最近4次调用
+    for _ in range(4):
+        breaker.record_success()
+    assert breaker.stats() == {"state": CircuitState.CLOSED.value, "calls": 4, "failures": 0}
+    breaker.record_failure()
+    breaker.record_failure()
+    assert breaker.state == CircuitState.OPEN.value
+    assert not breaker.allow()
+    assert "closed -> open" in caplog.records[-1].message
+    assert caplog.records[-1].levelno == logging.ERROR
+
+    # 冷却后半开，只允许1次试探调用，失败后重新打开
+    now[0] += 10
+    assert breaker.state == CircuitState.HALF_OPEN.value
+    assert breaker.allow()
+    assert not breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == CircuitState.OPEN.value
+
+    # 试探成功后关闭，窗口被清空
+    now[0] += 10
+    assert breaker.allow()
+    breaker.record_success()
+    assert breaker.stats() == {"state": CircuitState.CLOSED.value, "calls": 0, "failures": 0}
+    assert "half_open -> closed" in caplog.records[-1].message
+
+    breaker.record_failure()
+    breaker.reset()
+    assert breaker.stats()["failures"] == 0
+
+    # 同名共享
+    assert get_circuit_breaker("test:shared") is get_circuit_breaker("test:shared", min_calls=1)
+
+
+def test_circuit_breaker_shared(caplog, monkeypatch):
+    caplog.set_level(logging.DEBUG, "pykit_tools.error")
+    now = [100.0]
+    monkeypatch.setattr(time, "monotonic", lambda: now[0])
+
+    client = CacheMap()
+    a = CircuitBreaker("test:fleet", min_calls=1, cool_down=10, shared_client=client)
+    b = CircuitBreaker("test:fleet", min_calls=1, cool_down=10, shared_client=client)
+    assert b.allow()
+    a.record_failure()
+    assert client.get(a.shared_key) == "1"
+    # 检查间隔内不读取共享状态
+    assert b.allow()
+    now[0] += 1
+    assert not b.allow()
+    assert b.state == CircuitState.OPEN.value
+
+    class BrokenClient(object):
+        def get(self, key):
+            raise IOError("get error")
+
+        def set(self, key, value, timeout):
+            raise IOError("set error")
+
+    c = CircuitBreaker("test:broken", min_calls=1, shared_client=BrokenClient())
+    assert c.allow()
+    assert "get shared state error" in caplog.records[-1].message
+    c.record_failure()
+    assert "set shared state error" in caplog.records[-1].message
+    assert c.state == CircuitState.OPEN.value
+
+    lock = c._lock
+    c._after_fork()
+    assert c._lock is not lock
+
+
+def test_circuit_breaker_deco():
+    calls = []
+
+    @circuit_breaker(name="test:deco", min_calls=2, cool_down=60, failure_for=IOError)
+    def call(error=None):
+        calls.append(error)
+        if error:
+            raise error
+        return True
+
+    assert call()
+    # 非 failure_for 的异常记为成功
+    with pytest.raises(ValueError):
+        call(ValueError())
+    assert call.breaker.stats()["failures"] == 0
+    for _ in range(2):
+        with pytest.raises(IOError):
+            call(IOError())
+    assert call.breaker.state == CircuitState.OPEN.value
+
+    # 打开后不再调用函数
+    calls.clear()
+    assert call() is False
+    assert calls == []
+
+    fn = circuit_breaker(lambda: 1, name="test:deco", default=lambda: "default")
+    assert fn() == "default"
+    fn = circuit_breaker(lambda: 1, name="test:deco", is_raise=True)
+    with pytest.raises(CircuitOpenError) as exc_info:
+        fn()
+    assert exc_info.value.name == "test:deco"
+
+    # 与 handle_exception 结合，熔断后不再重试调用
+    fn = handle_exception(max_retries=3, retry_for=IOError, default=0)(call)
+    assert fn(IOError()) == 0
+    assert calls == []
+
+
+def test_circuit_breaker_async(run_async):
+    @circuit_breaker(name="test:async", min_calls=1, is_raise=True)
+    async def call(error=None):
+        if error:
+            raise error
+        return True
+
+    assert run_async(call())
+    with pytest.raises(IOError):
+        run_async(call(IOError()))
+    with pytest.raises(CircuitOpenError):
+        run_async(call())
+    assert call.breaker.state == CircuitState.OPEN.value
+
+
+def test_circuit_breaker_half_open_interrupted(run_async):
+    @circuit_breaker(name="test:half-open-cancel", min_calls=1, cool_down=0.01)
+    async def call(action=None):
+        if action == "hang":
+            await asyncio.sleep(1)
+        elif action == "error":
+            raise IOError()
+        return True
+
+    async def trial():
+        with pytest.raises(IOError):
+            await call("error")
+        await asyncio.sleep(0.02)
+        assert call.breaker.state == CircuitState.HALF_OPEN.value
+        # 试探调用超时被取消，归还试探名额
+        with pytest.raises(asyncio.TimeoutError):
+            await asyncio.wait_for(call("hang"), 0.01)
+        # python3.6 的 wait_for 超时后不等待被取消的任务结束
+        await asyncio.sleep(0)
+        assert call.breaker.state == CircuitState.HALF_OPEN.value
+        return await call()
+
+    assert run_async(trial()) is True
+    assert call.breaker.state == CircuitState.CLOSED.value
+
+    class Interrupt(BaseException):
+        pass
+
+    @circuit_breaker(name="test:half-open-interrupt-async", min_calls=1, cool_down=0.01)
+    async def async_call(error=None):
+        if error:
+            raise error
+        return True
+
+    with pytest.raises(IOError):
+        run_async(async_call(IOError()))
+    time.sleep(0.02)
+    with pytest.raises(Interrupt):
+        run_async(async_call(Interrupt()))
+    assert run_async(async_call()) is True
+
+    @circuit_breaker(name="test:half-open-interrupt", min_calls=1, cool_down=0.01)
+    def sync_call(error=None):
+        if error:
+            raise error
+        return True
+
+    with pytest.raises(IOError):
+        sync_call(IOError())
+    time.sleep(0.02)
+    with pytest.raises(Interrupt):
+        sync_call(Interrupt())
+    assert sync_call.breaker.state == CircuitState.HALF_OPEN.value
+    assert sync_call() is True
+    assert sync_call.breaker.state == CircuitState.CLOSED.value
+    # 关闭状态下不影响统计
+    sync_call.breaker.release()
+    assert sync_call.breaker.stats() == {"state": CircuitState.CLOSED.value, "calls": 0, "failures": 0}
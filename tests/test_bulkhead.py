@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+# coding=utf-8
+import time
+import asyncio
+import threading
+
+import pytest
+
+from pykit_tools.decorators.bulkhead import Bulkhead, BulkheadFullError, get_bulkhead, bulkhead
+
+
+def test_bulkhead():
+    release = threading.Event()
+    running = []
+
+    @bulkhead(name="test:bulkhead", max_concurrent=2, max_queue=1, is_raise=True)
+    def call(i):
+        running.append(i)
+        release.wait()
+        return i
+
+    results = []
+    threads = [threading.Thread(target=lambda i=i: results.append(call(i))) for i in range(3)]
+    for t in threads:
+        t.start()
+        time.sleep(0.02)
+    assert call.bulkhead.stats() == {"in_flight": 2, "queued": 1, "rejected": 0}
+    assert len(running) == 2
+    with pytest.raises(BulkheadFullError):
+        call(3)
+
+    # 同名的函数共享名额
+    fn = bulkhead(lambda: 1, name="test:bulkhead", default=lambda: 0)
+    assert fn() == 0
+    assert call.bulkhead.stats()["rejected"] == 2
+
+    release.set()
+    for t in threads:
+        t.join()
+    assert sorted(results) == [0, 1, 2]
+    assert call.bulkhead.stats() == {"in_flight": 0, "queued": 0, "rejected": 2}
+    assert fn() == 1
+    assert get_bulkhead("test:bulkhead") is call.bulkhead
+
+
+def test_bulkhead_queue_timeout():
+    b = Bulkhead("test:timeout", max_concurrent=1, max_queue=2, queue_timeout=0.05)
+    assert b.acquire()
+    start = time.monotonic()
+    assert not b.acquire()
+    assert time.monotonic() - start >= 0.05
+    assert b.stats() == {"in_flight": 1, "queued": 0, "rejected": 1}
+
+    # 排队中的调用在释放后获得名额
+    got = []
+    t = threading.Thread(target=lambda: got.append(b.acquire()))
+    t.start()
+    time.sleep(0.01)
+    b.release()
+    t.join()
+    assert got == [True]
+    assert b.stats()["in_flight"] == 1
+    b.release()
+    assert b.stats()["in_flight"] == 0
+
+    b._waiters.append(object())
+    b._after_fork()
+    assert b.stats() == {"in_flight": 0, "queued": 0, "rejected": 1}
+
+
+def test_bulkhead_async(run_async):
+    @bulkhead(name="test:async", max_concurrent=1, max_queue=1, queue_timeout=0.05)
+    async def call(delay):
+        await asyncio.sleep(delay)
+        return delay
+
+    async def gather(*delays):
+        # python3.6 的 gather 不按参数顺序开始执行，按顺序创建任务
+        return await asyncio.gather(*[asyncio.ensure_future(call(d)) for d in delays])
+
+    async def run():
+        return await gather(0.02, 0, 0)
+
+    # 第二个排队后执行，第三个被拒绝
+    assert run_async(run()) == [0.02, 0, False]
+    assert call.bulkhead.stats() == {"in_flight": 0, "queued": 0, "rejected": 1}
+
+    async def timeout():
+        return await gather(0.1, 0)
+
+    assert run_async(timeout()) == [0.1, False]
+
+    # 排队中被取消，已获得的名额交给下一个调用
+    async def cancel():
+        first = asyncio.ensure_future(call(0.02))
+        await asyncio.sleep(0)
+        second = asyncio.ensure_future(call.bulkhead.acquire_async())
+        await asyncio.sleep(0)
+        second.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await second
+        return await first
+
+    assert run_async(cancel()) == 0.02
+    assert call.bulkhead.stats()["in_flight"] == 0
+
+    b = Bulkhead("test:async-granted", max_concurrent=1, max_queue=1)
+
+    async def granted_then_cancelled():
+        assert await b.acquire_async()
+        waiter = asyncio.ensure_future(b.acquire_async())
+        await asyncio.sleep(0)
+        b.release()
+        waiter.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiter
+
+    run_async(granted_then_cancelled())
+    assert b.stats()["in_flight"] == 0
@@ -2,6 +2,7 @@
 # coding=utf-8
 import json
 import uuid
+import weakref
 import pytest
 import logging
 
@@ -9,7 +10,7 @@ import logging
 import pykit_tools
 from pykit_tools.utils import CacheMap
 from pykit_tools.decorators import cache
-from pykit_tools.decorators.cache import method_deco_cache
+from pykit_tools.decorators.cache import method_deco_cache, instance_method_cache
 
 
 def test_deco_cache(caplog):
@@ -208,3 +209,278 @@ def test_redis_cache(monkeypatch):
     assert _client.get(test_key) is None
     assert test() == test_word
     assert json.loads(_client.get(test_key)) == test_word
+
+
+def test_estimate_json_length():
+    values = [
+        "abc",
+        {"a": [1, 2.5, None, True, "x"], 1: {}},
+        [],
+        [[], {}, ("a", "b")],
+        {"data": ["a" * 10] * 50},
+    ]
+    for v in values:
+        size = len(json.dumps(v, separators=(",", ":")))
+        assert cache._estimate_json_length(v, size) <= size
+    # 超过limit后提前结束
+    assert cache._estimate_json_length(["a" * 10] * 1000, 100) > 100
+    # 仅遍历10个节点：括号和逗号 2001，9个数字
+    assert cache._estimate_json_length([1] * 2000, 10000, max_nodes=10) == 2010
+
+
+def test_cache_too_long(caplog, monkeypatch):
+    caplog.set_level(logging.DEBUG, "pykit_tools.error")
+    dumps = []
+
+    def _dumps(*args, **kwargs):
+        dumps.append(1)
+        return json_dumps(*args, **kwargs)
+
+    json_dumps = json.dumps
+    monkeypatch.setattr(json, "dumps", _dumps)
+
+    client = CacheMap()
+
+    @method_deco_cache(key="test", cache_client=client, cache_max_length=100)
+    def test(value, n):
+        return [value] * n
+
+    # 明显超长，不会执行序列化
+    test("a" * 10, 100)
+    assert not dumps
+    assert client.get("test") is None
+    assert "Cache too long" in caplog.records[-1].message
+    # 估算无法确定，序列化后才能判断
+    test(12345, 20)
+    assert len(dumps) == 1
+    assert client.get("test") is None
+    test("a" * 10, 7)
+    assert client.get("test") is not None
+
+
+def test_cache_chunks(caplog):
+    caplog.set_level(logging.DEBUG, "pykit_tools.error")
+
+    class SimpleClient(object):
+        def __init__(self):
+            self.data = {}
+
+        def get(self, key):
+            return self.data.get(key)
+
+        def set(self, key, value, timeout):
+            self.data[key] = value
+
+    calls = []
+
+    def test(n):
+        calls.append(n)
+        return {"data": ["数据" * 10] * n}
+
+    for client in (CacheMap(), SimpleClient()):
+        fn = method_deco_cache(test, key="test", cache_client=client, cache_chunk_size=64)
+        v = fn(10)
+        assert fn(10) == v
+        assert len(calls) == 1
+        manifest = client.get("test")
+        assert manifest.startswith(cache._CHUNK_MANIFEST_PREFIX)
+        count = int(manifest.split(":")[1])
+        chunks = [client.get(f"test:chunk:{i}") for i in range(count)]
+        assert all(len(c) <= 64 for c in chunks)
+        assert json.loads("".join(chunks)) == v
+
+        # 小数据不分块
+        fn = method_deco_cache(test, key="small", cache_client=client, cache_chunk_size=64)
+        fn(0)
+        assert json.loads(client.get("small")) == {"data": []}
+
+        # 校验失败
+        client.set("test:chunk:0", "x" * 64, 60)
+        calls.clear()
+        fn = method_deco_cache(test, key="test", cache_client=client, cache_chunk_size=64)
+        assert fn(10) == v
+        assert len(calls) == 1
+        assert "checksum error" in caplog.records[-1].message
+
+        # 部分块丢失
+        client.set("test:chunk:1", None, 60)
+        calls.clear()
+        assert fn(10) == v
+        assert len(calls) == 1
+        calls.clear()
+
+    # 超过 cache_max_length 的数据分块后可以缓存，每块不超过限制
+    large_client = CacheMap()
+    fn = method_deco_cache(test, key="large", cache_client=large_client, cache_max_length=100, cache_chunk_size=100)
+    v = fn(10)
+    assert len(json.dumps(v, separators=(",", ":"))) > 100
+    assert fn(10) == v
+    assert len(calls) == 1
+    assert large_client.get("large").startswith(cache._CHUNK_MANIFEST_PREFIX)
+    calls.clear()
+    with pytest.raises(ValueError):
+        method_deco_cache(test, cache_max_length=100, cache_chunk_size=101)
+
+    # 未开启分块时，manifest数据作为普通数据处理会报错
+    fn = method_deco_cache(test, key="test", cache_client=client)
+    caplog.clear()
+    fn(1)
+    assert "load cache_data error" in caplog.records[0].message
+
+
+def test_redis_cache_chunks():
+    import redis
+
+    _client = redis.StrictRedis(host="127.0.0.1", port=6379, db=0, decode_responses=True)
+    key = f"test:{uuid.uuid4()}"
+
+    @method_deco_cache(key=key, cache_client=_client, cache_chunk_size=100)
+    def test():
+        return "a" * 1000
+
+    assert test() == "a" * 1000
+    assert _client.get(key).startswith(cache._CHUNK_MANIFEST_PREFIX)
+    assert _client.ttl(f"{key}:chunk:0") > 0
+    assert test() == "a" * 1000
+    _client.delete(key, *[f"{key}:chunk:{i}" for i in range(11)])
+
+
+def test_cache_decode_memo(monkeypatch):
+    loads = []
+
+    def _loads(*args, **kwargs):
+        loads.append(1)
+        return json_loads(*args, **kwargs)
+
+    json_loads = json.loads
+    monkeypatch.setattr(json, "loads", _loads)
+
+    client = CacheMap()
+
+    def test(n):
+        return {"data": [{"n": n}]}
+
+    with pytest.raises(TypeError):
+        method_deco_cache(test, decode_memo_size=1, decode_memo_mode="illegal")
+
+    # 默认不开启
+    fn = method_deco_cache(test, key=lambda n: f"test:{n}", cache_client=client)
+    fn(0)
+    assert fn(0) == fn(0)
+    assert len(loads) == 2
+
+    loads.clear()
+    fn = method_deco_cache(test, key=lambda n: f"test:{n}", cache_client=client, decode_memo_size=2)
+    fn(1)
+    v = fn(1)
+    assert v is fn(1)
+    assert len(loads) == 1
+    # 超过数量后淘汰最久未使用的
+    fn(2)
+    fn(3)
+    fn(2)
+    fn(3)
+    assert len(loads) == 3
+    assert fn(1) == v
+    assert len(loads) == 4
+    # 缓存数据变化后重新解码
+    client.set("test:1", json.dumps({"data": []}))
+    assert fn(1) == {"data": []}
+    assert len(loads) == 5
+
+    fn = method_deco_cache(
+        test, key=lambda n: f"test:{n}", cache_client=client, decode_memo_size=2, decode_memo_mode="copy"
+    )
+    v = fn(2)
+    v["data"][0]["n"] = 100
+    assert fn(2) == {"data": [{"n": 2}]}
+    assert fn(2) is not fn(2)
+
+    fn = method_deco_cache(
+        test, key=lambda n: f"test:{n}", cache_client=client, decode_memo_size=2, decode_memo_mode="readonly"
+    )
+    v = fn(3)
+    assert v is fn(3)
+    assert v["data"][0]["n"] == 3
+    assert isinstance(v["data"], tuple)
+    with pytest.raises(TypeError):
+        v["data"] = 1
+    with pytest.raises(TypeError):
+        v["data"][0]["n"] = 1
+
+
+def test_instance_method_cache():
+    client = CacheMap()
+
+    class Test(object):
+        def __init__(self, tenant):
+            self.cache_key = tenant
+
+        def __str__(self):
+            return str(uuid.uuid4())
+
+        @instance_method_cache(cache_client=client)
+        def fn(self, *args):
+            return str(uuid.uuid4())
+
+        @instance_method_cache(identity=lambda self: self.cache_key.upper(), cache_client=client)
+        def fn2(self):
+            return str(uuid.uuid4())
+
+    # 相同标识的不同实例共享缓存
+    assert Test("a").fn() == Test("a").fn()
+    assert Test("a").fn(1) == Test("a").fn(1)
+    assert Test("a").fn(1) != Test("a").fn(2)
+    assert Test("a").fn() != Test("b").fn()
+    assert Test("a").fn2() == Test("A").fn2()
+
+    class Test2(object):
+        def cache_key(self):
+            return "key"
+
+        @instance_method_cache(cache_client=client)
+        def fn(self):
+            return str(uuid.uuid4())
+
+        @instance_method_cache(identity="not_exists", cache_client=client)
+        def fn2(self):
+            return 1
+
+    assert Test2().fn() == Test2().fn()
+    with pytest.raises(TypeError):
+        Test2().fn2()
+
+
+def test_instance_method_cache_weak_local():
+    import gc
+
+    calls = []
+
+    class Test(object):
+        @instance_method_cache(weak_local=True, timeout=10)
+        def fn(self, *args):
+            calls.append(args)
+            return str(uuid.uuid4())
+
+        @instance_method_cache(weak_local=True, cannot_cache=lambda v: v == 0)
+        def zero(self):
+            calls.append(0)
+            return 0
+
+    t = Test()
+    assert t.fn() == t.fn()
+    assert t.fn(1) == t.fn(1)
+    assert t.fn(1) != t.fn(2)
+    assert t.fn() != Test().fn()
+    assert len(calls) == 4
+    assert t.zero() == t.zero() == 0
+    assert calls.count(0) == 2
+
+    # 实例被回收后缓存数据释放
+    local_caches = [
+        c.cell_contents for c in Test.fn.__closure__ if isinstance(c.cell_contents, weakref.WeakKeyDictionary)
+    ]
+    assert len(local_caches[0]) == 1
+    del t
+    gc.collect()
+    assert len(local_caches[0]) == 0
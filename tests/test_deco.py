@@ -1,11 +1,22 @@
 #!/usr/bin/env python
 # coding=utf-8
+import os
+import sys
+import time
+import timeit
+import subprocess
+import signal
 import random
+import asyncio
 import logging
+import threading
+import functools
 
 import pytest
 
-from pykit_tools.decorators.common import handle_exception, time_record
+from pykit_tools.decorators.common import handle_exception, time_record, hedged, call_timeout
+from pykit_tools.decorators.common import TimeoutMode, CallTimeoutError
+from pykit_tools.decorators.common import RetryBackoff, RetryBudget, get_retry_budget
 
 
 def test_handle_exception(caplog, monkeypatch):
@@ -169,3 +180,595 @@ def test_time_record_format_ret_raises(caplog):
     assert record.levelno == logging.ERROR
     assert "format fail" in record.getMessage()
     assert record.exc_info is not None
+
+
+def test_handle_exception_backoff(monkeypatch):
+    sleeps = []
+    monkeypatch.setattr(time, "sleep", lambda v: sleeps.append(v))
+
+    def test():
+        raise ValueError("error")
+
+    with pytest.raises(TypeError):
+        handle_exception(test, retry_backoff="illegal")
+
+    # 支持小数的固定等待
+    handle_exception(test, max_retries=3, retry_delay=0.05, retry_jitter=False)()
+    assert sleeps == [0.05, 0.05]
+
+    # 指数退避 + 最大等待时间
+    sleeps.clear()
+    fn = handle_exception(
+        test,
+        max_retries=5,
+        retry_delay=0.1,
+        retry_jitter=False,
+        retry_backoff=RetryBackoff.EXPONENTIAL.value,
+        retry_max_delay=0.5,
+    )
+    fn()
+    assert sleeps == [0.1, 0.2, 0.4, 0.5]
+
+    # 指数退避 + 抖动；抖动为0时不会sleep，固定抖动比例
+    sleeps.clear()
+    with monkeypatch.context() as m:
+        m.setattr(random, "randint", lambda a, b: 50)
+        fn = handle_exception(test, max_retries=4, retry_delay=0.1, retry_backoff=RetryBackoff.EXPONENTIAL.value)
+        fn()
+    assert sleeps == pytest.approx([0.05, 0.1, 0.2])
+
+    # 去相关抖动
+    sleeps.clear()
+    fn = handle_exception(
+        test, max_retries=20, retry_delay=0.1, retry_backoff=RetryBackoff.DECORRELATED.value, retry_max_delay=1
+    )
+    fn()
+    assert len(sleeps) == 19
+    assert all(0.1 <= v <= 1 for v in sleeps)
+    for prev, v in zip([0.1] + sleeps, sleeps):
+        assert v <= prev * 3
+
+
+def test_handle_exception_deadline(caplog, monkeypatch):
+    caplog.set_level(logging.DEBUG, "pykit_tools.error")
+    sleeps = []
+
+    def test():
+        time.sleep(0.05)
+        raise ValueError("error")
+
+    # 第2次失败后，已耗时加等待时间超过 deadline，不再重试
+    fn = handle_exception(test, default=0, max_retries=10, retry_delay=0.05, retry_jitter=False, deadline=0.17)
+    assert fn() == 0
+    assert len(caplog.records) == 2
+    assert caplog.records[0].levelno == logging.WARNING
+    assert caplog.records[-1].levelno == logging.ERROR
+
+    caplog.clear()
+    fn = handle_exception(test, max_retries=10, retry_delay=1, deadline=0.5, is_raise=True)
+    monkeypatch.setattr(random, "randint", lambda *args: 100)
+    with pytest.raises(ValueError):
+        fn()
+    assert len(caplog.records) == 1
+
+    # 不执行函数
+    assert handle_exception(test, max_retries=0, default=1)() == 1
+
+    # 不匹配 retry_for 时日志级别为 logger_level
+    caplog.clear()
+    handle_exception(test, max_retries=10, retry_for=TypeError)()
+    assert len(caplog.records) == 1
+    assert caplog.records[0].levelno == logging.ERROR
+    assert not sleeps
+
+
+def test_handle_exception_retry_if_result(caplog):
+    caplog.set_level(logging.DEBUG, "pykit_tools.error")
+    results = [None, None, 3]
+
+    def test():
+        return results.pop(0)
+
+    fn = handle_exception(test, max_retries=3, retry_if_result=lambda v: v is None)
+    assert fn() == 3
+    assert len(caplog.records) == 2
+    assert "for result None" in caplog.records[0].message
+
+    # 重试次数用完后返回最后一次的结果
+    results[:] = [None, None, None]
+    fn = handle_exception(test, max_retries=2, retry_if_result=lambda v: v is None)
+    assert fn() is None
+    assert results == [None]
+
+    # 超过总耗时限制
+    results[:] = [None, None, None]
+    fn = handle_exception(
+        test, max_retries=3, retry_delay=1, retry_jitter=False, deadline=0.5, retry_if_result=lambda v: v is None
+    )
+    assert fn() is None
+    assert results == [None, None]
+
+
+def test_handle_exception_async(caplog, monkeypatch, run_async):
+    caplog.set_level(logging.DEBUG, "pykit_tools.error")
+    sleeps = []
+
+    async def fake_sleep(delay):
+        sleeps.append(delay)
+
+    monkeypatch.setattr(asyncio, "sleep", fake_sleep)
+    calls = []
+
+    @handle_exception(max_retries=3, retry_for=IOError, retry_delay=0.5, retry_jitter=False, default=0)
+    async def fetch(error=None):
+        calls.append(error)
+        if error:
+            raise error
+        return 1
+
+    assert run_async(fetch()) == 1
+    calls.clear()
+    assert run_async(fetch(IOError("io"))) == 0
+    assert len(calls) == 3
+    assert sleeps == [0.5, 0.5]
+    assert caplog.records[0].levelno == logging.WARNING
+    assert caplog.records[-1].levelno == logging.ERROR
+
+    fn = handle_exception(fetch.__wrapped__, is_raise=True, log_args=False)
+    with pytest.raises(ValueError):
+        run_async(fn(ValueError("value")))
+
+    results = [None, 2]
+
+    @handle_exception(max_retries=2, retry_if_result=lambda v: v is None)
+    async def poll():
+        return results.pop(0)
+
+    assert run_async(poll()) == 2
+
+    @handle_exception(max_retries=1, retry_if_result=lambda v: v is None)
+    async def poll_once():
+        return None
+
+    assert run_async(poll_once()) is None
+
+    # 取消时不捕获、不重试
+    calls.clear()
+
+    @handle_exception(max_retries=3, default=0)
+    async def cancelled():
+        calls.append(1)
+        raise asyncio.CancelledError()
+
+    with pytest.raises(asyncio.CancelledError):
+        run_async(cancelled())
+    assert calls == [1]
+
+
+def test_time_record_async(caplog, run_async):
+    caplog.set_level(logging.DEBUG, "pykit_tools.error")
+
+    @time_record()
+    async def test(delay, error=None):
+        await asyncio.sleep(delay)
+        if error:
+            raise error
+        return "ok"
+
+    assert run_async(test(0.02)) == "ok"
+    key, cost, ret = caplog.records[-1].getMessage().split()[-3:]
+    assert float(cost) >= 20
+    assert ret == "ok"
+
+    with pytest.raises(ValueError):
+        run_async(test(0, ValueError("boom")))
+    assert caplog.records[-1].levelno == logging.ERROR
+
+    async def cancel():
+        task = asyncio.ensure_future(test(1))
+        await asyncio.sleep(0.01)
+        task.cancel()
+        await task
+
+    with pytest.raises(asyncio.CancelledError):
+        run_async(cancel())
+    assert caplog.records[-1].getMessage().endswith("cancelled")
+
+    # 被取消的调用与正常结束的一样遵循慢调用阈值和聚合
+    @time_record(slow_ms=500, sample_rate=0)
+    async def quiet(delay):
+        await asyncio.sleep(delay)
+
+    @time_record(aggregate=True)
+    async def counted(delay):
+        await asyncio.sleep(delay)
+
+    async def cancel_all():
+        tasks = [asyncio.ensure_future(quiet(1)), asyncio.ensure_future(counted(1))]
+        await asyncio.sleep(0.01)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    caplog.clear()
+    run_async(cancel_all())
+    assert caplog.records == []
+    assert counted.snapshot()["count"] == 1
+    assert counted.snapshot()["errors"] == 0
+
+
+def test_handle_exception_retry_budget():
+    calls = []
+
+    def call(error=None):
+        calls.append(error)
+        if error:
+            raise error
+        return 1
+
+    budget = RetryBudget("test:budget", ratio=0.5, max_tokens=2)
+    fn = handle_exception(call, max_retries=3, retry_for=IOError, default=0, retry_budget=budget)
+    # 初始2个令牌，第一次失败的调用消耗完
+    assert fn(IOError()) == 0
+    assert len(calls) == 3
+    calls.clear()
+    assert fn(IOError()) == 0
+    assert len(calls) == 1
+    assert budget.stats() == {"name": "test:budget", "tokens": 0, "deposits": 0, "withdrawals": 2, "rejections": 1}
+
+    # 成功调用存入令牌，2次成功后允许1次重试
+    assert fn() == 1
+    assert fn() == 1
+    calls.clear()
+    assert fn(IOError()) == 0
+    assert len(calls) == 2
+    assert budget.stats()["deposits"] == 2
+
+    # 按名称共享
+    fn = handle_exception(call, max_retries=3, is_raise=True, retry_budget="test:shared-budget")
+    assert get_retry_budget("test:shared-budget", max_tokens=0) is get_retry_budget("test:shared-budget")
+    calls.clear()
+    with pytest.raises(IOError):
+        fn(IOError())
+    assert len(calls) == 3
+
+    lock = budget._lock
+    budget._after_fork()
+    assert budget._lock is not lock
+
+
+def test_hedged():
+    delays = []
+
+    def read(value=None, error=None):
+        time.sleep(delays.pop(0) if delays else 0)
+        if error:
+            raise error
+        return value
+
+    # 第一次调用慢，对冲调用先返回
+    fn = hedged(read, delay=0.02, max_ratio=1)
+    delays[:] = [0.3, 0]
+    start = time.monotonic()
+    assert fn("v") == "v"
+    assert time.monotonic() - start < 0.2
+    assert fn.hedge_stats() == {"calls": 1, "fired": 1, "won": 1}
+    # 第一次调用在等待时间内完成，不对冲
+    assert fn("v") == "v"
+    assert fn.hedge_stats() == {"calls": 2, "fired": 1, "won": 1}
+
+    # 两次都失败时抛出异常；第一次失败后等待对冲调用的结果
+    delays[:] = [0.05, 0.05]
+    with pytest.raises(ValueError):
+        fn(error=ValueError())
+    assert fn.hedge_stats()["fired"] == 2
+
+    # 超过对冲比例后不再对冲
+    fn = hedged(read, delay=0.01, max_ratio=0.1)
+    delays[:] = [0.05]
+    assert fn("v") == "v"
+    assert fn.hedge_stats() == {"calls": 1, "fired": 0, "won": 0}
+
+    # 自适应等待时间，样本不足时在当前线程中直接调用
+    fn = hedged(read, min_samples=3, window_size=3, max_ratio=1)
+    for _ in range(4):
+        assert fn("v") == "v"
+    assert fn.hedge_stats()["fired"] == 0
+    delays[:] = [0.3, 0]
+    assert fn("v") == "v"
+    assert fn.hedge_stats() == {"calls": 5, "fired": 1, "won": 1}
+
+    state = fn.hedge_stats.__self__
+    lock = state._lock
+    state._after_fork()
+    state.executor._after_fork()
+    assert state._lock is not lock
+    assert state.executor._executor is None
+
+
+def test_hedged_async(run_async):
+    delays = []
+
+    @hedged(delay=0.02, max_ratio=1)
+    async def read(value=None, error=None):
+        await asyncio.sleep(delays.pop(0) if delays else 0)
+        if error:
+            raise error
+        return value
+
+    delays[:] = [1, 0]
+    start = time.monotonic()
+    assert run_async(read("v")) == "v"
+    assert time.monotonic() - start < 0.5
+    assert read.hedge_stats() == {"calls": 1, "fired": 1, "won": 1}
+
+    delays[:] = [0.05, 0.05]
+    with pytest.raises(ValueError):
+        run_async(read(error=ValueError()))
+
+    @hedged(min_samples=1)
+    async def fast():
+        return 1
+
+    assert run_async(fast()) == 1
+    assert run_async(fast()) == 1
+    assert fast.hedge_stats() == {"calls": 2, "fired": 0, "won": 0}
+
+
+def test_call_timeout(caplog, monkeypatch):
+    caplog.set_level(logging.DEBUG, "pykit_tools.error")
+
+    def work(delay, error=None):
+        time.sleep(delay)
+        if error:
+            raise error
+        return delay
+
+    with pytest.raises(TypeError):
+        call_timeout(work, mode="illegal")
+    with monkeypatch.context() as m:
+        m.delattr(signal, "SIGALRM")
+        with pytest.raises(TypeError):
+            call_timeout(work, mode=TimeoutMode.SIGNAL.value)
+
+    for mode in TimeoutMode.values:
+        fn = call_timeout(work, seconds=0.05, mode=mode)
+        assert fn(0) == 0
+        with pytest.raises(ValueError):
+            fn(0, ValueError())
+        with pytest.raises(CallTimeoutError) as exc_info:
+            fn(0.3)
+        assert 0.05 <= exc_info.value.elapsed < 0.3
+        assert isinstance(exc_info.value, TimeoutError)
+
+    # 非主线程中 signal 模式回退为线程
+    fn = call_timeout(work, seconds=0.05, mode=TimeoutMode.SIGNAL.value)
+    errors = []
+
+    def run():
+        try:
+            fn(0.3)
+        except CallTimeoutError as e:
+            errors.append(e)
+
+    t = threading.Thread(target=run)
+    t.start()
+    t.join()
+    assert len(errors) == 1
+
+    # 超时计为可重试的失败
+    calls = []
+
+    @handle_exception(max_retries=3, retry_for=TimeoutError, default=-1)
+    @call_timeout(seconds=0.05, mode=TimeoutMode.SIGNAL.value)
+    def flaky():
+        calls.append(1)
+        time.sleep(0.3 if len(calls) < 3 else 0)
+        return len(calls)
+
+    assert flaky() == 3
+    assert "timeout after" in caplog.records[0].getMessage()
+
+
+def test_call_timeout_nested_signal():
+    signal_mode = TimeoutMode.SIGNAL.value
+
+    def work(delay):
+        time.sleep(delay)
+        return delay
+
+    # 外层先到期
+    @call_timeout(seconds=0.1, mode=signal_mode)
+    def outer_first():
+        return call_timeout(work, seconds=1, mode=signal_mode)(0.5)
+
+    with pytest.raises(CallTimeoutError) as exc_info:
+        outer_first()
+    assert exc_info.value.seconds == 0.1
+    assert exc_info.value.elapsed < 0.3
+
+    # 内层先到期，之后恢复外层的计时器
+    @call_timeout(seconds=0.2, mode=signal_mode)
+    def inner_first():
+        with pytest.raises(CallTimeoutError) as inner_info:
+            call_timeout(work, seconds=0.05, mode=signal_mode)(1)
+        assert inner_info.value.seconds == 0.05
+        return work(1)
+
+    start = time.monotonic()
+    with pytest.raises(CallTimeoutError) as exc_info:
+        inner_first()
+    assert exc_info.value.seconds == 0.2
+    assert time.monotonic() - start < 0.5
+    assert signal.getitimer(signal.ITIMER_REAL) == (0.0, 0.0)
+
+    # 外层的处理函数不抛出异常时继续执行
+    alarms = []
+    previous = signal.signal(signal.SIGALRM, lambda signum, frame: alarms.append(signum))
+    try:
+        signal.setitimer(signal.ITIMER_REAL, 0.05)
+        assert call_timeout(work, seconds=1, mode=signal_mode)(0.2) == 0.2
+        assert alarms == [signal.SIGALRM]
+        assert signal.getitimer(signal.ITIMER_REAL) == (0.0, 0.0)
+        with pytest.raises(CallTimeoutError):
+            signal.setitimer(signal.ITIMER_REAL, 0.05)
+            call_timeout(work, seconds=0.1, mode=signal_mode)(1)
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, previous)
+
+
+def test_call_timeout_abandoned(tmp_path):
+    calls = []
+
+    @call_timeout(seconds=0.05, max_workers=1)
+    def work(delay):
+        calls.append(delay)
+        time.sleep(delay)
+
+    # 唯一的线程被放弃的调用占用，排队的调用超时后取消，不再执行
+    with pytest.raises(CallTimeoutError):
+        work(0.3)
+    with pytest.raises(CallTimeoutError):
+        work(0)
+    time.sleep(0.3)
+    assert calls == [0.3]
+    workers = [t for t in threading.enumerate() if t.name.startswith("pykit_tools.timeout")]
+    assert workers and all(t.daemon for t in workers)
+
+    # 放弃的调用不阻塞进程退出
+    script = tmp_path / "hang.py"
+    script.write_text(
+        "import time\n"
+        "from pykit_tools.decorators.common import call_timeout\n"
+        "try:\n"
+        "    call_timeout(time.sleep, seconds=0.05)(60)\n"
+        "except TimeoutError:\n"
+        "    pass\n"
+    )
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    proc = subprocess.run([sys.executable, str(script)], env=dict(os.environ, PYTHONPATH=root), timeout=30)
+    assert proc.returncode == 0
+
+
+def test_call_timeout_async(run_async):
+    @call_timeout(seconds=0.05)
+    async def work(delay):
+        await asyncio.sleep(delay)
+        return delay
+
+    assert run_async(work(0)) == 0
+    with pytest.raises(CallTimeoutError) as exc_info:
+        run_async(work(1))
+    assert exc_info.value.elapsed >= 0.05
+
+
+def test_handle_exception_log_suppress(caplog):
+    caplog.set_level(logging.DEBUG, "pykit_tools.error")
+
+    def test(data, error=None):
+        raise ValueError(f"error {len(data)}")
+
+    # 还会重试的异常只输出一行，最后一次输出堆栈和截断后的参数
+    fn = handle_exception(test, max_retries=2, log_args_max_bytes=32)
+    fn("x" * 1000)
+    pre, last = caplog.records
+    assert pre.getMessage().endswith("retry=1 ValueError: error 1000")
+    assert not pre.exc_info
+    assert "...(truncated)" in last.getMessage()
+    assert last.exc_info is not None
+
+    caplog.clear()
+    fn = handle_exception(test, max_retries=2, log_compact_retries=False, log_args=False)
+    fn("x")
+    assert all(r.exc_info is not None for r in caplog.records)
+
+    # 日志级别未开启时不格式化
+    caplog.clear()
+    caplog.set_level(logging.CRITICAL, "pykit_tools.error")
+    fn("x")
+    assert caplog.records == []
+
+    # 相同特征的异常在窗口内只输出一次
+    caplog.set_level(logging.DEBUG, "pykit_tools.error")
+    fn = handle_exception(test, log_dedup_window=0.05)
+    for i in range(5):
+        fn("x" * i)
+    assert len(caplog.records) == 1
+    # 异常不再出现时，窗口结束后输出被忽略的数量
+    time.sleep(0.2)
+    assert len(caplog.records) == 2
+    assert caplog.records[-1].getMessage().endswith("ValueError suppressed=4")
+    assert caplog.records[-1].levelno == logging.ERROR
+    fn("x")
+    assert len(caplog.records) == 3
+    assert "suppressed" not in caplog.records[-1].getMessage()
+
+
+def test_time_record_sampling(caplog, monkeypatch):
+    caplog.set_level(logging.DEBUG, "pykit_tools.error")
+    calls = []
+
+    def format_key(v, delay=0):
+        calls.append(v)
+        return f"key-{v}"
+
+    def work(v, delay=0):
+        if delay:
+            time.sleep(delay)
+        if v < 0:
+            raise ValueError(v)
+        return v
+
+    # 每10次调用输出1次，不输出的调用不会构建key
+    fn = time_record(work, format_key=format_key, format_ret=lambda v: calls.append(v), sample_rate=0.1)
+    for i in range(30):
+        fn(i)
+    assert len(caplog.records) == 3
+    assert calls == [0, 0, 10, 10, 20, 20]
+
+    # 只输出慢调用和异常
+    caplog.clear()
+    fn = time_record(work, slow_ms=20)
+    fn(1)
+    fn(2, delay=0.02)
+    with pytest.raises(ValueError):
+        fn(-1)
+    assert [r.getMessage().split()[1] for r in caplog.records] == ["2", "-1"]
+
+    # 慢调用一定输出，其余的按采样率输出
+    caplog.clear()
+    fn = time_record(work, slow_ms=20, sample_rate=1)
+    fn(1)
+    fn(2, delay=0.02)
+    assert len(caplog.records) == 2
+
+    # 无法获取函数路径
+    caplog.clear()
+    time_record(functools.partial(work, 1))()
+    assert caplog.records[0].getMessage().startswith("functools.partial(")
+
+    # 输出比例等于采样率
+    for rate, expected in ((0.4, 40), (0.7, 70), (0.01, 1), (1, 100)):
+        caplog.clear()
+        fn = time_record(work, sample_rate=rate)
+        for i in range(100):
+            fn(i)
+        assert len(caplog.records) == expected
+    for rate in (-0.1, 3):
+        with pytest.raises(ValueError):
+            time_record(work, sample_rate=rate)
+
+
+@pytest.mark.benchmark
+def test_time_record_unsampled_overhead(benchmark_env):
+    """不输出日志的调用相比直接调用的额外耗时小于1微秒"""
+
+    def noop(v):
+        return v
+
+    number = 100000
+    wrapped = time_record(noop, sample_rate=0.0001)
+    raw_cost = min(timeit.repeat(lambda: noop(1), number=number, repeat=5))
+    cost = min(timeit.repeat(lambda: wrapped(1), number=number, repeat=5))
+    assert (cost - raw_cost) / number * 1e6 < 1
@@ -0,0 +1,224 @@
+#!/usr/bin/env python
+# coding=utf-8
+import os
+import gc
+import time
+import signal
+import logging
+import threading
+
+import pytest
+
+from pykit_tools import fork, utils, redis_tool, histogram
+from pykit_tools.log import handlers
+from pykit_tools.patterns import singleton
+from pykit_tools.patterns.singleton import Singleton
+from pykit_tools.decorators import cache
+from pykit_tools.decorators.cache import singleton_refresh_regular
+
+
+def test_fork_callbacks(caplog, monkeypatch):
+    caplog.set_level(logging.DEBUG, "pykit_tools.error")
+    calls = []
+
+    class Test(object):
+        def reset(self):
+            calls.append(self)
+
+    def raise_error():
+        raise ValueError("callback error")
+
+    t = Test()
+    callbacks = fork._Callbacks()
+    callbacks.append(t.reset)
+    callbacks.append(raise_error)
+    callbacks.run()
+    assert calls == [t]
+    assert "fork callback" in caplog.records[-1].message
+
+    # 对象被回收后不再调用
+    calls.clear()
+    del t
+    gc.collect()
+    callbacks.run()
+    assert calls == []
+    assert len(callbacks.refs) == 1
+
+    # 超过数量后清理已回收的对象
+    for _ in range(100):
+        callbacks.append(Test().reset)
+    assert len(callbacks.refs) < 64
+
+    monkeypatch.setattr(fork, "_before_callbacks", fork._Callbacks())
+    monkeypatch.setattr(fork, "_child_callbacks", fork._Callbacks())
+    fork.register_before_fork(lambda: calls.append("before"))
+    fork.register_after_fork(lambda: calls.append("after"))
+    fork.run_before_fork()
+    fork.run_after_fork()
+    assert calls[-2:] == ["before", "after"]
+
+
+def test_fork_reset_objects(clean_dir):
+    cache_map = utils.CacheMap()
+    lock = cache_map._lock
+    cache_map._after_fork()
+    assert cache_map._lock is not lock
+
+    client = redis_tool.RedisRingClient([{"host": "127.0.0.1", "port": 6379, "db": 1}])
+    client.set("test:fork", "v", 10)
+    client._after_fork()
+    assert client.get("test:fork") == "v"
+
+    class Keep(Singleton):
+        pass
+
+    class Drop(Singleton):
+        singleton_fork_policy = fork.ForkPolicy.DROP.value
+        singleton_registry = singleton.LRURegistry
+
+    keep, drop = Keep(), Drop()
+    Keep._singleton_after_fork()
+    Drop._singleton_after_fork()
+    Drop._singleton_instances._after_fork()
+    assert Keep() is keep
+    assert Drop() is not drop
+
+    with pytest.raises(TypeError):
+
+        class Illegal(Singleton):
+            singleton_fork_policy = "illegal"
+
+    with pytest.raises(TypeError):
+        singleton_refresh_regular(Keep, fork_policy="illegal")
+
+    for policy in fork.ForkPolicy.values:
+        refresh_cls = singleton_refresh_regular(type("Refresh", (object,), {}), fork_policy=policy)
+        after_fork = fork._child_callbacks.refs[-1]()
+        ins = refresh_cls()
+        after_fork()
+        assert (refresh_cls() is ins) == (policy == fork.ForkPolicy.KEEP.value)
+
+    memo = cache._DecodeMemo(1, cache.DecodeMemoMode.SHARED.value)
+    lock = memo._lock
+    memo._after_fork()
+    assert memo._lock is not lock
+
+    handler = handlers.MultiProcessTimedRotatingFileHandler("test.log", when="D")
+    stream = handler.stream
+    handler._after_fork()
+    assert stream.closed
+    assert handler.stream is not None and not handler.stream.closed
+    handler.close()
+    handler = handlers.MultiProcessTimedRotatingFileHandler("test.log", when="D", delay=True)
+    handler._after_fork()
+    assert handler.stream is None
+
+
+@pytest.mark.skipif(not hasattr(os, "register_at_fork"), reason="os.register_at_fork not supported")
+@pytest.mark.filterwarnings("ignore::DeprecationWarning")
+def test_fork_under_load(clean_dir):
+    cache_map = utils.CacheMap()
+
+    class Keep(Singleton):
+        pass
+
+    class Drop(Singleton):
+        singleton_fork_policy = fork.ForkPolicy.DROP.value
+
+    @singleton_refresh_regular(timeout=10, fork_policy=fork.ForkPolicy.DROP.value)
+    class Refresh(object):
+        pass
+
+    keep, drop, refresh = Keep(), Drop(), Refresh()
+
+    logger = logging.getLogger("test_fork_under_load")
+    logger.propagate = False
+    handler = handlers.MultiProcessTimedRotatingFileHandler("fork.log", when="D")
+    logger.addHandler(handler)
+
+    stop = threading.Event()
+
+    def worker(i):
+        while not stop.is_set():
+            cache_map.incr("count")
+            cache_map.get_or_set(f"key:{i}", lambda: i, timeout=0)
+            Keep()
+            logger.warning("parent %s", i)
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(4)]
+    for t in threads:
+        t.start()
+
+    try:
+        for _ in range(10):
+            pid = os.fork()
+            if pid == 0:
+                # 子进程中若锁未被重建，会死锁直到超时
+                signal.alarm(5)
+                code = 0
+                try:
+                    for i in range(100):
+                        cache_map.incr("count")
+                        cache_map.get_or_set(f"key:{i}", lambda: i, timeout=0)
+                    assert Keep() is keep
+                    assert Drop() is not drop
+                    assert Refresh() is not refresh
+                    logger.warning("child %s", os.getpid())
+                    handler.flush()
+                except BaseException:
+                    code = 1
+                os._exit(code)
+            _, status = os.waitpid(pid, 0)
+            assert os.WIFEXITED(status) and os.WEXITSTATUS(status) == 0
+    finally:
+        stop.set()
+        for t in threads:
+            t.join()
+
+    handler.flush()
+    with open(handler.useFileName) as f:
+        content = f.read()
+    assert content.count("child") == 10
+    logger.removeHandler(handler)
+    handler.close()
+
+
+@pytest.mark.skipif(not hasattr(os, "register_at_fork"), reason="os.register_at_fork not supported")
+def test_fork_histogram_reporter():
+    messages = []
+
+    class Handler(logging.Handler):
+        def emit(self, record):
+            messages.append(record.getMessage())
+
+    logger = logging.getLogger("test_fork_histogram_reporter")
+    logger.propagate = False
+    logger.setLevel(logging.INFO)
+    handler = Handler()
+    logger.addHandler(handler)
+    hist = histogram.LatencyHistogram()
+    # fork前注册，子进程中不会再注册
+    histogram.register("test:fork-histogram", hist, logger, interval=0.05)
+    hist.record(1)
+
+    pid = os.fork()
+    if pid == 0:
+        signal.alarm(5)
+        code = 0
+        try:
+            messages.clear()
+            # 父进程fork前的数据不重复输出
+            assert hist.snapshot()["count"] == 0
+            assert histogram._reporter._thread is not None and histogram._reporter._thread.is_alive()
+            hist.record(2)
+            for _ in range(100):
+                if messages:
+                    break
+                time.sleep(0.01)
+            assert messages and messages[0].startswith("test:fork-histogram count=1 ")
+        except BaseException:
+            code = 1
+        os._exit(code)
+    _, status = os.waitpid(pid, 0)
+    logger.removeHandler(handler)
+    assert os.WIFEXITED(status) and os.WEXITSTATUS(status) == 0
@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+# coding=utf-8
+import time
+import random
+import logging
+
+import pytest
+
+from pykit_tools import histogram
+from pykit_tools.decorators.common import time_record
+
+
+def test_latency_histogram():
+    hist = histogram.LatencyHistogram()
+    assert hist.snapshot() == {"count": 0, "errors": 0, "min": 0.0, "max": 0.0, "p50": 0.0, "p90": 0.0, "p99": 0.0}
+
+    # 桶的上下界连续，索引和值互为逆运算
+    for value in (0, 1, 63, 64, 65, 127, 128, 1000, 123456789):
+        index = hist._index(value)
+        assert index == hist._index(int(hist._value(index)))
+    assert hist._index(1 << 50) == hist._size - 1
+
+    values = [random.uniform(0.01, 1000) for _ in range(10000)]
+    for v in values:
+        hist.record(v)
+    hist.record(5, error=True)
+    data = hist.snapshot(percentiles=(50, 90, 99, 99.9))
+    values.append(5)
+    values.sort()
+    assert data["count"] == 10001
+    assert data["errors"] == 1
+    assert data["min"] == values[0]
+    assert data["max"] == values[-1]
+    for p in (50, 90, 99, 99.9):
+        expected = values[int(len(values) * p / 100) - 1]
+        assert data[f"p{p:g}"] == pytest.approx(expected, rel=0.04)
+
+    # 内存固定
+    assert len(hist._counts) == 1152
+    assert hist.snapshot(reset=True)["count"] == 10001
+    assert hist.snapshot()["count"] == 0
+
+    lock = hist._lock
+    hist.record(1)
+    hist._after_fork()
+    assert hist._lock is not lock
+    assert hist.snapshot()["count"] == 0
+
+
+def test_time_record_aggregate(caplog, run_async):
+    caplog.set_level(logging.DEBUG, "pykit_tools.error")
+
+    @time_record(aggregate=True, aggregate_interval=0.1)
+    def work(v):
+        if v < 0:
+            raise ValueError(v)
+        return v
+
+    for i in range(100):
+        work(i)
+    with pytest.raises(ValueError):
+        work(-1)
+    # 只输出异常日志
+    assert len(caplog.records) == 1
+    data = work.snapshot()
+    assert data["count"] == 101
+    assert data["errors"] == 1
+    location = caplog.records[0].getMessage().split()[0]
+    assert histogram.snapshot()[location]["count"] == 101
+
+    # 定时输出统计数据并重置
+    caplog.clear()
+    time.sleep(0.25)
+    assert len(caplog.records) == 1
+    message = caplog.records[0].getMessage()
+    assert message.startswith(f"{location} count=101 errors=1 min=")
+    assert work.snapshot()["count"] == 0
+
+    @time_record(aggregate=True)
+    async def async_work():
+        return 1
+
+    assert run_async(async_work()) == 1
+    assert async_work.snapshot()["count"] == 1
+    caplog.clear()
+    histogram.flush()
+    assert any("count=1 errors=0" in r.getMessage() for r in caplog.records)
+    # 没有调用时不输出
+    caplog.clear()
+    histogram.flush()
+    assert caplog.records == []
+
+    reporter = histogram._reporter
+    thread = reporter._thread
+    reporter._after_fork()
+    # 已有注册的直方图时启动新的后台线程，原来的线程退出
+    assert reporter._thread is not None and reporter._thread is not thread
+    assert reporter._thread.is_alive()
+    thread.join(1)
+    assert not thread.is_alive()
+
+
+def test_reporter_shorter_interval(caplog):
+    caplog.set_level(logging.INFO, "pykit_tools.test")
+    logger = logging.getLogger("pykit_tools.test")
+    reporter = histogram._Reporter()
+    slow, fast = histogram.LatencyHistogram(), histogram.LatencyHistogram()
+    reporter.register("slow", slow, logger, 60)
+    time.sleep(0.05)
+    # 后台线程正在按较长的间隔休眠，注册更短的间隔后应立即生效
+    fast.record(1)
+    reporter.register("fast", fast, logger, 0.1)
+    time.sleep(0.3)
+    assert any(r.getMessage().startswith("fast count=1") for r in caplog.records)
+    reporter._thread = None
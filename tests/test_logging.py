@@ -6,7 +6,7 @@ import datetime
 import pytest
 import logging
 
-from pykit_tools.log import adapter, handlers
+from pykit_tools.log import adapter, handlers, suppress
 
 
 def test_format_adapter(caplog):
@@ -153,3 +153,85 @@ def test_multi_handler(monkeypatch):
     patch_handle_file_rotate(monkeypatch, logger, days=3)
     monkeypatch.setattr(os.path, "isfile", lambda x: False)
     logger.debug("Hello world")
+
+
+def test_truncate_repr():
+    assert suppress.truncate_repr((1, "2")) == "(1, '2')"
+    assert suppress.truncate_repr("a" * 100, 0) == repr("a" * 100)
+    text = suppress.truncate_repr({"k": "中" * 1000}, 64)
+    assert text.endswith("...(truncated)")
+    assert len(text.encode("utf-8")) <= 64 + len("...(truncated)")
+    # 超大容器只格式化部分元素
+    assert len(suppress.truncate_repr(list(range(100000)), 10000)) < 1000
+
+
+def test_error_deduplicator(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(time, "monotonic", lambda: now[0])
+
+    def raise_error(msg):
+        raise ValueError(msg)
+
+    signatures = []
+    for i in range(2):
+        try:
+            raise_error(f"id={i}")
+        except ValueError as e:
+            signatures.append(suppress.exception_signature(e, "location"))
+    # 异常信息不同，特征相同；位置为最内层抛出异常的代码行
+    assert signatures[0] == signatures[1]
+    assert signatures[0] == (
+        "builtins",
+        "ValueError",
+        __file__,
+        raise_error.__code__.co_firstlineno + 1,
+        "location",
+    )
+    assert suppress.exception_signature(ValueError()) == ("builtins", "ValueError")
+
+    dedup = suppress.ErrorDeduplicator(window=10, max_entries=2)
+    assert dedup.check("a") == 0
+    assert dedup.check("a") is None
+    assert dedup.check("a") is None
+    now[0] += 10
+    assert dedup.check("a") == 2
+    assert dedup.check("b") == 0
+    # 超过数量时清理过期的特征
+    now[0] += 10
+    assert dedup.check("c") == 0
+    assert set(dedup._entries) == {"c"}
+    assert dedup.check("d") == 0
+    assert dedup.check("e") == 0
+    assert set(dedup._entries) == {"e"}
+
+    # 窗口结束后移除，返回被忽略的数量
+    assert dedup.check("e") is None
+    assert dedup.flush() == {}
+    now[0] += 10
+    assert dedup.flush() == {"e": 1}
+    assert dedup._entries == {}
+
+    lock = dedup._lock
+    dedup._after_fork()
+    assert dedup._lock is not lock
+
+
+def test_error_deduplicator_storm_end():
+    flushed = []
+    dedup = suppress.ErrorDeduplicator(window=0.05, on_flush=lambda k, n: flushed.append((k, n)))
+    assert dedup.check("a") == 0
+    assert dedup.check("b") == 0
+    for _ in range(3):
+        assert dedup.check("a") is None
+    # 错误不再出现时，窗口结束后由定时器输出被忽略的数量
+    time.sleep(0.2)
+    assert flushed == [("a", 3)]
+    assert dedup._timer is None
+    # 已输出的数量不会在下一个窗口重复输出
+    assert dedup.check("a") == 0
+    assert dedup.check("a") is None
+    timer = dedup._timer
+    assert timer is not None and timer.daemon
+    dedup._after_fork()
+    assert dedup._timer is None and dedup._entries == {}
+    timer.cancel()
@@ -1,7 +1,15 @@
 #!/usr/bin/env python
 # coding=utf-8
+import time
+import logging
+import timeit
+import threading
+
 import pytest
 
+from pykit_tools.str_tool import compute_md5
+from pykit_tools.utils import get_caller_location
+from pykit_tools.patterns import singleton
 from pykit_tools.patterns.singleton import Singleton
 from pykit_tools.decorators.cache import singleton_refresh_regular
 
@@ -42,3 +50,247 @@ def test_refresh_singleton():
         pass
 
     assert TestV2() == TestV2()
+
+
+def test_singleton_args():
+    class Test(Singleton):
+        def __init__(self, *args, **kwargs):
+            self.args = args
+            self.kwargs = kwargs
+
+    assert Test(1, a=1, b=2) is Test(1, b=2, a=1)
+    assert Test(1) is not Test(2)
+    assert Test(1) is not Test()
+    # 不可哈希的参数
+    assert Test([1], a={"a": 1}) is Test([1], a={"a": 1})
+    assert Test([1]) is not Test([2])
+    # 相等但类型不同的参数
+    assert len({id(Test(1)), id(Test(True)), id(Test(1.0)), id(Test("1"))}) == 4
+    assert Test(True).args == (True,)
+    assert Test(a=1) is not Test(a=True)
+    assert Test((1,)) is not Test((True,))
+    assert Test((1,)) is Test((1,))
+
+    class Test2(Singleton):
+        pass
+
+    assert Test2() is not Test()
+
+
+def test_singleton_thread_safe():
+    count = []
+
+    class Test(Singleton):
+        def __init__(self, *args):
+            count.append(args)
+            time.sleep(0.05)
+
+    instances = []
+    threads = [threading.Thread(target=lambda i=i: instances.append(Test(i % 2))) for i in range(10)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert len(count) == 2
+    assert len({id(i) for i in instances}) == 2
+    assert Test._singleton_key_locks == {}
+
+    class Fail(Singleton):
+        def __init__(self, *args):
+            raise ValueError(args)
+
+    # 构建失败时也移除该key的锁
+    with pytest.raises(ValueError):
+        Fail(1)
+    assert Fail._singleton_key_locks == {}
+
+
+@pytest.mark.benchmark
+def test_singleton_benchmark(benchmark_env):
+    """实例化耗时：无参数时直接使用类作为key，对比原先每次计算md5的耗时"""
+
+    class Test(Singleton):
+        def __init__(self, *args):
+            pass
+
+    Test()
+    number = 10000
+    # 取多次的最小值，减少其他线程的干扰
+    cost = min(timeit.repeat(Test, number=number, repeat=5))
+    md5_cost = min(timeit.repeat(lambda: compute_md5(get_caller_location(Test)), number=number, repeat=5))
+    assert cost < md5_cost
+
+
+def test_singleton_registry():
+    import gc
+    import functools
+
+    class Test(Singleton):
+        def __init__(self, *args):
+            self.args = args
+
+    class SubTest(Test):
+        pass
+
+    # 每个类单独的注册表
+    t = Test(1)
+    assert singleton.instances_of(Test) == [t]
+    assert singleton.instances_of(SubTest) == []
+    assert SubTest(1) is not t
+    singleton.reset(Test)
+    assert singleton.instances_of(Test) == []
+    assert Test(1) is not t
+    assert len(SubTest._singleton_instances) == 1
+
+    class WeakTest(Singleton):
+        singleton_registry = singleton.WeakRegistry
+
+        def __init__(self, *args):
+            pass
+
+    t = WeakTest(1)
+    assert WeakTest(1) is t
+    assert singleton.instances_of(WeakTest) == [t]
+    del t
+    gc.collect()
+    assert singleton.instances_of(WeakTest) == []
+
+    closed = []
+
+    class LRUTest(Singleton):
+        singleton_registry = functools.partial(singleton.LRURegistry, capacity=2, on_evict=lambda ins: ins.close())
+
+        def __init__(self, *args):
+            self.args = args
+
+        def close(self):
+            closed.append(self.args)
+
+    t1, t2 = LRUTest(1), LRUTest(2)
+    assert LRUTest(1) is t1  # 最近使用
+    LRUTest(3)
+    assert closed == [(2,)]
+    assert LRUTest(1) is t1
+    assert LRUTest(2) is not t2
+    assert closed == [(2,), (3,)]
+    assert len(singleton.instances_of(LRUTest)) == 2
+    singleton.reset(LRUTest)
+    assert sorted(closed) == [(1,), (2,), (2,), (3,)]
+    assert singleton.instances_of(LRUTest) == []
+
+    class StrongTest(Singleton):
+        singleton_registry = functools.partial(singleton.StrongRegistry, on_evict=lambda ins: closed.append(ins))
+
+    closed.clear()
+    t = StrongTest()
+    singleton.reset(StrongTest)
+    assert closed == [t]
+
+
+def test_refresh_singleton_concurrent():
+    count = []
+
+    @singleton_refresh_regular(timeout=10)
+    class Test(object):
+        def __init__(self, *args):
+            count.append(args)
+            time.sleep(0.05)
+
+    instances = []
+    threads = [threading.Thread(target=lambda: instances.append(Test(1))) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert len(count) == 1
+    assert len({id(i) for i in instances}) == 1
+
+
+def test_refresh_singleton_ahead(caplog):
+    caplog.set_level(logging.DEBUG, "pykit_tools.error")
+    built = []
+    closed = []
+
+    @singleton_refresh_regular(timeout=0.3, refresh_ahead=0.2, close_delay=0.05)
+    class Test(object):
+        def __init__(self):
+            built.append(self)
+            time.sleep(0.05)
+
+        def close(self):
+            closed.append(self)
+
+    t1 = Test()
+    assert Test() is t1
+    time.sleep(0.12)
+    # 进入提前刷新时间，仍然返回旧实例，后台构建新实例
+    start = time.monotonic()
+    assert Test() is t1
+    assert Test() is t1
+    assert time.monotonic() - start < 0.04, "callers never wait for construction"
+    time.sleep(0.08)
+    assert len(built) == 2
+    t2 = Test()
+    assert t2 is not t1
+    assert closed == []
+    time.sleep(0.06)
+    assert closed == [t1]
+
+    # 后台刷新失败
+    fail = []
+
+    @singleton_refresh_regular(timeout=0.2, refresh_ahead=0.15)
+    class Test2(object):
+        def __init__(self):
+            if fail:
+                raise ValueError("refresh error")
+            fail.append(1)
+
+    t1 = Test2()
+    time.sleep(0.06)
+    assert Test2() is t1
+    time.sleep(0.02)
+    assert "refresh instance error" in caplog.records[-1].message
+    with pytest.raises(ValueError):
+        time.sleep(0.15)
+        Test2()
+
+    # close 抛出异常
+    @singleton_refresh_regular(timeout=0, close_delay=0)
+    class Test3(object):
+        def close(self):
+            raise ValueError("close error")
+
+    Test3()
+    Test3()
+    time.sleep(0.02)
+    assert "close instance error" in caplog.records[-1].message
+
+
+def test_refresh_singleton_prune():
+    closed = []
+
+    @singleton_refresh_regular(timeout=0.1, close_delay=0)
+    class Test(object):
+        def __init__(self, n):
+            if n < 0:
+                raise ValueError(n)
+            self.n = n
+
+        def close(self):
+            closed.append(self.n)
+
+    # 构建完成后移除key的锁
+    for i in range(5):
+        Test(i)
+    assert Test.singleton_stats() == {"instances": 5, "building": 0}
+    with pytest.raises(ValueError):
+        Test(-1)
+    assert Test.singleton_stats()["building"] == 0
+
+    # 过期的实例在之后构建时清理并关闭
+    time.sleep(0.12)
+    Test(5)
+    assert Test.singleton_stats() == {"instances": 1, "building": 0}
+    time.sleep(0.02)
+    assert sorted(closed) == [0, 1, 2, 3, 4]
@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+# coding=utf-8
+import os
+import time
+import pstats
+import logging
+import tracemalloc
+
+import pytest
+
+from pykit_tools import profiling
+from pykit_tools.profiling import CallProfiler, ProfileFormat
+from pykit_tools.decorators.common import time_record
+
+
+def _helper(n):
+    return sum(range(n))
+
+
+def test_profile_every(tmp_path, caplog):
+    directory = str(tmp_path / "profiles")
+    profiler = CallProfiler(directory, every=3, min_interval=0, max_files=2, top=5)
+
+    @time_record(profiler=profiler)
+    def work(n):
+        return _helper(n)
+
+    with caplog.at_level(logging.INFO):
+        assert [work(i) for i in range(7)] == [sum(range(i)) for i in range(7)]
+    # 第3、6次调用被分析；time_record 的日志不受影响
+    assert profiler.stats() == {"captures": 2, "skipped": 0}
+    assert len(caplog.records) == 7
+    names = sorted(os.listdir(directory))
+    assert len(names) == 2
+    assert all(n.startswith("tests.test_profiling.test_profile_every._locals_.work-") for n in names)
+    with open(os.path.join(directory, names[0]), encoding="utf-8") as f:
+        text = f.read()
+    assert "cost=" in text and "error=None" in text
+    assert "_helper" in text
+    assert "memory peak" not in text
+
+    # 最多保留 max_files 个文件
+    for i in range(3):
+        work(i)
+    assert profiler.stats()["captures"] == 3
+    assert len(os.listdir(directory)) == 2
+
+    # 不支持 async 函数
+    async def coro():
+        pass
+
+    with pytest.raises(TypeError):
+        time_record(coro, profiler=profiler)
+    with pytest.raises(TypeError):
+        CallProfiler(directory, output="html")
+
+
+def test_profile_slow(tmp_path):
+    directory = str(tmp_path)
+    profiler = CallProfiler(directory, slow_ms=20, output=ProfileFormat.PSTATS.value, memory=True, min_interval=60)
+
+    @time_record(profiler=profiler)
+    def work(delay):
+        data = [bytearray(1024) for _ in range(100)]
+        if delay < 0:
+            raise ValueError("negative")
+        time.sleep(delay)
+        return len(data)
+
+    assert work(0) == 100
+    assert os.listdir(directory) == []
+    # 慢调用之后的下一次调用被分析
+    assert work(0.03) == 100
+    assert work(0) == 100
+    names = sorted(os.listdir(directory))
+    assert len(names) == 2
+    assert names[0].endswith(".memory.txt")
+    assert names[1].endswith(".pstats")
+    stats = pstats.Stats(os.path.join(directory, names[1]))
+    assert any(func[2] == "work" for func in stats.stats)
+    with open(os.path.join(directory, names[0]), encoding="utf-8") as f:
+        text = f.read()
+    assert "memory peak=" in text
+    assert "test_profiling.py" in text
+    assert not tracemalloc.is_tracing()
+
+    # 间隔限制内的慢调用不再分析
+    assert work(0.03) == 100
+    assert work(0) == 100
+    assert profiler.stats() == {"captures": 1, "skipped": 1}
+
+    # 分析的调用抛出异常
+    profiler.min_interval = 0
+    profiler.output = ProfileFormat.TEXT.value
+    tracemalloc.start()
+    try:
+        work(0.03)
+        with pytest.raises(ValueError):
+            work(-1)
+        # 已开启的 tracemalloc 不会被关闭
+        assert tracemalloc.is_tracing()
+    finally:
+        tracemalloc.stop()
+    texts = [n for n in os.listdir(directory) if n.endswith(".txt") and not n.endswith(".memory.txt")]
+    with open(os.path.join(directory, texts[0]), encoding="utf-8") as f:
+        text = f.read()
+    assert repr(ValueError("negative")) in text
+    # 已开启的 tracemalloc 需要 reset_peak 才能得到调用期间的峰值内存
+    assert ("memory peak=" in text) == (profiling._reset_peak is not None)
+    assert "lines still allocated" in text
+
+
+def test_profile_errors(tmp_path, caplog, monkeypatch):
+    profiler = CallProfiler(str(tmp_path), every=1, min_interval=0)
+
+    @time_record(profiler=profiler)
+    def work():
+        return 1
+
+    # 已开启其他分析工具时直接调用
+    class Busy(object):
+        def enable(self):
+            raise ValueError("Another profiling tool is already active")
+
+    monkeypatch.setattr(profiling.cProfile, "Profile", Busy)
+    assert work() == 1
+    assert profiler.stats() == {"captures": 0, "skipped": 1}
+    # 本次开启的 tracemalloc 随之关闭
+    profiler.memory = True
+    assert work() == 1
+    assert not tracemalloc.is_tracing()
+    profiler.memory = False
+    monkeypatch.undo()
+
+    # 不支持 reset_peak 时已开启的 tracemalloc 不输出峰值内存
+    monkeypatch.setattr(profiling, "_reset_peak", None)
+    profiler.memory = True
+    profiler.directory = str(tmp_path / "memory")
+    tracemalloc.start()
+    try:
+        assert work() == 1
+    finally:
+        tracemalloc.stop()
+    with open(os.path.join(profiler.directory, os.listdir(profiler.directory)[0]), encoding="utf-8") as f:
+        text = f.read()
+    assert "memory peak=" not in text
+    assert "memory top 30 lines still allocated:" in text
+    profiler.memory = False
+    monkeypatch.undo()
+
+    # 输出失败不影响函数调用
+    profiler.directory = str(tmp_path / "file")
+    with open(profiler.directory, "w") as f:
+        f.write("")
+    with caplog.at_level(logging.ERROR, logger="pykit_tools.error"):
+        assert work() == 1
+    assert "write error" in caplog.records[-1].getMessage()
+
+    # 其他调用正在分析时直接调用
+    assert profiling._capture_lock.acquire()
+    try:
+        assert work() == 1
+    finally:
+        profiling._capture_lock.release()
+    assert profiler.stats()["captures"] == 2
+
+    profiling._after_fork()
+    assert not profiling._capture_lock.locked()
+
+    # 多进程同时轮转时文件可能已被删除
+    monkeypatch.setattr(os, "remove", lambda path: (_ for _ in ()).throw(FileNotFoundError(path)))
+    profiler.directory = str(tmp_path / "rotate")
+    profiler.max_files = 0
+    assert work() == 1
+    assert len(os.listdir(profiler.directory)) == 1
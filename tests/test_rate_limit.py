@@ -0,0 +1,199 @@
+#!/usr/bin/env python
+# coding=utf-8
+import time
+import uuid
+import logging
+
+import pytest
+
+import pykit_tools
+from pykit_tools import redis_tool
+from pykit_tools.decorators import rate_limit as rate_limit_module
+from pykit_tools.decorators.rate_limit import (
+    RateLimitBackend,
+    RateLimitExceeded,
+    RateLimitFailure,
+    TokenBucket,
+    RedisGCRALimiter,
+    get_rate_limiter,
+    rate_limit,
+)
+
+
+NODES = [{"host": "127.0.0.1", "port": 6379, "db": db, "socket_timeout": 10} for db in (1, 2, 3)]
+
+
+def test_token_bucket(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(time, "monotonic", lambda: now[0])
+
+    bucket = TokenBucket("test:bucket", rate=10, burst=2)
+    assert bucket.try_acquire() == 0
+    assert bucket.try_acquire() == 0
+    assert bucket.try_acquire() == pytest.approx(0.1)
+    now[0] += 0.05
+    assert bucket.try_acquire() == pytest.approx(0.05)
+    now[0] += 0.05
+    assert bucket.try_acquire() == 0
+    # 令牌数不超过容量
+    now[0] += 10
+    assert [bucket.try_acquire() for _ in range(3)][-1] > 0
+
+    assert TokenBucket("test:burst", rate=0.5).burst == 1
+    lock = bucket._lock
+    bucket._after_fork()
+    assert bucket._lock is not lock
+
+    with pytest.raises(TypeError):
+        get_rate_limiter("test:illegal", 1, backend="illegal")
+    assert get_rate_limiter("test:shared", 1) is get_rate_limiter("test:shared", 1, burst=1)
+    # 同名的限流器参数必须一致
+    with pytest.raises(ValueError):
+        get_rate_limiter("test:shared", 2)
+    with pytest.raises(ValueError):
+        get_rate_limiter("test:shared", 1, burst=3)
+
+
+def test_rate_limit_deco():
+    @rate_limit(rate=20, burst=1)
+    def call():
+        return 1
+
+    start = time.monotonic()
+    assert [call() for _ in range(3)] == [1, 1, 1]
+    assert time.monotonic() - start >= 0.09
+
+    fn = rate_limit(lambda: 1, rate=1, name="test:fail-fast", block=False, is_raise=True)
+    assert fn() == 1
+    with pytest.raises(RateLimitExceeded) as exc_info:
+        fn()
+    assert 0 < exc_info.value.retry_after <= 1
+
+    fn = rate_limit(lambda: 1, rate=1, name="test:fail-fast", block=False, default=lambda: 0)
+    assert fn() == 0
+    # 默认返回 default 不抛出异常，与其他装饰器一致
+    assert rate_limit(lambda: 1, rate=1, name="test:fail-fast", block=False)() is False
+
+    # 预计等待时间超过 max_wait 时直接失败
+    fn = rate_limit(lambda: 1, rate=5, burst=1, name="test:max-wait", max_wait=0.1, is_raise=True)
+    assert fn() == 1
+    with pytest.raises(RateLimitExceeded):
+        fn()
+
+
+def test_rate_limit_async(run_async):
+    @rate_limit(rate=20, burst=1, name="test:async")
+    async def call():
+        return 1
+
+    async def run():
+        return [await call() for _ in range(3)]
+
+    start = time.monotonic()
+    assert run_async(run()) == [1, 1, 1]
+    assert time.monotonic() - start >= 0.09
+
+    @rate_limit(rate=20, burst=1, name="test:async", block=False, is_raise=False, default=0)
+    async def reject():
+        return 1
+
+    assert run_async(reject()) == 0
+
+
+def test_rate_limit_redis(monkeypatch):
+    class Settings(object):
+        APP_CACHE_REDIS = None
+
+    monkeypatch.setattr(pykit_tools, "settings", Settings())
+    with pytest.raises(ValueError):
+        RedisGCRALimiter("test:no-redis", 1)
+
+    Settings.APP_CACHE_REDIS = NODES[0]
+    name = f"test:{uuid.uuid4()}"
+    limiter = get_rate_limiter(name, 10, burst=2, backend=RateLimitBackend.REDIS.value)
+    assert isinstance(limiter, RedisGCRALimiter)
+    assert limiter.try_acquire() == 0
+    assert limiter.try_acquire() == 0
+    assert 0 < limiter.try_acquire() <= 0.1
+
+    # 多个进程/机器使用不同的客户端共享配额，支持多节点
+    client = redis_tool.RedisRingClient(NODES)
+    name = f"test:{uuid.uuid4()}"
+    other = RedisGCRALimiter(name, 1, client=client)
+    assert other.try_acquire() == 0
+    assert other.try_acquire() > 0  # 使用缓存的脚本
+
+    @rate_limit(rate=1, name=name, backend=RateLimitBackend.REDIS.value, client=client, block=False, is_raise=True)
+    def call():
+        return 1
+
+    with pytest.raises(RateLimitExceeded):
+        call()
+
+
+def test_rate_limit_redis_async(run_async):
+    client = redis_tool.RedisRingClient(NODES)
+    name = f"test:{uuid.uuid4()}"
+
+    @rate_limit(rate=20, burst=1, name=name, backend=RateLimitBackend.REDIS.value, client=client)
+    async def call():
+        return 1
+
+    async def run():
+        return [await call() for _ in range(3)]
+
+    start = time.monotonic()
+    assert run_async(run()) == [1, 1, 1]
+    assert time.monotonic() - start >= 0.09
+
+
+def test_rate_limit_backend_error(caplog, run_async, monkeypatch):
+    caplog.set_level(logging.DEBUG, "pykit_tools.error")
+    # 无法连接的redis
+    client = redis_tool.RedisRingClient([{"host": "127.0.0.1", "port": 1, "db": 0, "socket_connect_timeout": 0.1}])
+    backend = RateLimitBackend.REDIS.value
+
+    with pytest.raises(TypeError):
+        rate_limit(lambda: 1, name="test:error-illegal", backend=backend, client=client, on_backend_error="illegal")
+
+    # 默认抛出后端的异常
+    fn = rate_limit(lambda: 1, name="test:error-raise", backend=backend, client=client)
+    with pytest.raises(Exception) as exc_info:
+        fn()
+    assert not isinstance(exc_info.value, RateLimitExceeded)
+
+    # 放行调用，日志只输出一次
+    fn = rate_limit(
+        lambda: 1,
+        name="test:error-allow",
+        backend=backend,
+        client=client,
+        on_backend_error=RateLimitFailure.ALLOW.value,
+    )
+    assert [fn(), fn()] == [1, 1]
+    messages = [r.getMessage() for r in caplog.records if "backend error" in r.getMessage()]
+    assert messages == ["pykit_tools rate_limit test:error-allow backend error, allow the call, suppressed=0"]
+
+    # 视为超过限流
+    reject = RateLimitFailure.REJECT.value
+    fn = rate_limit(lambda: 1, name="test:error-reject", backend=backend, client=client, on_backend_error=reject)
+    assert fn() is False
+    fn = rate_limit(
+        lambda: 1, name="test:error-reject", backend=backend, client=client, on_backend_error=reject, is_raise=True
+    )
+    with pytest.raises(RateLimitExceeded):
+        fn()
+
+    @rate_limit(name="test:error-reject", backend=backend, client=client, on_backend_error=reject, default=0)
+    async def call():
+        return 1
+
+    assert run_async(call()) == 0
+
+    # 窗口结束时输出被忽略的错误数
+    caplog.clear()
+    monkeypatch.setattr(rate_limit_module._error_dedup, "window", 0)
+    assert rate_limit_module._error_dedup.flush()
+    messages = [r.getMessage() for r in caplog.records]
+    assert any(m.startswith("pykit_tools rate_limit test:error-allow backend error ") for m in messages)
+    assert all(m.endswith("suppressed=1") for m in messages if "test:error-allow" in m)
@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+# coding=utf-8
+import json
+import uuid
+
+import pytest
+import redis
+
+import pykit_tools
+from pykit_tools import redis_tool
+from pykit_tools.decorators.cache import method_deco_cache
+
+
+# 使用同一个redis的不同db模拟多个节点
+NODES = [{"host": "127.0.0.1", "port": 6379, "db": db, "socket_timeout": 10} for db in (1, 2, 3)]
+# 不可用的节点
+DOWN_NODE = {"name": "down", "host": "127.0.0.1", "port": 6390, "db": 0, "socket_connect_timeout": 0.1}
+
+
+def test_hash_ring():
+    assert redis_tool.HashRing([]).get_node("test") is None
+
+    ring = redis_tool.HashRing(["a", "b", "c"])
+    keys = [f"key-{i}" for i in range(3000)]
+    nodes = {k: ring.get_node(k) for k in keys}
+    counts = {n: list(nodes.values()).count(n) for n in ("a", "b", "c")}
+    assert all(c > 700 for c in counts.values()), counts
+    assert ring.get_node("test") == ring.get_node("test")
+
+    # 删除节点只会影响该节点上的key
+    ring2 = redis_tool.HashRing(["a", "b"])
+    for k, n in nodes.items():
+        if n != "c":
+            assert ring2.get_node(k) == n
+        assert ring.get_node(k, skip={"c"}) == ring2.get_node(k)
+    assert ring.get_node("test", skip={"a", "b", "c"}) is None
+
+
+def test_ring_client():
+    with pytest.raises(ValueError):
+        redis_tool.RedisRingClient([])
+    with pytest.raises(ValueError):
+        redis_tool.RedisRingClient([NODES[0], NODES[0]])
+
+    client = redis_tool.build_redis_client(NODES)
+    assert isinstance(client, redis_tool.RedisRingClient)
+    assert set(client.clients) == {"127.0.0.1:6379/1", "127.0.0.1:6379/2", "127.0.0.1:6379/3"}
+
+    keys = [f"test:{uuid.uuid4()}" for _ in range(30)]
+    client.set(keys[0], "v", 10)
+    assert client.get(keys[0]) == "v"
+    assert client.get_client(keys[0]).get(keys[0]) == "v"
+    assert client.get_client(keys[0]).ttl(keys[0]) > 0
+
+    client.set_many({k: k for k in keys}, timeout=10)
+    assert client.get_many(keys + ["not-exists"]) == keys + [None]
+    # key分布在多个节点上
+    assert len({client.get_node(k) for k in keys}) == 3
+    for k in keys:
+        assert client.clients[client.get_node(k)].get(k) == k
+    assert client.delete_many(keys) == len(keys)
+    assert client.get_many(keys) == [None] * len(keys)
+    assert client.delete(keys[0]) == 0
+
+
+def test_ring_client_mark_down(monkeypatch):
+    client = redis_tool.RedisRingClient(NODES[:1] + [DOWN_NODE], retry_interval=30)
+    keys = [f"test:{uuid.uuid4()}" for _ in range(30)]
+    down_key = [k for k in keys if client.get_node(k) == "down"][0]
+
+    with pytest.raises(redis.ConnectionError):
+        client.get(down_key)
+    # 节点被标记不可用，路由到下一个节点
+    assert client.get_node(down_key) == "127.0.0.1:6379/1"
+    client.set(down_key, "v")
+    assert client.get(down_key) == "v"
+    client.delete(down_key)
+
+    # 到达重试时间后重新尝试该节点
+    client._down["down"] = 0
+    with pytest.raises(redis.ConnectionError):
+        client.set_many({k: k for k in keys})
+    assert "down" in client._down
+    client.set_many({k: k for k in keys})
+    assert client.get_many(keys) == keys
+    client.delete_many(keys)
+
+    # 所有节点都不可用
+    client.mark_down("127.0.0.1:6379/1")
+    with pytest.raises(redis.ConnectionError):
+        client.get(down_key)
+    with pytest.raises(redis.ConnectionError):
+        client.get_many(keys)
+
+
+def test_deco_cache_with_nodes(monkeypatch):
+    class Settings(object):
+        APP_CACHE_REDIS = NODES
+
+    monkeypatch.setattr(pykit_tools, "settings", Settings())
+
+    test_key = f"test:{uuid.uuid4()}"
+
+    @method_deco_cache(key=test_key)
+    def test():
+        return str(uuid.uuid4())
+
+    client = redis_tool.RedisRingClient(NODES)
+    v = test()
+    assert v == test()
+    assert json.loads(client.get(test_key)) == v
+    client.delete(test_key)
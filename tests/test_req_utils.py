@@ -6,6 +6,7 @@ import pytest
 from unittest.mock import Mock
 import requests  # type: ignore
 
+from pykit_tools import tracing
 from pykit_tools.decorators.req_utils import requests_logger
 
 
@@ -743,3 +744,32 @@ class TestBaseRequest:
         br = BaseRequest()
         result = br.post("http://example.com", json={"key": "value"})
         assert result.status_code == 200
+
+
+@pytest.mark.skipif(tracing.contextvars is None, reason="contextvars not supported")
+def test_requests_logger_trace():
+    records = []
+    tracing.set_sink(records.append)
+    try:
+
+        @requests_logger(trace=True)
+        def mock_request(method, url, **kwargs):
+            if url.endswith("/error"):
+                raise requests.ConnectionError("refused")
+            response = Mock()
+            response.status_code = 200
+            response.content = b"ok"
+            response.text = "ok"
+            return response
+
+        with tracing.span("handler"):
+            mock_request("GET", "http://example.com/a")
+            mock_request("POST", "http://example.com/error")
+    finally:
+        tracing.set_sink(None)
+
+    ok, error = records[0]["children"]
+    assert ok["name"] == "GET example.com"
+    assert ok["attrs"] == {"url": "http://example.com/a", "status": 200}
+    assert error["name"] == "POST example.com"
+    assert error["error"] == "ConnectionError: refused"
@@ -0,0 +1,270 @@
+#!/usr/bin/env python
+# coding=utf-8
+import os
+import json
+import time
+import asyncio
+import logging
+
+import pytest
+
+from pykit_tools import tracing
+from pykit_tools.decorators.common import time_record, call_timeout, hedged
+
+
+requires_contextvars = pytest.mark.skipif(tracing.contextvars is None, reason="contextvars not supported")
+
+
+@pytest.fixture
+def records():
+    records = []
+    tracing.set_sink(records.append)
+    yield records
+    tracing.set_sink(None)
+
+
+@requires_contextvars
+def test_traced(records):
+    @tracing.traced(name="leaf")
+    def leaf(delay):
+        time.sleep(delay)
+
+    @tracing.traced
+    def root():
+        with tracing.span("block", step=1) as s:
+            assert tracing.current_span() is s
+            leaf(0.01)
+        leaf(0.02)
+        return 1
+
+    assert tracing.current_span() is None
+    assert root() == 1
+    assert tracing.current_span() is None
+    assert len(records) == 1
+
+    record = records[0]
+    assert record["name"].endswith("root")
+    assert record["parent_id"] is None
+    block, leaf2 = record["children"]
+    assert block["name"] == "block"
+    assert block["attrs"] == {"step": 1}
+    assert block["parent_id"] == record["span_id"]
+    assert block["trace_id"] == leaf2["trace_id"] == record["trace_id"]
+    assert [c["name"] for c in block["children"]] == ["leaf"]
+    assert leaf2["total_ms"] >= 20
+    assert block["self_ms"] < block["total_ms"]
+    assert record["self_ms"] == pytest.approx(record["total_ms"] - block["total_ms"] - leaf2["total_ms"], abs=0.01)
+
+    # 异常记录在调用上
+    @tracing.traced(name="fail")
+    def fail():
+        leaf(0)
+        raise ValueError("bad")
+
+    with pytest.raises(ValueError):
+        fail()
+    assert records[-1]["error"] == "ValueError: bad"
+    assert records[-1]["children"][0]["error"] is None
+
+    with pytest.raises(KeyError):
+        with tracing.span("fail-block"):
+            raise KeyError("k")
+    assert records[-1]["name"] == "fail-block"
+    assert records[-1]["error"].startswith("KeyError")
+
+
+@requires_contextvars
+def test_traced_async(records, run_async):
+    @tracing.traced(name="child")
+    async def child(delay):
+        await asyncio.sleep(delay)
+        return delay
+
+    @tracing.traced(name="root")
+    async def root():
+        # 并发执行的任务中的调用都是子调用
+        return await asyncio.gather(child(0.02), child(0.02), child(0))
+
+    assert run_async(root()) == [0.02, 0.02, 0]
+    assert len(records) == 1
+    record = records[0]
+    assert [c["name"] for c in record["children"]] == ["child"] * 3
+    # 并发的子调用耗时之和超过总耗时
+    assert record["self_ms"] >= 0
+
+    @tracing.traced(name="cancelled")
+    async def cancelled():
+        await asyncio.sleep(1)
+
+    async def run():
+        task = asyncio.ensure_future(cancelled())
+        await asyncio.sleep(0)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    run_async(run())
+    assert records[-1]["name"] == "cancelled"
+    assert records[-1]["error"].startswith("CancelledError")
+
+
+@requires_contextvars
+def test_trace_time_record(records, caplog, monkeypatch):
+    @time_record(trace=True, slow_ms=1000)
+    @call_timeout(seconds=1)
+    def inner(x):
+        return x
+
+    @hedged(delay=1)
+    @time_record(trace=True, slow_ms=1000)
+    def hedged_inner(x):
+        return x
+
+    @time_record(trace=True, slow_ms=1000)
+    def outer():
+        return inner(1) + hedged_inner(2)
+
+    # 工作线程中的调用也是子调用
+    assert outer() == 3
+    record = records[0]
+    assert [c["name"].rsplit(".", 1)[-1] for c in record["children"]] == ["inner", "hedged_inner"]
+    assert record["children"][1]["thread_id"] != record["thread_id"]
+
+    # 子调用数量有上限
+    monkeypatch.setattr(tracing, "max_children", 2)
+
+    @time_record(trace=True, slow_ms=1000)
+    def loop():
+        for i in range(5):
+            inner(i)
+
+    loop()
+    assert len(records[-1]["children"]) == 2
+    assert records[-1]["dropped"] == 3
+
+    # 输出异常不影响函数调用
+    def bad_sink(record):
+        raise RuntimeError("sink")
+
+    tracing.set_sink(bad_sink)
+    with caplog.at_level(logging.ERROR, logger="pykit_tools.error"):
+        assert inner(5) == 5
+    assert "tracing sink" in caplog.records[-1].getMessage()
+
+
+def test_without_contextvars(records, monkeypatch):
+    # python3.6 没有 contextvars 时不记录调用树，函数正常调用
+    monkeypatch.setattr(tracing, "contextvars", None)
+
+    def work(x):
+        with tracing.span("block") as s:
+            assert tracing.current_span() is None
+            assert s.name == "block"
+        return x
+
+    assert tracing.traced(work) is work
+    assert tracing.bind_context(work) is work
+    assert time_record(trace=True)(work)(1) == 1
+    assert hedged(delay=1)(work)(2) == 2
+    assert records == []
+
+
+@requires_contextvars
+def test_logger_sink(caplog):
+    tracing.set_sink(None)
+
+    @tracing.traced(name="logged")
+    def logged():
+        with tracing.span("obj", value=object()):
+            pass
+
+    with caplog.at_level(logging.INFO, logger="pykit_tools.trace"):
+        logged()
+    record = json.loads(caplog.records[-1].getMessage())
+    assert record["name"] == "logged"
+    assert record["children"][0]["attrs"]["value"].startswith("<object")
+
+    # token在其他上下文中创建时直接恢复父调用
+    span, token = tracing.start_span("outer")
+    child, child_token = tracing.contextvars.copy_context().run(tracing.start_span, "child")
+    tracing.finish_span(child, child_token)
+    assert tracing.current_span() is span
+    with caplog.at_level(logging.INFO, logger="pykit_tools.trace"):
+        tracing.finish_span(span, token)
+    assert tracing.current_span() is None
+    assert caplog.records[-1].getMessage().count('"child"') == 1
+
+
+def _load_trace(path):
+    # 流式写入的文件没有结尾的 `]`
+    with open(path, encoding="utf-8") as f:
+        text = f.read()
+    assert text.startswith("[\n")
+    return json.loads(text.rstrip().rstrip(",") + "]")
+
+
+@requires_contextvars
+def test_chrome_trace_sink(tmp_path):
+    path = str(tmp_path / "trace.{pid}.json")
+    sink = tracing.ChromeTraceSink(path, max_bytes=2000, backup_count=2)
+    tracing.set_sink(sink)
+    try:
+
+        @time_record(trace=True, slow_ms=1000)
+        @call_timeout(seconds=1)
+        def query(sql):
+            with tracing.span("cache", key=sql):
+                return sql
+
+        @tracing.traced(name="request")
+        def request():
+            query("a")
+            with pytest.raises(ZeroDivisionError):
+                with tracing.span("fail"):
+                    1 / 0
+
+        request()
+        filename = path.format(pid=os.getpid())
+        events = _load_trace(filename)
+    finally:
+        tracing.set_sink(None)
+
+    meta = [e for e in events if e["ph"] == "M"]
+    assert {e["args"]["name"] for e in meta} >= {"MainThread"}
+    assert len({e["tid"] for e in meta}) == 2
+    spans = [e for e in events if e["ph"] != "M"]
+    assert [(e["name"].rsplit(".", 1)[-1], e["ph"]) for e in spans] == [
+        ("request", "B"),
+        ("query", "B"),
+        ("cache", "B"),
+        ("cache", "E"),
+        ("query", "E"),
+        ("fail", "B"),
+        ("fail", "E"),
+        ("request", "E"),
+    ]
+    assert all(e["pid"] == os.getpid() for e in events)
+    # 工作线程中的调用在单独的线程
+    assert spans[2]["tid"] != spans[0]["tid"]
+    assert spans[2]["args"]["key"] == "a"
+    assert spans[5]["args"]["error"].startswith("ZeroDivisionError")
+    assert all(spans[i]["ts"] <= spans[i + 1]["ts"] for i in range(len(spans) - 1))
+
+    # 超过大小后轮转，保留 backup_count 个文件
+    for _ in range(20):
+        sink(tracing.Span("big", thread=1).to_dict())
+    sink.flush()
+    names = sorted(os.listdir(tmp_path))
+    assert names == [os.path.basename(filename) + s for s in ("", ".1", ".2")]
+    assert _load_trace(filename + ".1")[0]["ph"] == "M"
+
+    # 不保留时直接删除；fork后重新打开文件
+    sink.backup_count = 0
+    sink._size = sink.max_bytes
+    sink._after_fork()
+    sink(tracing.Span("after-fork").to_dict())
+    sink._size = sink.max_bytes
+    sink(tracing.Span("rotated").to_dict())
+    sink.close()
+    sink.close()
+    assert [e["name"] for e in _load_trace(filename) if e["ph"] != "M"] == ["rotated", "rotated"]
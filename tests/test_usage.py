@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+# coding=utf-8
+import gc
+import time
+import asyncio
+import logging
+import tracemalloc
+
+import pytest
+
+from pykit_tools import usage, histogram
+from pykit_tools.usage import ResourceMeter
+from pykit_tools.decorators.common import time_record
+
+
+def _burn(seconds):
+    end = usage._thread_time() + seconds
+    while usage._thread_time() < end:
+        pass
+
+
+def test_resource_meter(monkeypatch):
+    meter = ResourceMeter()
+    assert meter.stop(meter.start()) == {}
+
+    meter = ResourceMeter(cpu=True, gc_stats=True)
+    assert usage._gc_monitor._callback in gc.callbacks
+    state = meter.start()
+    _burn(0.02)
+    time.sleep(0.05)
+    fields = meter.stop(state)
+    assert list(fields) == ["cpu_ms", "gc", "gc_ms"]
+    # 等待的时间不计入CPU时间
+    assert 20 <= fields["cpu_ms"] < 45
+    state = meter.start()
+    gc.collect()
+    fields = meter.stop(state)
+    assert fields["gc"] >= 1
+    assert fields["gc_ms"] > 0
+    assert usage.format_fields({"gc": 1, "gc_ms": 0.5}) == " gc=1 gc_ms=0.500"
+
+    # 重复注册只添加一次回调
+    ResourceMeter(gc_stats=True)
+    assert gc.callbacks.count(usage._gc_monitor._callback) == 1
+    lock = usage._gc_monitor._lock
+    usage._gc_monitor._after_fork()
+    assert usage._gc_monitor._lock is not lock
+
+    was_tracing = tracemalloc.is_tracing()
+    meter = ResourceMeter(memory=True)
+    try:
+        assert tracemalloc.is_tracing()
+        state = meter.start()
+        kept = [bytearray(1024) for _ in range(100)]
+        temp = bytearray(1024 * 1024)
+        del temp
+        fields = meter.stop(state)
+        assert 100 <= fields["mem_kb"] < 500
+        if usage._reset_peak is not None:
+            assert fields["mem_peak_kb"] >= 1024
+        assert len(kept) == 100
+
+        # 不支持时不统计CPU时间和峰值内存
+        monkeypatch.setattr(usage, "_reset_peak", None)
+        monkeypatch.setattr(usage, "_thread_time", None)
+        meter = ResourceMeter(cpu=True, memory=True)
+        assert list(meter.stop(meter.start())) == ["mem_kb"]
+    finally:
+        if not was_tracing:
+            tracemalloc.stop()
+
+
+def test_time_record_resource_fields(caplog, run_async):
+    caplog.set_level(logging.INFO)
+
+    @time_record(cpu_time=True, gc_stats=True)
+    def work(v):
+        _burn(0.005)
+        if v < 0:
+            raise ValueError(v)
+        return v
+
+    work(1)
+    message = caplog.records[-1].getMessage()
+    assert " cpu_ms=" in message and " gc=" in message and " gc_ms=" in message
+    with pytest.raises(ValueError):
+        work(-1)
+    assert " -1 cpu_ms=" in caplog.records[-1].getMessage()
+
+    @time_record(cpu_time=True)
+    async def async_work():
+        await asyncio.sleep(0.01)
+        return 1
+
+    assert run_async(async_work()) == 1
+    cpu_ms = float(caplog.records[-1].getMessage().rsplit("cpu_ms=", 1)[1])
+    assert cpu_ms < 10
+
+    # 聚合数据中统计总和和最大值
+    @time_record(aggregate=True, cpu_time=True)
+    def aggregated(v):
+        _burn(0.002 * v)
+        if v < 0:
+            raise ValueError(v)
+
+    for i in range(1, 4):
+        aggregated(i)
+    with pytest.raises(ValueError):
+        aggregated(-1)
+    data = aggregated.snapshot()
+    assert data["count"] == 4
+    assert 12 <= data["cpu_ms_sum"] < 30
+    assert 6 <= data["cpu_ms_max"] < 15
+    caplog.clear()
+    histogram.flush()
+    message = [r.getMessage() for r in caplog.records if "cpu_ms_sum=" in r.getMessage()][0]
+    assert " cpu_ms_max=" in message
+    assert aggregated.snapshot().get("cpu_ms_sum") is None
+
+    @time_record(aggregate=True, cpu_time=True)
+    async def async_aggregated():
+        return 1
+
+    assert run_async(async_aggregated()) == 1
+    assert "cpu_ms_sum" in async_aggregated.snapshot()
@@ -1,6 +1,10 @@
 #!/usr/bin/env python
 # coding=utf-8
+import os
 import time
+import threading
+
+import pytest
 
 from pykit_tools import utils
 
@@ -64,3 +68,134 @@ def test_cache_map():
     cache_client.set("test", 1)
     cache_client.delete("test")
     assert cache_client.get("test") is None
+
+
+def test_cache_map_add_and_get_or_set():
+    cache_client = utils.CacheMap()
+    assert cache_client.add("test", 1) is True
+    assert cache_client.add("test", 2) is False
+    assert cache_client.get("test") == 1
+    # 过期后可以重新add
+    cache_client.set("test", 1, timeout=-1)
+    assert cache_client.add("test", 3) is True
+    assert cache_client.get("test") == 3
+
+    assert cache_client.get_or_set("v", 1) == 1
+    assert cache_client.get_or_set("v", 2) == 1
+    assert cache_client.get_or_set("fn", lambda: "a") == "a"
+    assert cache_client.get_or_set("fn", lambda: "b") == "a"
+
+    # 并发时 factory 只执行一次
+    calls = []
+
+    def factory():
+        calls.append(1)
+        time.sleep(0.05)
+        return len(calls)
+
+    threads = [threading.Thread(target=cache_client.get_or_set, args=("concurrent", factory)) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert len(calls) == 1
+    assert cache_client.get("concurrent") == 1
+    assert cache_client._key_locks == {}
+
+    # factory 抛出异常时也移除该key的锁
+    def fail():
+        raise ValueError("factory error")
+
+    with pytest.raises(ValueError):
+        cache_client.get_or_set("fail", fail)
+    assert cache_client._key_locks == {}
+    assert cache_client.get("fail") is None
+
+
+def test_cache_map_incr():
+    cache_client = utils.CacheMap()
+    assert cache_client.incr("count") == 1
+    assert cache_client.incr("count", 5) == 6
+    assert cache_client.decr("count", 2) == 4
+    assert cache_client.decr("new") == -1
+
+    # 已存在的key不改变过期时间
+    cache_client.incr("ttl", timeout=0.05)
+    expire_at = cache_client.cache["ttl"][0]
+    cache_client.incr("ttl", timeout=100)
+    assert cache_client.cache["ttl"][0] == expire_at
+    time.sleep(0.06)
+    assert cache_client.incr("ttl") == 1
+
+    cache_client.set("str", "a")
+    with pytest.raises(ValueError):
+        cache_client.incr("str")
+
+    threads = [threading.Thread(target=lambda: [cache_client.incr("c") for _ in range(100)]) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert cache_client.get("c") == 800
+
+
+def test_cache_map_cas():
+    cache_client = utils.CacheMap()
+    assert cache_client.gets("test") == (None, None)
+    # 期望key不存在
+    assert cache_client.cas("test", 1, None) is True
+    assert cache_client.cas("test", 1, None) is False
+
+    value, version = cache_client.gets("test")
+    assert value == 1
+    assert cache_client.cas("test", 2, version) is True
+    # 版本已变化
+    assert cache_client.cas("test", 3, version) is False
+    assert cache_client.get("test") == 2
+
+    value, version = cache_client.gets("test")
+    cache_client.set("test", 4)
+    assert cache_client.cas("test", 5, version) is False
+    cache_client.delete("test")
+    assert cache_client.cas("test", 5, version) is False
+
+
+def test_cache_map_snapshot(clean_dir):
+    cache_client = utils.CacheMap()
+    cache_client.set("a", {"k": [1, 2]}, timeout=100)
+    cache_client.set("b", "b", timeout=0.05)
+    cache_client.set("expired", 1, timeout=-1)
+    cache_client.set("lock", threading.Lock())  # 无法序列化，忽略
+    cache_client.cache["illegal"] = 1
+    assert cache_client.dump("cache.snapshot") == 2
+    assert not os.path.exists(f"cache.snapshot.{os.getpid()}.tmp")
+
+    new_client = utils.CacheMap()
+    assert new_client.load("cache.snapshot") == 2
+    assert new_client.get("a") == {"k": [1, 2]}
+    assert new_client.cache["a"][0] == cache_client.cache["a"][0], "Absolute expiry time"
+    value, version = new_client.gets("a")
+    assert new_client.cas("a", 1, version) is True
+
+    # 加载时忽略已过期的数据
+    time.sleep(0.06)
+    new_client = utils.CacheMap()
+    assert new_client.load("cache.snapshot") == 1
+    assert new_client.get("b") is None
+
+    # 文件被截断
+    with open("cache.snapshot", "rb") as f:
+        content = f.read()
+    with open("cache.snapshot", "wb") as f:
+        f.write(content[:-3])
+    assert utils.CacheMap().load("cache.snapshot") == 1
+    with open("cache.snapshot", "wb") as f:
+        f.write(b"illegal")
+    with pytest.raises(ValueError):
+        utils.CacheMap().load("cache.snapshot")
+
+    # 写入失败时不残留临时文件
+    os.mkdir("snapshot_dir")
+    with pytest.raises(OSError):
+        cache_client.dump("snapshot_dir")
+    assert not os.path.exists(f"snapshot_dir.{os.getpid()}.tmp")